@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+import os
+import libvirt
+
+test_driver_uri = 'test:///default'
+domain_xml_template = """<domain type='test'>
+  <name>{}</name>
+  <memory unit='MiB'>128</memory>
+  <vcpu>1</vcpu>
+  <os><type arch='x86_64'>hvm</type></os>
+  <devices>{}</devices>
+</domain>"""
+disk_xml_template = """<disk type='file' device='disk'>
+    <driver name='qemu' type='raw'/>
+    <source file='{}'/>
+    <target dev='vd{}' bus='virtio'/>
+  </disk>"""
+
+
+def create_disk_image(file_path, size_mb, sparse=False, data_every_mb=64):
+    block = os.urandom(1024 * 1024)
+    with open(file_path, 'wb') as image_fp:
+        if sparse:
+            # 1 MiB of data every data_every_mb MiB, holes everywhere else
+            image_fp.truncate(size_mb * 1024 * 1024)
+            for offset_mb in range(0, size_mb, data_every_mb):
+                image_fp.seek(offset_mb * 1024 * 1024)
+                image_fp.write(block)
+        else:
+            for offset_mb in range(size_mb):
+                image_fp.write(block)
+    return file_path
+
+
+def define_test_domain(name, disk_paths):
+    # test:///default is shared by every connection of the process, CreateBackup will see this domain
+    libvirt_connection = libvirt.open(test_driver_uri)
+    disks = ''.join([disk_xml_template.format(disk_path, chr(ord('a') + index))
+                     for index, disk_path in enumerate(disk_paths)])
+    domain = libvirt_connection.defineXML(domain_xml_template.format(name, disks))
+    domain.create()
+    return libvirt_connection, domain
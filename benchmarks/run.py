@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+# Usage (from the repository root): python3 -m benchmarks.run --size-mb 1024 --sparse --output bench_output.txt
+import argparse
+import json
+import logging
+import os
+import shutil
+import tempfile
+from time import time
+import paramiko
+from benchmarks.fixtures import create_disk_image, define_test_domain, test_driver_uri
+from benchmarks.sftp_server import BenchmarkSSHServer
+from sanitexbackup.create_backup import CreateBackup
+from sanitexbackup.retrieve_backup import RetrieveBackup
+
+
+def directory_size(directory):
+    total = 0
+    for root, dirs, files in os.walk(directory):
+        for file_name in files:
+            total += os.path.getsize(os.path.join(root, file_name))
+    return total
+
+
+def check_sizes(name, disk_paths, directory, prefix=''):
+    # A copy that lost its trailing holes is faster but wrong, the numbers of such a run are worthless
+    copies = dict()
+    for root, dirs, files in os.walk(directory):
+        for file_name in files:
+            copies[file_name] = os.path.getsize(os.path.join(root, file_name))
+    for disk_path in disk_paths:
+        copy_name = prefix + os.path.basename(disk_path)
+        if copies.get(copy_name) != os.path.getsize(disk_path):
+            raise RuntimeError('{}: {} is {} bytes instead of {}'.format(
+                name, copy_name, copies.get(copy_name), os.path.getsize(disk_path)
+            ))
+
+
+def measure(name, function, size_of=None, repeat=1, check=None):
+    results = []
+    for iteration in range(repeat):
+        started = time()
+        result = function()
+        elapsed = time() - started
+        if check is not None:
+            check()
+        transferred = size_of() if size_of is not None else 0
+        results.append({
+            'benchmark': name,
+            'iteration': iteration,
+            'seconds': elapsed,
+            'bytes': transferred,
+            'mb_per_second': transferred / 1000000 / max(elapsed, 0.000001) if transferred else None,
+            'ok': result is not False and result != (False, None),
+        })
+    return results
+
+
+def run(arguments):
+    work_dir = tempfile.mkdtemp(prefix='sanitex-bench-')
+    images_dir = os.path.join(work_dir, 'images')
+    staging_dir = os.path.join(work_dir, 'staging')
+    local_dir = os.path.join(work_dir, 'local')
+    for directory in (images_dir, staging_dir, local_dir):
+        os.mkdir(directory)
+    client_key = paramiko.RSAKey.generate(2048)
+    key_file = os.path.join(work_dir, 'id_bench')
+    client_key.write_private_key_file(key_file)
+    server = BenchmarkSSHServer(client_key).start()
+    results = []
+    try:
+        disk_paths = [
+            create_disk_image(
+                os.path.join(images_dir, 'disk{}.img'.format(index)),
+                arguments.size_mb,
+                sparse=arguments.sparse
+            ) for index in range(arguments.disks)
+        ]
+        define_test_domain(arguments.vm_name, disk_paths)
+        connection = {
+            'host': server.host,
+            'port': server.port,
+            'user': 'bench',
+            'keyfile': key_file,
+            'vm_name': arguments.vm_name,
+            'libvirt_uri': test_driver_uri,
+            'temporarily_remote_backup_path': staging_dir,
+            'local_backups_path': local_dir,
+            # The test driver only implements a plain shutdown
+            'shutdown_escalation': ['acpi', 'destroy'],
+            'shutdown_timeout': 5,
+            'download_channels': arguments.channels,
+            'copy_concurrency': arguments.copy_concurrency,
+        }
+        backup_maker = CreateBackup(connection)
+        created = []
+
+        def create_backup():
+            data, backup_name = backup_maker.create_backup()
+            created.append(backup_name)
+            return data
+
+        results += measure(
+            'create_backup',
+            create_backup,
+            lambda: directory_size(os.path.join(staging_dir, created[-1])),
+            arguments.repeat,
+            lambda: check_sizes('create_backup', disk_paths, os.path.join(staging_dir, created[-1]))
+        )
+
+        def retrieve_backup():
+            # Start from scratch every time, otherwise resume skips everything
+            shutil.rmtree(os.path.join(local_dir, created[-1]), ignore_errors=True)
+            return backup_maker.retrieve_backup(created[-1])
+
+        results += measure(
+            'retrieve_backup',
+            retrieve_backup,
+            lambda: directory_size(os.path.join(local_dir, created[-1])),
+            arguments.repeat,
+            lambda: check_sizes('retrieve_backup', disk_paths, os.path.join(local_dir, created[-1]))
+        )
+        results += measure('list_remote_backups', backup_maker.list_remote_backups, repeat=arguments.repeat)
+
+        retrieve_dir = os.path.join(work_dir, 'retrieve')
+
+        def retrieve_backup_get():
+            shutil.rmtree(retrieve_dir, ignore_errors=True)
+            os.mkdir(retrieve_dir)
+            return RetrieveBackup(connection, retrieve_dir, os.path.join(staging_dir, created[-1])).get()
+
+        results += measure(
+            'RetrieveBackup.get',
+            retrieve_backup_get,
+            lambda: directory_size(retrieve_dir),
+            arguments.repeat,
+            lambda: check_sizes('RetrieveBackup.get', disk_paths, retrieve_dir)
+        )
+
+        restored = []
+
+        def restore_backup():
+            # Under a new name every time, the restored images land next to the originals
+            restored.append('{}-restored{}'.format(arguments.vm_name, len(restored)))
+            return backup_maker.restore_backup(created[-1], restored[-1])
+
+        results += measure(
+            'restore_backup',
+            restore_backup,
+            lambda: sum([os.path.getsize(os.path.join(images_dir, restored[-1] + '-' + os.path.basename(disk_path)))
+                         for disk_path in disk_paths]),
+            arguments.repeat,
+            lambda: check_sizes('restore_backup', disk_paths, images_dir, restored[-1] + '-')
+        )
+    finally:
+        server.stop()
+        if not arguments.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    for result in results:
+        result.update({
+            'disks': arguments.disks,
+            'size_mb': arguments.size_mb,
+            'sparse': arguments.sparse,
+            'channels': arguments.channels,
+        })
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Offline transfer benchmarks against local SSH/SFTP and libvirt stand-ins'
+    )
+    parser.add_argument('--size-mb', type=int, default=256, help='size of every generated disk image')
+    parser.add_argument('--disks', type=int, default=2, help='disk images attached to the test domain')
+    parser.add_argument('--sparse', action='store_true', help='generate mostly empty images')
+    parser.add_argument('--channels', type=int, default=4, help='SFTP channels used for downloads')
+    parser.add_argument('--copy-concurrency', type=int, default=2, help='concurrent staging copies')
+    parser.add_argument('--repeat', type=int, default=3, help='iterations per benchmark')
+    parser.add_argument('--vm-name', default='sanitex-bench')
+    parser.add_argument('--keep', action='store_true', help='keep the temporary directory')
+    parser.add_argument('--output', help='write JSON lines here instead of stdout')
+    arguments = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    lines = '\n'.join([json.dumps(result) for result in run(arguments)])
+    if arguments.output:
+        with open(arguments.output, 'w') as output_fp:
+            output_fp.write(lines + '\n')
+    else:
+        print(lines)
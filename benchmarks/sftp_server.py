@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import socket
+import subprocess
+from copy import copy
+from threading import Thread, Event
+import paramiko
+from paramiko import ServerInterface, SFTPServerInterface, SFTPServer, SFTPAttributes, SFTPHandle, SFTP_OK
+from paramiko import AUTH_SUCCESSFUL, AUTH_FAILED, OPEN_SUCCEEDED
+
+
+def apply_attributes(path, attr, file_object=None):
+    # SFTPServer.set_file_attr changes the size through open(path, 'w+'), which empties the file first
+    if attr._flags & attr.FLAG_SIZE:
+        if file_object is not None:
+            file_object.flush()
+            os.ftruncate(file_object.fileno(), attr.st_size)
+        else:
+            os.truncate(path, attr.st_size)
+    # Permissions, owner and times, the size is done
+    other = copy(attr)
+    other._flags &= ~attr.FLAG_SIZE
+    SFTPServer.set_file_attr(path, other)
+
+
+class BenchmarkSFTPHandle(SFTPHandle):
+    def stat(self):
+        try:
+            return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attr):
+        try:
+            apply_attributes(self.filename, attr, self.writefile)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+
+class BenchmarkSFTPInterface(SFTPServerInterface):
+    # Serves the local filesystem as is, so staging paths and libvirt disk paths need no translation
+
+    def list_folder(self, path):
+        try:
+            out = []
+            for file_name in os.listdir(path):
+                attributes = SFTPAttributes.from_stat(os.stat(os.path.join(path, file_name)))
+                attributes.filename = file_name
+                out.append(attributes)
+            return out
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.stat(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.lstat(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def open(self, path, flags, attr):
+        try:
+            binary_flag = getattr(os, 'O_BINARY', 0)
+            fd = os.open(path, flags | binary_flag, 0o600)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+        try:
+            file_object = os.fdopen(fd, mode)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        handle = BenchmarkSFTPHandle(flags)
+        handle.filename = path
+        handle.readfile = file_object
+        handle.writefile = file_object
+        return handle
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        try:
+            os.rename(oldpath, newpath)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def posix_rename(self, oldpath, newpath):
+        return self.rename(oldpath, newpath)
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(path)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def rmdir(self, path):
+        try:
+            os.rmdir(path)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def chattr(self, path, attr):
+        try:
+            apply_attributes(path, attr)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def canonicalize(self, path):
+        return os.path.normpath(path if os.path.isabs(path) else os.path.join('/', path))
+
+
+class BenchmarkServerInterface(ServerInterface):
+    def __init__(self, authorized_key):
+        self.authorized_key = authorized_key
+
+    def check_auth_publickey(self, username, key):
+        if key.get_base64() == self.authorized_key.get_base64():
+            return AUTH_SUCCESSFUL
+        return AUTH_FAILED
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        # Remote commands (mkdir, cp, find, zstd...) run locally, like they would on the hypervisor
+        Thread(target=self._run_command, args=(channel, command), daemon=True).start()
+        return True
+
+    @staticmethod
+    def _run_command(channel, command):
+        process = subprocess.Popen(
+            command.decode() if isinstance(command, bytes) else command,
+            shell=True,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+        stdout, stderr = process.communicate()
+        channel.sendall(stdout)
+        channel.sendall_stderr(stderr)
+        channel.send_exit_status(process.returncode)
+        channel.close()
+
+
+class BenchmarkSSHServer:
+    def __init__(self, authorized_key, host='127.0.0.1', port=0):
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.authorized_key = authorized_key
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((host, port))
+        self.socket.listen(16)
+        self.host, self.port = self.socket.getsockname()
+        self.stopped = Event()
+        self.transports = []
+        self.thread = None
+
+    def start(self):
+        self.thread = Thread(target=self._accept, name='benchmark-ssh', daemon=True)
+        self.thread.start()
+        return self
+
+    def _accept(self):
+        while not self.stopped.is_set():
+            try:
+                client, address = self.socket.accept()
+            except OSError:
+                return
+            transport = paramiko.Transport(client)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler('sftp', SFTPServer, BenchmarkSFTPInterface)
+            try:
+                transport.start_server(server=BenchmarkServerInterface(self.authorized_key))
+            except paramiko.SSHException as e:
+                logging.warning('Benchmark SSH negotiation failed: {}'.format(e))
+                continue
+            self.transports.append(transport)
+
+    def stop(self):
+        self.stopped.set()
+        self.socket.close()
+        for transport in self.transports:
+            transport.close()
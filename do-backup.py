@@ -1,24 +1,38 @@
 # -*- coding: utf-8 -*-
 import logging
 from sanitexbackup.retrieve_backup import RetrieveBackup
-from sanitexbackup.create_backup import CreateBackup
+from sanitexbackup.orchestrator import BackupOrchestrator, expand_connections
+from configloader import get_config_from_file
 from os import environ, path
 
 
 if __name__ == '__main__':
-    if 'SERVER' not in environ or "VM_NAME" not in environ:
-        logging.critical('Server must be defined in env var SERVER and Virtual Machine name in VM_NAME.')
-        exit(1)
-    if 'USER' in environ:
-        user = environ['USER']
+    if 'SERVER' in environ and "VM_NAME" in environ:
+        if 'USER' in environ:
+            user = environ['USER']
+        else:
+            user = 'root'
+        my_connection = {
+            'host': environ['SERVER'],
+            'user': user,
+            'keyfile': path.expanduser('~') + '/.ssh/id_backup',
+            'vm_name': environ['VM_NAME']
+        }
+        connections = [my_connection]
     else:
-        user = 'root'
-    my_connection = {
-        'host': environ['SERVER'],
-        'user': user,
-        'keyfile': path.expanduser('~') + '/.ssh/id_backup',
-        'vm_name': environ['VM_NAME']
-    }
+        # Every VM of every host listed in the configuration file
+        config = get_config_from_file(environ.get('CONFIG_FILE', 'config/config.yaml'))
+        if not config:
+            logging.critical('Server must be defined in env var SERVER and Virtual Machine name in VM_NAME, '
+                             'or VMs listed under "hosts" in the configuration file.')
+            exit(1)
+        config = config.get('connection', config)
+        config.setdefault('keyfile', path.expanduser('~') + '/.ssh/id_backup')
+        connections = expand_connections(config)
+        if not connections:
+            logging.critical('No VMs found in the configuration file.')
+            exit(1)
+        my_connection = connections[0]
 
     if 'local_path' in environ:
         my_local_path = environ['local_path']
@@ -28,12 +42,10 @@ if __name__ == '__main__':
     if not my_local_path.endswith('/'):
         my_local_path += '/'
 
-    backup_maker = CreateBackup(my_connection)
-    data = backup_maker.create_backup()
-    if data:
-        logging.warning(data)
-    else:
-        logging.critical("Could not create remote backup")
+    results = BackupOrchestrator(connections).run()
+    logging.warning(BackupOrchestrator.format_results(results))
+    if not all([result['ok'] for result in results]):
+        logging.critical("Could not create every remote backup")
         exit(1)
     exit(0)
     backup_getter = RetrieveBackup(my_connection, my_local_path)
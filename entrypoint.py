@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 # from sanitexbackup.create_backup import CreateBackup
 from sanitexbackup.notifier import Notifier
+from sanitexbackup.orchestrator import expand_connections
 from configloader import get_config_from_file
 from os.path import expanduser, join as join_path, isdir
 from os import mkdir, chmod
@@ -30,11 +31,12 @@ if 'temporarily_remote_backup_path' not in connection:
 # else:
 #     print(backup_result)
 
-if 'host' in connection:
+for vm_connection in expand_connections(connection):
     logging.warning(
-        'Remote backups will be created at {} in dir {}'.format(
-            connection['host'],
-            connection['temporarily_remote_backup_path']
+        'Remote backups of {} will be created at {} in dir {}'.format(
+            vm_connection['vm_name'],
+            vm_connection.get('host'),
+            vm_connection['temporarily_remote_backup_path']
         )
     )
 
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+import logging
+import sqlite3
+from datetime import datetime
+from threading import Lock
+from time import time
+
+
+class BackupCatalog:
+    instances = dict()
+    instances_lock = Lock()
+    per_page = 20
+
+    @classmethod
+    def shared(cls, database):
+        with cls.instances_lock:
+            if database not in cls.instances:
+                cls.instances[database] = cls(database)
+            return cls.instances[database]
+
+    def __init__(self, database):
+        self.database = database
+        self.lock = Lock()
+        self.db = sqlite3.connect(self.database, check_same_thread=False)
+        with self.db:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS backups (
+                vm TEXT NOT NULL,
+                name TEXT NOT NULL,
+                host TEXT,
+                path TEXT NOT NULL,
+                created REAL NOT NULL,
+                retrieved REAL NOT NULL,
+                logical_size INTEGER NOT NULL DEFAULT 0,
+                stored_size INTEGER NOT NULL DEFAULT 0,
+                file_count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (vm, name)
+            )""")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS files (
+                vm TEXT NOT NULL,
+                backup TEXT NOT NULL,
+                name TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                stored_size INTEGER NOT NULL,
+                checksum TEXT,
+                mtime REAL,
+                PRIMARY KEY (vm, backup, name)
+            )""")
+            self.db.execute('CREATE INDEX IF NOT EXISTS backups_created ON backups (created)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS backups_vm_created ON backups (vm, created)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+
+    @staticmethod
+    def created_from_name(backup_name):
+        # backup-<vm>-YYYYmmddHHMMSS, backups taken before several VMs were supported are backup-YYYYmmddHHMM
+        stamp = backup_name.rsplit('-', 1)[-1]
+        for stamp_format in ('%Y%m%d%H%M%S', '%Y%m%d%H%M'):
+            try:
+                return datetime.strptime(stamp, stamp_format).timestamp()
+            except ValueError:
+                continue
+        return time()
+
+    def get_meta(self, key):
+        with self.lock:
+            row = self.db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    def record_backup(self, vm_name, backup_name, host, backup_path, files):
+        # files: list of dicts with name, size, stored_size, mtime and optionally checksum
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM files WHERE vm = ? AND backup = ?', (vm_name, backup_name))
+            self.db.executemany(
+                'INSERT INTO files (vm, backup, name, size, stored_size, checksum, mtime) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [
+                    (vm_name, backup_name, item['name'], item['size'], item['stored_size'], item.get('checksum'),
+                     item.get('mtime'))
+                    for item in files
+                ]
+            )
+            self.db.execute(
+                'INSERT OR REPLACE INTO backups '
+                '(vm, name, host, path, created, retrieved, logical_size, stored_size, file_count) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (
+                    vm_name,
+                    backup_name,
+                    host,
+                    backup_path,
+                    self.created_from_name(backup_name),
+                    time(),
+                    sum([item['size'] for item in files]),
+                    sum([item['stored_size'] for item in files]),
+                    len(files)
+                )
+            )
+        logging.info('Catalog updated with {} of {} ({} files)'.format(backup_name, vm_name, len(files)))
+
+    def set_checksum(self, vm_name, backup_name, file_name, checksum):
+        with self.lock, self.db:
+            self.db.execute(
+                'UPDATE files SET checksum = ? WHERE vm = ? AND backup = ? AND name = ?',
+                (checksum, vm_name, backup_name, file_name)
+            )
+
+    def remove_backup(self, vm_name, backup_name):
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM files WHERE vm = ? AND backup = ?', (vm_name, backup_name))
+            self.db.execute('DELETE FROM backups WHERE vm = ? AND name = ?', (vm_name, backup_name))
+
+    @staticmethod
+    def _conditions(vm_name=None, since=None, until=None):
+        conditions = ' WHERE 1=1'
+        params = []
+        if vm_name:
+            conditions += ' AND vm = ?'
+            params.append(vm_name)
+        if since:
+            conditions += ' AND created >= ?'
+            params.append(since)
+        if until:
+            conditions += ' AND created < ?'
+            params.append(until)
+        return conditions, params
+
+    def totals(self, vm_name=None, since=None, until=None):
+        conditions, params = self._conditions(vm_name, since, until)
+        with self.lock:
+            count, logical_size, stored_size = self.db.execute(
+                'SELECT COUNT(*), COALESCE(SUM(logical_size), 0), COALESCE(SUM(stored_size), 0) FROM backups' +
+                conditions,
+                params
+            ).fetchone()
+        return {'count': count, 'logical_size': logical_size, 'stored_size': stored_size}
+
+    def list_backups(self, vm_name=None, since=None, until=None, page=1, per_page=None):
+        per_page = per_page or self.per_page
+        conditions, params = self._conditions(vm_name, since, until)
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT vm, name, host, path, created, retrieved, logical_size, stored_size, file_count FROM backups' +
+                conditions + ' ORDER BY created DESC LIMIT ? OFFSET ?',
+                params + [per_page, (max(1, page) - 1) * per_page]
+            ).fetchall()
+        keys = ('vm', 'name', 'host', 'path', 'created', 'retrieved', 'logical_size', 'stored_size', 'file_count')
+        return [dict(zip(keys, row)) for row in rows]
+
+    def list_all_backups(self, vm_name=None):
+        # Oldest first, without paging
+        conditions, params = self._conditions(vm_name)
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT vm, name, host, path, created, retrieved, logical_size, stored_size, file_count FROM backups' +
+                conditions + ' ORDER BY created',
+                params
+            ).fetchall()
+        keys = ('vm', 'name', 'host', 'path', 'created', 'retrieved', 'logical_size', 'stored_size', 'file_count')
+        return [dict(zip(keys, row)) for row in rows]
+
+    def list_files(self, vm_name, backup_name):
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT name, size, stored_size, checksum, mtime FROM files WHERE vm = ? AND backup = ? ORDER BY name',
+                (vm_name, backup_name)
+            ).fetchall()
+        return [dict(zip(('name', 'size', 'stored_size', 'checksum', 'mtime'), row)) for row in rows]
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+from datetime import datetime
+from shlex import quote
+from time import sleep
+from xml.dom import minidom
+import libvirt
+from paramiko import SSHException
+
+
+class CheckpointBackup:
+    checkpoint_prefix = 'sanitex-'
+    manifest_name = 'manifest.json'
+    # Incremental backups taken on top of a full one before the next full backup starts a new chain. Restores
+    # replay the whole chain and retention can only delete complete chains, so it must not grow forever.
+    max_chain_length = 6
+    checkpoint_xml_template = """<domaincheckpoint>
+      <name>{}</name>
+      <description>{}</description>
+      <disks>{}</disks>
+    </domaincheckpoint>"""
+    checkpoint_disk_xml_template = """<disk name='{}' checkpoint='bitmap'/>"""
+    backup_xml_template = """<domainbackup mode='push'>
+      {}
+      <disks>{}</disks>
+    </domainbackup>"""
+    backup_disk_xml_template = """<disk name='{}' backup='yes' type='file'>
+        <driver type='qcow2'/>
+        <target file='{}'/>
+      </disk>"""
+
+    def __init__(self, vm, ssh, remote_path, disks, sleep_time=5, max_chain_length=None):
+        self.vm = vm
+        self.ssh = ssh
+        self.remote_path = remote_path
+        # List of (target device, source image) tuples
+        self.disks = disks
+        self.sleep_time = sleep_time
+        if max_chain_length is not None:
+            self.max_chain_length = int(max_chain_length)
+
+    @staticmethod
+    def is_supported(vm):
+        # Checkpoints and backup jobs arrived with libvirt 6.0, older bindings do not have the calls at all
+        return all([hasattr(vm, name) for name in ('listAllCheckpoints', 'checkpointLookupByName', 'backupBegin')]) \
+            and hasattr(libvirt, 'VIR_DOMAIN_BACKUP_BEGIN_REUSE_EXTERNAL')
+
+    @staticmethod
+    def _disk_file_name(target):
+        return '{}.qcow2'.format(target)
+
+    def _remote_command(self, command):
+        stdin, stdout, ssh_stderr = self.ssh.exec_command(command)
+        stdin.flush()
+        exit_status = stdout.channel.recv_exit_status()
+        return exit_status, stdout.readlines(), ssh_stderr.readlines()
+
+    def _list_own_checkpoints(self):
+        checkpoints = []
+        for checkpoint in self.vm.listAllCheckpoints():
+            if not checkpoint.getName().startswith(self.checkpoint_prefix):
+                continue
+            xml = minidom.parseString(checkpoint.getXMLDesc())
+            description = xml.getElementsByTagName('description')
+            creation_time = xml.getElementsByTagName('creationTime')
+            checkpoints.append({
+                'checkpoint': checkpoint,
+                'name': checkpoint.getName(),
+                'backup_dir': description[0].firstChild.nodeValue if description and description[0].firstChild
+                else None,
+                'created': int(creation_time[0].firstChild.nodeValue) if creation_time else 0,
+            })
+        return sorted(checkpoints, key=lambda item: item['created'])
+
+    def _find_parent(self, checkpoints):
+        if not checkpoints:
+            logging.warning('No previous checkpoint found for VM "{}", taking a full backup'.format(self.vm.name()))
+            return None
+        parent = checkpoints[-1]
+        if not parent['backup_dir']:
+            logging.warning('Checkpoint {} has no backup attached, taking a full backup'.format(parent['name']))
+            return None
+        for target, source in self.disks:
+            exit_status, out, err = self._remote_command('test -f {}'.format(quote('{}/{}/{}'.format(
+                self.remote_path,
+                parent['backup_dir'],
+                self._disk_file_name(target)
+            ))))
+            if exit_status != 0:
+                logging.warning('Previous backup {} is missing disk {}, taking a full backup'.format(
+                    parent['backup_dir'],
+                    target
+                ))
+                return None
+        parent['chain_length'] = self._chain_length(parent['backup_dir'])
+        if parent['chain_length'] is None:
+            logging.warning('Chain length of {} unknown, taking a full backup'.format(parent['backup_dir']))
+            return None
+        if self.max_chain_length and parent['chain_length'] >= self.max_chain_length:
+            logging.warning('{} incremental backups since the last full one, taking a full backup'.format(
+                parent['chain_length']
+            ))
+            return None
+        return parent
+
+    def _chain_length(self, backup_dir):
+        # Incremental backups between backup_dir and its full backup, None when its manifest can not tell
+        ftp = self.ssh.open_sftp()
+        try:
+            with ftp.open(self.remote_path + '/' + backup_dir + '/' + self.manifest_name, 'r') as manifest_fp:
+                return json.loads(manifest_fp.read().decode()).get('chain_length')
+        except (IOError, ValueError):
+            return None
+        finally:
+            ftp.close()
+
+    def _prepare_incremental_targets(self, backup_dir, parent):
+        for target, source in self.disks:
+            # Relative backing file so the chain survives being retrieved to a different root
+            exit_status, out, err = self._remote_command(
+                'qemu-img create -q -f qcow2 -F qcow2 -b {} {}'.format(
+                    quote('../{}/{}'.format(parent['backup_dir'], self._disk_file_name(target))),
+                    quote('{}/{}/{}'.format(self.remote_path, backup_dir, self._disk_file_name(target)))
+                )
+            )
+            if exit_status != 0:
+                logging.critical('Could not create incremental target for {}: {}'.format(target, ''.join(err)))
+                return False
+        return True
+
+    def _wait_for_backup_job(self):
+        while self.vm.jobInfo()[0] != libvirt.VIR_DOMAIN_JOB_NONE:
+            sleep(self.sleep_time)
+        stats = self.vm.jobStats(libvirt.VIR_DOMAIN_JOB_STATS_COMPLETED)
+        return stats.get('type') == libvirt.VIR_DOMAIN_JOB_COMPLETED
+
+    def _delete_checkpoints(self, checkpoints):
+        for item in checkpoints:
+            try:
+                # Deleting merges its bitmap into the remaining ones, keeping a single bitmap per disk alive
+                item['checkpoint'].delete()
+            except libvirt.libvirtError as e:
+                logging.warning('Could not delete old checkpoint {}: {}'.format(item['name'], e))
+
+    def _write_manifest(self, backup_dir, manifest):
+        ftp = self.ssh.open_sftp()
+        ftp.chdir(self.remote_path + '/' + backup_dir)
+        with ftp.open(self.manifest_name, 'w') as manifest_fp:
+            manifest_fp.write(json.dumps(manifest, indent=2))
+        ftp.close()
+
+    def run(self, backup_dir):
+        out = []
+        try:
+            checkpoints = self._list_own_checkpoints()
+        except libvirt.libvirtError as e:
+            logging.critical('Could not list checkpoints: {}'.format(e))
+            return False
+        parent = self._find_parent(checkpoints)
+        checkpoint_name = self.checkpoint_prefix + backup_dir
+        flags = 0
+        if parent is None:
+            incremental_xml = ''
+        else:
+            if not self._prepare_incremental_targets(backup_dir, parent):
+                return False
+            incremental_xml = '<incremental>{}</incremental>'.format(parent['name'])
+            flags = libvirt.VIR_DOMAIN_BACKUP_BEGIN_REUSE_EXTERNAL
+        backup_xml = self.backup_xml_template.format(
+            incremental_xml,
+            ''.join([
+                self.backup_disk_xml_template.format(
+                    target,
+                    '{}/{}/{}'.format(self.remote_path, backup_dir, self._disk_file_name(target))
+                ) for target, source in self.disks
+            ])
+        )
+        checkpoint_xml = self.checkpoint_xml_template.format(
+            checkpoint_name,
+            backup_dir,
+            ''.join([self.checkpoint_disk_xml_template.format(target) for target, source in self.disks])
+        )
+        try:
+            self.vm.backupBegin(backup_xml, checkpoint_xml, flags)
+            logging.warning('{} backup job started for VM "{}" with checkpoint {}'.format(
+                'Full' if parent is None else 'Incremental',
+                self.vm.name(),
+                checkpoint_name
+            ))
+            if not self._wait_for_backup_job():
+                logging.critical('Backup job for VM "{}" failed'.format(self.vm.name()))
+                self._delete_checkpoints([{
+                    'checkpoint': self.vm.checkpointLookupByName(checkpoint_name),
+                    'name': checkpoint_name
+                }])
+                return False
+        except libvirt.libvirtError as e:
+            logging.critical('Libvirt backup error: {}'.format(e))
+            return False
+        manifest = {
+            'format': 1,
+            'mode': 'full' if parent is None else 'incremental',
+            'created': datetime.today().strftime('%Y-%m-%d %H:%M:%S'),
+            'checkpoint': checkpoint_name,
+            'parent_checkpoint': None if parent is None else parent['name'],
+            'parent_backup': None if parent is None else parent['backup_dir'],
+            'chain_length': 0 if parent is None else parent['chain_length'] + 1,
+            'disks': [
+                {
+                    'target': target,
+                    'source': source,
+                    'file': self._disk_file_name(target),
+                    'backing': None if parent is None else '../{}/{}'.format(
+                        parent['backup_dir'],
+                        self._disk_file_name(target)
+                    ),
+                } for target, source in self.disks
+            ],
+        }
+        try:
+            self._write_manifest(backup_dir, manifest)
+        except SSHException as e:
+            logging.critical('SSH error writing manifest: {}'.format(e))
+            return False
+        self._delete_checkpoints(checkpoints)
+        for disk in manifest['disks']:
+            out.append(['{} -> {}/{}/{} ({})\n'.format(
+                disk['source'],
+                self.remote_path,
+                backup_dir,
+                disk['file'],
+                manifest['mode']
+            )])
+        return out
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+# Images are hashed per block so the download engine can check blocks as they arrive, in any order, and a block
+# that fails can be fetched again alone. The file checksum is the hash of its block digests.
+import errno
+import hashlib
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+algorithm = 'sha256'
+manifest_name = 'checksums.json'
+read_size = 1024 * 1024
+
+
+class ChecksumError(OSError):
+    pass
+
+
+def new_hash():
+    return hashlib.new(algorithm)
+
+
+def update_zeros(digest, length):
+    zeros = bytes(min(length, read_size))
+    for offset in range(0, length, read_size):
+        digest.update(zeros[:min(read_size, length - offset)])
+
+
+@lru_cache(maxsize=8)
+def zero_digest(length):
+    digest = new_hash()
+    update_zeros(digest, length)
+    return digest.hexdigest()
+
+
+def file_digest(block_digests):
+    digest = new_hash()
+    for block_digest in block_digests:
+        digest.update(bytes.fromhex(block_digest))
+    return digest.hexdigest()
+
+
+class BlockHasher:
+    # Fed with the file from start to end, zeros() stands for holes that are never read
+    def __init__(self, block_size):
+        self.block_size = block_size
+        self.blocks = []
+        self.size = 0
+        self.current = new_hash()
+        self.filled = 0
+
+    def _advance(self, length):
+        self.filled += length
+        self.size += length
+        if self.filled == self.block_size:
+            self.blocks.append(self.current.hexdigest())
+            self.current = new_hash()
+            self.filled = 0
+
+    def update(self, data):
+        view = memoryview(data)
+        while len(view):
+            take = min(len(view), self.block_size - self.filled)
+            self.current.update(view[:take])
+            self._advance(take)
+            view = view[take:]
+
+    def zeros(self, length):
+        while length:
+            take = min(length, self.block_size - self.filled)
+            if self.filled == 0 and take == self.block_size:
+                self.blocks.append(zero_digest(self.block_size))
+                self.size += take
+            else:
+                self.update(bytes(min(take, read_size)))
+                take = min(take, read_size)
+            length -= take
+
+    def finish(self):
+        if self.filled:
+            self.blocks.append(self.current.hexdigest())
+            self.current = new_hash()
+            self.filled = 0
+        return self.blocks
+
+
+def _is_hole(fd, offset, end):
+    try:
+        return os.lseek(fd, offset, os.SEEK_DATA) >= end
+    except OSError as e:
+        # ENXIO: only holes after offset. Filesystems without SEEK_DATA say EINVAL, read everything there.
+        return e.errno == errno.ENXIO
+
+
+def local_block_digests(file_path, block_size):
+    hasher = BlockHasher(block_size)
+    fd = os.open(file_path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        for block_offset in range(0, size, block_size):
+            block_end = min(block_offset + block_size, size)
+            if _is_hole(fd, block_offset, block_end):
+                hasher.zeros(block_end - block_offset)
+                continue
+            for offset in range(block_offset, block_end, read_size):
+                hasher.update(os.pread(fd, min(read_size, block_end - offset), offset))
+    finally:
+        os.close(fd)
+    return hasher.finish()
+
+
+def stream_block_digests(chunks, block_size):
+    hasher = BlockHasher(block_size)
+    for chunk in chunks:
+        if chunk.count(0) == len(chunk):
+            hasher.zeros(len(chunk))
+        else:
+            hasher.update(chunk)
+    return hasher.finish()
+
+
+def load_manifest(manifest_path):
+    with open(manifest_path, 'r') as manifest_fp:
+        return json.load(manifest_fp)
+
+
+def build_manifest(block_size, files):
+    # files: {name: {'size': bytes, 'blocks': [hex digests]}}
+    for entry in files.values():
+        entry['digest'] = file_digest(entry['blocks'])
+    return {'algorithm': algorithm, 'block_size': block_size, 'files': files}
+
+
+def mismatched_blocks(entry, size, block_digests):
+    if size != entry['size']:
+        return list(range(max(len(block_digests), len(entry['blocks']))))
+    return [
+        index for index, expected in enumerate(entry['blocks'])
+        if index >= len(block_digests) or block_digests[index] != expected
+    ]
+
+
+def verify_files(files, compute, workers=4):
+    """
+    files: {name: manifest entry}, compute(name) returns (size, block digests) or None when the file is missing.
+    Returns {name: (ok, message)}, files are hashed in parallel, hashlib releases the GIL on large buffers.
+    """
+    def verify(name):
+        try:
+            computed = compute(name)
+        except OSError as e:
+            logging.warning('Could not verify {}: {}'.format(name, e))
+            return name, (False, 'unreadable: {}'.format(e))
+        if computed is None:
+            return name, (False, 'missing')
+        size, block_digests = computed
+        bad = mismatched_blocks(files[name], size, block_digests)
+        if bad:
+            return name, (False, '{} of {} blocks differ'.format(len(bad), len(files[name]['blocks'])))
+        return name, (True, 'ok')
+
+    with ThreadPoolExecutor(max_workers=max(1, int(workers))) as executor:
+        return dict(executor.map(verify, sorted(files)))
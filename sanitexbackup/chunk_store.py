@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import zlib
+from threading import Condition, Lock, get_ident
+
+
+class ChunkStore:
+    root = '/app/backups/.chunks'
+    manifest_suffix = '.chunks'
+    min_size = 256 * 1024
+    max_size = 4 * 1024 * 1024
+    # Boundaries are only considered right after this marker, which is located with bytes.find instead of
+    # running a rolling hash over every byte in Python. Roughly one candidate every 64 KiB on random data.
+    anchor = b'\x5a\xa5'
+    window_size = 48
+    # One candidate out of 16 becomes a boundary, giving ~1 MiB average chunks
+    cut_mask = 0xf
+    index_name = 'index.sqlite'
+    db = None
+    # Ingests run side by side, collect_garbage() waits for them and keeps new ones out while it sweeps: chunks of
+    # an ingest in progress are not referenced by any manifest yet
+    sweep_condition = Condition()
+    ingesting = 0
+    sweeping = False
+
+    def __init__(self, root=None):
+        if root is not None:
+            self.root = root
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root, 0o700, exist_ok=True)
+        # Every instance has its own connection, SQLite serializes the writers of concurrent ingests
+        self.lock = Lock()
+        self.db = sqlite3.connect(os.path.join(self.root, self.index_name), timeout=60, check_same_thread=False)
+        with self.db:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS chunks (digest TEXT PRIMARY KEY, size INTEGER NOT NULL)')
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    @classmethod
+    def manifest_for(cls, file_path):
+        return file_path + cls.manifest_suffix
+
+    @classmethod
+    def is_manifest(cls, file_path):
+        return file_path.endswith(cls.manifest_suffix)
+
+    def _chunk_path(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def _find_cut(self, buffer):
+        limit = min(len(buffer), self.max_size)
+        if limit <= self.min_size:
+            return limit
+        position = buffer.find(self.anchor, self.min_size, limit)
+        while position != -1:
+            cut = position + len(self.anchor)
+            if zlib.crc32(buffer[cut - self.window_size:cut]) & self.cut_mask == 0:
+                return cut
+            position = buffer.find(self.anchor, position + 1, limit)
+        return limit
+
+    def _chunks(self, fp):
+        buffer = b''
+        while True:
+            data = fp.read(self.max_size)
+            buffer += data
+            while len(buffer) >= self.max_size or (not data and buffer):
+                cut = self._find_cut(buffer)
+                yield buffer[:cut]
+                buffer = buffer[cut:]
+            if not data:
+                return
+
+    def has_chunk(self, digest):
+        with self.lock:
+            return self.db.execute('SELECT 1 FROM chunks WHERE digest = ?', (digest,)).fetchone() is not None
+
+    def _store_chunk(self, digest, chunk):
+        chunk_path = self._chunk_path(digest)
+        os.makedirs(os.path.dirname(chunk_path), 0o700, exist_ok=True)
+        # Two ingests may store the same new chunk at once, each one writes its own temporary file
+        temporary_path = '{}.{}-{}.tmp'.format(chunk_path, os.getpid(), get_ident())
+        with open(temporary_path, 'wb') as chunk_fp:
+            chunk_fp.write(chunk)
+        os.replace(temporary_path, chunk_path)
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO chunks (digest, size) VALUES (?, ?)', (digest, len(chunk)))
+
+    def ingest(self, file_path, remove=True):
+        chunks = []
+        logical_size = 0
+        stored_size = 0
+        manifest_path = self.manifest_for(file_path)
+        with ChunkStore.sweep_condition:
+            ChunkStore.sweep_condition.wait_for(lambda: not ChunkStore.sweeping)
+            ChunkStore.ingesting += 1
+        try:
+            with open(file_path, 'rb') as file_fp:
+                for chunk in self._chunks(file_fp):
+                    digest = hashlib.blake2b(chunk, digest_size=32).hexdigest()
+                    if not self.has_chunk(digest):
+                        self._store_chunk(digest, chunk)
+                        stored_size += len(chunk)
+                    chunks.append([digest, len(chunk)])
+                    logical_size += len(chunk)
+            with open(manifest_path + '.tmp', 'w') as manifest_fp:
+                json.dump({'file': os.path.basename(file_path), 'size': logical_size, 'chunks': chunks}, manifest_fp)
+            os.replace(manifest_path + '.tmp', manifest_path)
+        finally:
+            with ChunkStore.sweep_condition:
+                ChunkStore.ingesting -= 1
+                ChunkStore.sweep_condition.notify_all()
+        if remove:
+            os.remove(file_path)
+        logging.warning('Deduplicated {}: {} bytes, {} new bytes stored'.format(file_path, logical_size, stored_size))
+        return logical_size, stored_size
+
+    @staticmethod
+    def load_manifest(manifest_path):
+        with open(manifest_path, 'r') as manifest_fp:
+            return json.load(manifest_fp)
+
+    def chunk_layout(self, manifest_path):
+        # (offset in the original file, size, chunk file) of every chunk, chunks can be read in any order
+        layout = []
+        offset = 0
+        for digest, size in self.load_manifest(manifest_path)['chunks']:
+            layout.append((offset, size, self._chunk_path(digest)))
+            offset += size
+        return layout
+
+    def collect_garbage(self, backups_root):
+        """
+        Removes the chunks no manifest below backups_root refers to any more, returns (chunks removed, bytes freed).
+        A manifest that can not be read stops the sweep before anything is removed.
+        """
+        with ChunkStore.sweep_condition:
+            ChunkStore.sweep_condition.wait_for(lambda: not ChunkStore.sweeping and not ChunkStore.ingesting)
+            ChunkStore.sweeping = True
+        try:
+            referenced = set()
+            for directory, dirs, names in os.walk(backups_root):
+                dirs[:] = [name for name in dirs if os.path.join(directory, name) != self.root]
+                for name in names:
+                    if self.is_manifest(name):
+                        for digest, size in self.load_manifest(os.path.join(directory, name))['chunks']:
+                            referenced.add(digest)
+            with self.lock:
+                unreferenced = [
+                    (digest, size) for digest, size in self.db.execute('SELECT digest, size FROM chunks')
+                    if digest not in referenced
+                ]
+            for digest, size in unreferenced:
+                try:
+                    os.remove(self._chunk_path(digest))
+                except FileNotFoundError:
+                    pass
+            with self.lock, self.db:
+                self.db.executemany('DELETE FROM chunks WHERE digest = ?', [(digest,) for digest, size in unreferenced])
+            removed = len(unreferenced)
+            freed = sum([size for digest, size in unreferenced])
+        finally:
+            with ChunkStore.sweep_condition:
+                ChunkStore.sweeping = False
+                ChunkStore.sweep_condition.notify_all()
+        logging.warning('Chunk store: {} unreferenced chunks removed, {} bytes freed'.format(removed, freed))
+        return removed, freed
+
+    def read_chunks(self, manifest_path):
+        # The original file, chunk after chunk
+        for digest, size in self.load_manifest(manifest_path)['chunks']:
+            with open(self._chunk_path(digest), 'rb') as chunk_fp:
+                yield chunk_fp.read()
+
+    def restore(self, manifest_path, destination):
+        with open(destination, 'wb') as destination_fp:
+            for chunk in self.read_chunks(manifest_path):
+                size = len(chunk)
+                if chunk.count(0) == size:
+                    # Leave a hole instead of writing zeros
+                    destination_fp.seek(size, os.SEEK_CUR)
+                else:
+                    destination_fp.write(chunk)
+            destination_fp.truncate()
+        return destination
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from os import path
+from shlex import quote
+
+zstd_suffix = '.zst'
+
+
+def compressed_name(file_name):
+    return path.basename(file_name) + zstd_suffix
+
+
+def is_compressed(file_name):
+    return file_name.endswith(zstd_suffix)
+
+
+def build_compress_argv(level, threads=0):
+    # Compresses standard input to standard output unless files are appended
+    argv = ['zstd', '-q']
+    if int(level) > 19:
+        argv.append('--ultra')
+    return argv + ['-T{}'.format(int(threads)), '-{}'.format(int(level)), '-c']
+
+
+def build_compress_command(source, destination, level, threads=0):
+    return '{} {} > {} && echo {}'.format(
+        ' '.join(build_compress_argv(level, threads)),
+        quote(source),
+        quote(destination),
+        quote('{} -> {}'.format(source, destination))
+    )
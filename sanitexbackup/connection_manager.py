@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+import logging
+from contextlib import contextmanager
+from os import path
+from threading import BoundedSemaphore, Lock, RLock
+from time import time
+import libvirt
+from paramiko import SSHClient, SSHException, AutoAddPolicy
+from .lifecycle import LifecycleWatcher
+from .throttle import TokenBucket
+
+
+class ConnectionManager:
+    managers = dict()
+    managers_lock = Lock()
+    keepalive_interval = 30
+    keepalive_count = 3
+    sftp_pool_size = 8
+
+    @classmethod
+    def for_connection(cls, connection):
+        key = (
+            connection.get('user'),
+            connection.get('host'),
+            connection.get('port', 22),
+            connection.get('keyfile'),
+            connection.get('libvirt_uri')
+        )
+        with cls.managers_lock:
+            if key not in cls.managers:
+                cls.managers[key] = cls(connection)
+            elif connection.get('max_host_copies') != cls.managers[key].connection.get('max_host_copies'):
+                # The copy slots are created once per host, a VM can not have a limit of its own
+                logging.warning('max_host_copies of {} differs between VMs of the host, using {}'.format(
+                    connection.get('host'), cls.managers[key].connection.get('max_host_copies')
+                ))
+            return cls.managers[key]
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.lock = RLock()
+        self.ssh = None
+        self.libvirt_connection = None
+        self.idle_sftp = []
+        self.cache = dict()
+        # Staging copies of every VM of this host share the storage pool, so they share the limit too
+        copy_limit = connection.get('max_host_copies')
+        self.copy_slots = BoundedSemaphore(int(copy_limit)) if copy_limit else None
+        # Every download from this host draws from the same bucket, at the rate configured for the job drawing
+        self.download_bucket = TokenBucket()
+        # Same for restores going the other way
+        self.upload_bucket = TokenBucket()
+
+    def _libvirt_uri(self):
+        if 'libvirt_uri' in self.connection:
+            return self.connection['libvirt_uri']
+        return 'qemu+ssh://{}@{}/system'.format(self.connection['user'], self.connection['host'])
+
+    def _connect_ssh(self):
+        ssh = SSHClient()
+        ssh.set_missing_host_key_policy(AutoAddPolicy())
+        known_hosts = path.join(path.expanduser('~'), '.ssh', 'known_hosts')
+        if path.isfile(known_hosts):
+            ssh.load_host_keys(filename=known_hosts)
+        try:
+            ssh.connect(
+                hostname=self.connection['host'],
+                username=self.connection['user'],
+                port=self.connection.get('port', 22),
+                key_filename=self.connection['keyfile']
+            )
+        except SSHException:
+            ssh.close()
+            raise
+        ssh.get_transport().set_keepalive(self.keepalive_interval)
+        logging.info('SSH connection to {} established'.format(self.connection['host']))
+        return ssh
+
+    def get_ssh(self):
+        with self.lock:
+            transport = self.ssh.get_transport() if self.ssh is not None else None
+            if transport is None or not transport.is_active():
+                if self.ssh is not None:
+                    logging.warning('SSH connection to {} lost, reconnecting'.format(self.connection['host']))
+                    self.ssh.close()
+                self.idle_sftp = []
+                self.ssh = self._connect_ssh()
+            return self.ssh
+
+    def get_transport(self):
+        return self.get_ssh().get_transport()
+
+    def exec_command(self, command):
+        return self.get_ssh().exec_command(command)
+
+    def acquire_sftp(self):
+        with self.lock:
+            transport = self.get_transport()
+            while self.idle_sftp:
+                sftp = self.idle_sftp.pop()
+                if sftp.get_channel().get_transport() is transport and not sftp.get_channel().closed:
+                    return sftp
+            return self.get_ssh().open_sftp()
+
+    def release_sftp(self, sftp):
+        with self.lock:
+            channel = sftp.get_channel()
+            if len(self.idle_sftp) < self.sftp_pool_size and not channel.closed and \
+                    self.ssh is not None and channel.get_transport() is self.ssh.get_transport():
+                self.idle_sftp.append(sftp)
+            else:
+                sftp.close()
+
+    @contextmanager
+    def sftp(self):
+        sftp = self.acquire_sftp()
+        try:
+            yield sftp
+        finally:
+            self.release_sftp(sftp)
+
+    @contextmanager
+    def copy_slot(self):
+        if self.copy_slots is None:
+            yield
+            return
+        with self.copy_slots:
+            yield
+
+    def cache_get(self, key, ttl):
+        # Remote state cached per host, keys are tuples starting with the kind of data
+        with self.lock:
+            if key in self.cache:
+                stored, value = self.cache[key]
+                if time() - stored < ttl:
+                    return value
+                del self.cache[key]
+            return None
+
+    def cache_put(self, key, value):
+        with self.lock:
+            self.cache[key] = (time(), value)
+
+    def invalidate(self, kind):
+        with self.lock:
+            for key in [key for key in self.cache if key[0] == kind]:
+                del self.cache[key]
+
+    def get_libvirt(self):
+        with self.lock:
+            if self.libvirt_connection is not None:
+                try:
+                    if self.libvirt_connection.isAlive():
+                        return self.libvirt_connection
+                except libvirt.libvirtError:
+                    pass
+                logging.warning('Libvirt connection to {} lost, reconnecting'.format(self.connection['host']))
+                try:
+                    self.libvirt_connection.close()
+                except libvirt.libvirtError:
+                    pass
+                self.libvirt_connection = None
+            LifecycleWatcher.start_event_loop()
+            self.libvirt_connection = libvirt.open(self._libvirt_uri())
+            try:
+                self.libvirt_connection.setKeepAlive(self.keepalive_interval, self.keepalive_count)
+            except libvirt.libvirtError as e:
+                logging.debug('Libvirt keepalive not available: {}'.format(e))
+            return self.libvirt_connection
+
+    def close(self):
+        with self.lock:
+            for sftp in self.idle_sftp:
+                sftp.close()
+            self.idle_sftp = []
+            if self.ssh is not None:
+                self.ssh.close()
+                self.ssh = None
+            if self.libvirt_connection is not None:
+                try:
+                    self.libvirt_connection.close()
+                except libvirt.libvirtError:
+                    pass
+                self.libvirt_connection = None
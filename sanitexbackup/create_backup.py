@@ -1,34 +1,71 @@
 # -*- coding: utf-8 -*-
 import logging
-from os import path, mkdir, walk, sep
-from paramiko import SSHClient, SSHException, AutoAddPolicy
-from time import sleep
+import re
+from os import path, mkdir, listdir, remove, rmdir, stat
+from paramiko import SSHException
 from xml.dom import minidom
+from xml.parsers.expat import ExpatError
+import json
 import libvirt
+import sqlite3
+from shlex import quote
+from shutil import rmtree
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from time import time
+from .checkpoint_backup import CheckpointBackup
+from .live_snapshot import LiveSnapshot
+from .transfer import DownloadEngine, copy_sparse
+from . import compression
+from .chunk_store import ChunkStore
+from .connection_manager import ConnectionManager
+from .lifecycle import LifecycleWatcher
+from .progress import TransferProgress
+from .history import JobHistory, Trace
+from .catalog import BackupCatalog
+from . import remote_helpers
+from . import checksums
+from . import retention
+from .throttle import scheduled_rate
+from .staging import CopyStrategy, select_strategy
+from .restore import RestoreBackup, RestoreError
+from .snapshots import SnapshotManager
+
+# ionice arguments for staging_io_class, children of the shell inherit the class
+io_priorities = {
+    'idle': 'ionice -c3',
+    'best-effort': 'ionice -c2 -n7',
+}
 
 
 class CreateBackup:
     connection = dict()
     remote_path = None
+    local_path = '/app/backups'
     libvirt_connection = None
+    connection_manager = None
+    # Seconds between remote stat calls of a file being staged
+    staging_poll_interval = 5
+    remote_listing_ttl = 300
     snapshot_xml_template = """<domainsnapshot>
       <name>{}</name>
     </domainsnapshot>"""
 
     def __init__(self, connection):
         self.connection = connection
-        if 'temporary_backup_path' in connection:
+        if 'temporarily_remote_backup_path' in connection:
             self.remote_path = connection['temporarily_remote_backup_path']
         else:
             self.remote_path = '/var/backups'
+        if 'local_backups_path' in connection:
+            self.local_path = connection['local_backups_path']
+        # Shared by every CreateBackup of the same host, connections are kept open between operations
+        self.connection_manager = ConnectionManager.for_connection(connection)
         self.__connect_libvirt()
 
     def __connect_libvirt(self):
         try:
-            self.libvirt_connection = libvirt.open(
-                'qemu+ssh://{}@{}/system'.format(self.connection['user'], self.connection['host'])
-            )
+            self.libvirt_connection = self.connection_manager.get_libvirt()
         except libvirt.libvirtError as e:
             logging.critical('Error connecting to Libvirt: {}'.format(e))
         if self.libvirt_connection is None:
@@ -51,19 +88,34 @@ class CreateBackup:
                     for attr in diskNode.attributes.keys():
                         print('    ' + diskNode.attributes[attr].name + ' = ' +
                               diskNode.attributes[attr].value)
-                        if diskType.getAttribute('device') == "disk" and diskNode.attributes[attr].name == "file" and \
+                        # Images are files, or block devices such as logical volumes
+                        if diskType.getAttribute('device') == "disk" and diskNode.nodeName == 'source' and \
+                                diskNode.attributes[attr].name in ("file", "dev") and \
                                 diskNode.attributes[attr].value is not None:
                             images_to_save.append(diskNode.attributes[attr].value)
         return images_to_save
 
+    @staticmethod
+    def _get_vm_disk_targets(vm):
+        xml = minidom.parseString(vm.XMLDesc(0))
+        disks = []
+        for disk in xml.getElementsByTagName('disk'):
+            if disk.getAttribute('device') != 'disk':
+                continue
+            sources = disk.getElementsByTagName('source')
+            targets = disk.getElementsByTagName('target')
+            if not sources or not targets or not sources[0].getAttribute('file'):
+                continue
+            disks.append((targets[0].getAttribute('dev'), sources[0].getAttribute('file')))
+        return disks
+
     def find_virtual_machine(self):
         if 'vm_name' not in self.connection:
             logging.critical('No virtual machine name was provided')
             return None
         else:
             try:
-                if not self._is_libvirt_connected():
-                    self.__connect_libvirt()
+                self.__connect_libvirt()
             except SSHException as e:
                 logging.critical("SSH Error: {}".format(e))
                 return None
@@ -73,31 +125,25 @@ class CreateBackup:
                 logging.warning('Error looking for VM "{}": {}'.format(self.connection['vm_name'], e))
                 return None
 
-    @staticmethod
-    def _activate_vm(vm):
+    def _activate_vm(self, vm):
         if vm.isActive() != 1:
             resume_status = vm.create()
             if resume_status is None or resume_status is False:
                 return False
+            return LifecycleWatcher(self.libvirt_connection).wait_until_running(
+                vm,
+                self.connection.get('startup_timeout', 60)
+            )
         return True
 
-    @staticmethod
-    def _deactivate_vm(vm, sleep_time=5, retry_limit=10):
-        if retry_limit < 2:
-            return False
+    def _deactivate_vm(self, vm):
         if vm.isActive() == 1:
-            deactivation_status = vm.shutdown()
-            if deactivation_status:
-                logging.warning(deactivation_status)
-            sleep(sleep_time)
-            for i in range(1, retry_limit):
-                if vm.isActive() == 1:
-                    logging.warning('VM is still active... [Try {}/{}] [{}s delay]'.format(i, retry_limit, sleep_time))
-                    sleep(sleep_time)
-                else:
-                    break
-            if vm.isActive() != 0:
-                logging.critical('Machine did not stop in time... you may wanna increase delay or waiting time...')
+            if not LifecycleWatcher(self.libvirt_connection).shutdown(
+                    vm,
+                    self.connection.get('shutdown_timeout', 120),
+                    self.connection.get('shutdown_escalation', ['acpi'])):
+                logging.critical('Machine did not stop in time... you may wanna increase shutdown_timeout or '
+                                 'add more shutdown_escalation steps...')
                 return False
         return True
 
@@ -106,178 +152,1142 @@ class CreateBackup:
             return False
         return True
 
-    def create_backup(self):
-        current_backup_dir = None
+    def _staging_rate(self, copies=None):
+        # staging_rate is shared by the copies of one backup running at the same time
+        rate = scheduled_rate(self.connection, 'staging_rate')
+        if not rate:
+            return 0
+        return max(1, rate // max(1, copies or int(self.connection.get('copy_concurrency', 2))))
+
+    def _checksum_block_size(self):
+        # Digests line up with the blocks the download engine fetches, so it can check them on arrival
+        return DownloadEngine.block_size if self.connection.get('checksums', False) else 0
+
+    def _build_stage_command(self, image_to_save, destination, source=None, copies=None):
+        # source: where the data is read from when it is not the image itself (a copy-on-write clone)
+        source = source or image_to_save
+        staged_file = destination + '/' + self._staged_file_name(image_to_save)
+        level = self.connection.get('compression_level')
+        rate = self._staging_rate(copies)
+        block_size = self._checksum_block_size()
+        if rate or block_size:
+            # Paced and hashing copies go through a reader on the hypervisor, zstd works as a filter
+            command = remote_helpers.build_command(
+                remote_helpers.stage_copy,
+                source,
+                staged_file,
+                rate,
+                block_size,
+                *(compression.build_compress_argv(level, self.connection.get('compression_threads', 0))
+                  if level else [])
+            )
+        elif level:
+            command = compression.build_compress_command(
+                source,
+                staged_file,
+                level,
+                self.connection.get('compression_threads', 0)
+            )
+        else:
+            # Holes of thin provisioned images stay holes in the staging copy
+            command = 'cp -v --sparse=always {} {}'.format(quote(source), quote(staged_file))
+        io_class = self.connection.get('staging_io_class')
+        if io_class in io_priorities:
+            command = '{} sh -c {}'.format(io_priorities[io_class], quote(command))
+        return command
+
+    def _staged_file_name(self, image_to_save):
+        if self.connection.get('compression_level'):
+            return compression.compressed_name(image_to_save)
+        return path.basename(image_to_save)
+
+    def _copy_image(self, ssh, image_to_save, destination, trace, progress_reporters=None, source=None, copies=None):
+        # Waiting for a free copy slot of the host is not part of the copy itself
+        with self.connection_manager.copy_slot():
+            return self._run_copy(ssh, image_to_save, destination, trace, progress_reporters, source, copies)
+
+    def _run_copy(self, ssh, image_to_save, destination, trace, progress_reporters=None, source=None, copies=None):
+        started = time()
+        staged_file = destination + '/' + self._staged_file_name(image_to_save)
+        try:
+            with self.connection_manager.sftp() as ftp:
+                source_size = ftp.stat(source or image_to_save).st_size
+        except (OSError, SSHException) as e:
+            logging.critical('Copy of {} failed: {}'.format(image_to_save, e))
+            return image_to_save, 1, [], None
+        # Compressed output does not grow like the source, so there is no meaningful total. Block devices have no
+        # size over SFTP either.
+        progress = TransferProgress(
+            'Staging ' + path.basename(image_to_save),
+            None if self.connection.get('compression_level') else source_size or None,
+            progress_reporters
+        )
+        stdin, stdout, ssh_stderr = ssh.exec_command(
+            self._build_stage_command(image_to_save, destination, source, copies)
+        )
+        stdin.flush()
+        output = b''
+        # Wakes up as soon as the copy exits, and every staging_poll_interval seconds before that
+        while not stdout.channel.status_event.wait(self.staging_poll_interval):
+            # Block digests of big images do not fit the channel window, keep it drained
+            while stdout.channel.recv_ready():
+                output += stdout.channel.recv(65536)
+            try:
+                with self.connection_manager.sftp() as ftp:
+                    progress.set(ftp.stat(staged_file).st_size)
+            except FileNotFoundError:
+                pass
+        progress.finish()
+        lines = (output + stdout.read()).decode(errors='replace').splitlines(True)
+        exit_status = stdout.channel.recv_exit_status()
+        trace.add_span('copy', started, time() - started, source_size, path.basename(image_to_save))
+        if exit_status != 0:
+            logging.critical('Copy of {} failed [exit {}]: {}'.format(
+                image_to_save,
+                exit_status,
+                ''.join(ssh_stderr.readlines())
+            ))
+        # The hashing copy ends with a JSON line holding the block digests
+        digests = None
+        if lines and lines[-1].startswith('{'):
+            digests = json.loads(lines.pop())
+        return image_to_save, exit_status, lines, digests
+
+    def _stage_images(self, ssh, images_to_save, backup_dir, trace, progress_reporters=None, sources=None):
+        # Each copy runs on its own channel of the same SSH transport
+        concurrency = max(1, int(self.connection.get('copy_concurrency', 2)))
+        destination = '{}/{}'.format(self.remote_path, backup_dir)
+        sources = sources or dict()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = [
+                executor.submit(
+                    self._copy_image,
+                    ssh,
+                    image_to_save,
+                    destination,
+                    trace,
+                    progress_reporters,
+                    sources.get(image_to_save),
+                    # A single disk gets the whole staging rate
+                    min(concurrency, len(images_to_save))
+                ) for image_to_save in images_to_save
+            ]
+            return [future.result() for future in futures]
+
+    def _stream_images(self, images_to_save, local_backup_path, trace, progress_reporters=None, sources=None):
+        # Direct mode: images go from the hypervisor straight into the local store, no staging copy
+        sources = sources or dict()
+        out = []
+        failed = []
+        engine = DownloadEngine(
+            self.connection_manager,
+            channels=self.connection.get('download_channels'),
+            progress_reporters=progress_reporters,
+            record_digests=bool(self._checksum_block_size()),
+            connection=self.connection
+        )
+        try:
+            for image_to_save in images_to_save:
+                local_file = path.join(local_backup_path, path.basename(image_to_save))
+                started = time()
+                try:
+                    transferred, elapsed = engine.download(sources.get(image_to_save, image_to_save), local_file)
+                except OSError as e:
+                    logging.critical('Streaming of {} failed: {}'.format(image_to_save, e))
+                    failed.append(image_to_save)
+                    continue
+                trace.add_span('stream', started, time() - started, transferred, path.basename(image_to_save))
+                out.append('{}: {}\n'.format(path.basename(image_to_save), engine.format_rate(transferred, elapsed)))
+        finally:
+            engine.close()
+        digests = dict([
+            (path.basename(local_file), entry) for local_file, entry in engine.recorded_digests.items()
+        ])
+        return out, failed, digests
+
+    def _write_local_checksums(self, local_backup_path, digests, vm_xml):
+        block_size = self._checksum_block_size()
+        files = dict(digests)
+        xml_data = vm_xml.encode()
+        files['VMdump.xml'] = {'size': len(xml_data), 'blocks': checksums.stream_block_digests([xml_data], block_size)}
+        manifest = checksums.build_manifest(block_size, files)
+        with open(path.join(local_backup_path, checksums.manifest_name), 'w') as manifest_fp:
+            json.dump(manifest, manifest_fp)
+        return manifest
+
+    def _store_local_backup(self, backup_name, trace):
         out = []
-        if 'port' in self.connection:
-            ssh_port = self.connection['port']
+        deduplicated = dict()
+        if self.connection.get('deduplicate', False):
+            with trace.span('deduplicate'):
+                deduplicated = self._deduplicate_backup(path.join(self.local_path, backup_name))
+            for file_name, (logical_size, stored_size) in sorted(deduplicated.items()):
+                out.append('{}: {} deduplicated, {} new'.format(
+                    file_name,
+                    self._format_size(logical_size),
+                    self._format_size(stored_size)
+                ))
+        self._catalog_backup(backup_name, deduplicated)
+        return out
+
+    def _remote_block_digests(self, remote_file, block_size):
+        # None for files gone in the meantime, checksums.verify_files reports them as missing
+        try:
+            return remote_helpers.block_digests(self.connection_manager, remote_file, block_size)
+        except FileNotFoundError:
+            return None
+
+    def _write_checksums(self, backup_dir, staged_digests, vm_xml):
+        block_size = self._checksum_block_size()
+        remote_dir = self.remote_path + '/' + backup_dir
+        files = dict(staged_digests)
+        xml_data = vm_xml.encode()
+        files['VMdump.xml'] = {
+            'size': len(xml_data),
+            'blocks': checksums.stream_block_digests([xml_data], block_size)
+        }
+        with self.connection_manager.sftp() as ftp:
+            # Files written by libvirt itself (incremental backups) are hashed after the fact on the hypervisor
+            missing = [
+                name for name in ftp.listdir(remote_dir)
+                if name not in files and name != checksums.manifest_name
+            ]
+        if missing:
+            with ThreadPoolExecutor(max_workers=max(1, int(self.connection.get('copy_concurrency', 2)))) as executor:
+                for name, digests in zip(missing, executor.map(
+                        lambda name: self._remote_block_digests(remote_dir + '/' + name, block_size), missing)):
+                    if digests is not None:
+                        files[name] = {'size': digests[0], 'blocks': digests[1]}
+        manifest = checksums.build_manifest(block_size, files)
+        with self.connection_manager.sftp() as ftp:
+            with ftp.open(remote_dir + '/' + checksums.manifest_name, 'w') as manifest_fp:
+                manifest_fp.write(json.dumps(manifest))
+        return manifest
+
+    def _start_trace(self, operation):
+        try:
+            history = JobHistory.shared(path.join(self.local_path, 'history.sqlite'))
+        except sqlite3.Error as e:
+            logging.warning('Job history not available: {}'.format(e))
+            history = None
+        return Trace(history, self.connection.get('vm_name'), operation)
+
+    def create_backup(self, progress_reporters=None):
+        trace = self._start_trace('create backup')
+        result = (False, None)
+        try:
+            result = self._create_backup(trace, progress_reporters)
+            return result
+        finally:
+            self.invalidate_remote_backups()
+            trace.finish('ok' if result[0] is not False else 'failed')
+
+    def _restart_vm(self, vm, trace, downtime_started):
+        with trace.span('startup'):
+            activated = self._activate_vm(vm)
+        downtime = None
+        if downtime_started is not None:
+            downtime = time() - downtime_started
+            trace.add_span('downtime', downtime_started, downtime)
+        else:
+            # Live, incremental or already stopped: the orchestrator orders VMs by this span, none means unknown
+            trace.add_span('downtime', time(), 0.0)
+        return activated, downtime
+
+    def _select_staging_strategy(self, images_to_save):
+        wanted = self.connection.get('staging_strategy', 'auto')
+        if wanted == 'copy' or not images_to_save:
+            return CopyStrategy(self.connection_manager, self.remote_path)
+        with self.connection_manager.sftp() as ftp:
+            # Clones land next to the staged copies, the directory has to exist before probing
+            try:
+                ftp.stat(self.remote_path)
+            except FileNotFoundError:
+                return CopyStrategy(self.connection_manager, self.remote_path)
+        return select_strategy(self.connection_manager, self.remote_path, images_to_save, wanted)
+
+    def _new_backup_dir(self):
+        # VMs backed up at the same time share the staging and the local directory, the VM name keeps them apart
+        return 'backup-{}-{}'.format(
+            re.sub(r'[^A-Za-z0-9_.-]', '_', self.connection['vm_name']),
+            datetime.today().strftime('%Y%m%d%H%M%S')
+        )
+
+    def _make_backup_dir(self, backup_dir, direct):
+        # Never reused, an existing directory holds another backup
+        if direct:
+            try:
+                mkdir(path.join(self.local_path, backup_dir))
+            except OSError as e:
+                logging.critical('Could not create {}: {}'.format(backup_dir, e))
+                return False
+            return True
+        try:
+            stdin, stdout, ssh_stderr = self.connection_manager.exec_command(
+                'mkdir {}'.format(quote(self.remote_path + '/' + backup_dir))
+            )
+            exit_status = stdout.channel.recv_exit_status()
+            error = ssh_stderr.read().decode(errors='replace').strip()
+        except SSHException as e:
+            logging.critical('SSH error: {}'.format(e))
+            return False
+        if exit_status != 0:
+            logging.critical('Could not create {}: {}'.format(backup_dir, error))
+            return False
+        return True
+
+    def _remove_backup_dir(self, backup_dir, direct):
+        # Only ever called on a directory _make_backup_dir just created, nothing was written into it yet
+        try:
+            if direct:
+                rmdir(path.join(self.local_path, backup_dir))
+            else:
+                stdin, stdout, ssh_stderr = self.connection_manager.exec_command(
+                    'rmdir {}'.format(quote(self.remote_path + '/' + backup_dir))
+                )
+                stdout.channel.recv_exit_status()
+        except (OSError, SSHException) as e:
+            logging.warning('Could not remove {}: {}'.format(backup_dir, e))
+
+    def _write_staging_record(self, backup_dir, record, direct):
+        # What kept the guest down this time, read back by whoever compares runs
+        data = json.dumps(record)
+        if direct:
+            with open(path.join(self.local_path, backup_dir, 'staging.json'), 'w') as record_fp:
+                record_fp.write(data)
         else:
-            ssh_port = 22
-        ssh = SSHClient()
-        ssh.set_missing_host_key_policy(AutoAddPolicy())
+            with self.connection_manager.sftp() as ftp:
+                with ftp.open(self.remote_path + '/' + backup_dir + '/staging.json', 'w') as record_fp:
+                    record_fp.write(data)
+
+    def _create_backup(self, trace, progress_reporters=None):
+        current_backup_dir = None
+        downtime_started = None
+        downtime = None
+        activated = None
+        out = []
+        failed_copies = []
+        staged_digests = dict()
+        strategy = None
         vm = self.find_virtual_machine()
+        backup_mode = self.connection.get('backup_mode', 'full')
         if vm is None:
             logging.critical('Failed to obtain VM')
             return False, current_backup_dir
-        else:
-            vm_status = vm.isActive()
-            logging.warning('VM "{}" found [Status: {}]'.format(self.connection['vm_name'], vm_status))
-            if vm.isActive() == 1:
+        direct = self.connection.get('transfer_mode', 'staged') == 'direct'
+        if direct and backup_mode == 'incremental':
+            # libvirt writes incremental backups into files on the hypervisor itself
+            logging.warning('Incremental backups are always staged on the hypervisor')
+            direct = False
+        if direct:
+            # Images are read over SFTP as they are, there is no copy on the hypervisor to compress or pace
+            ignored = [
+                key for key in ('compression_level', 'staging_rate', 'staging_io_class') if self.connection.get(key)
+            ]
+            if ignored:
+                logging.warning('{} ignored in direct transfer mode'.format(', '.join(ignored)))
+        images_to_save = self._print_all_vm_disks(vm)
+        vm_status = vm.isActive()
+        logging.warning('VM "{}" found [Status: {}]'.format(self.connection['vm_name'], vm_status))
+        if backup_mode in ('incremental', 'live') and vm_status != 1:
+            # Checkpoints and external snapshots are taken from the running guest
+            logging.warning('VM is not running, {} backup not possible. Taking a full copy.'.format(backup_mode))
+            backup_mode = 'full'
+        if backup_mode == 'live':
+            # External snapshots are only taken of image files, a block device would be copied while in use
+            snapshotted = set([source for target, source in self._get_vm_disk_targets(vm)])
+            devices = [image for image in images_to_save if image not in snapshotted]
+            if devices:
+                logging.warning('Live snapshots do not cover block devices ({}). Taking a full copy.'.format(
+                    ', '.join(devices)
+                ))
+                backup_mode = 'full'
+        if backup_mode == 'incremental' and not CheckpointBackup.is_supported(vm):
+            logging.warning('libvirt bindings without checkpoint support (6.0 or newer needed), taking a full copy.')
+            backup_mode = 'full'
+        if backup_mode == 'full':
+            # Probing happens while the guest still runs, it does not count as downtime
+            try:
+                strategy = self._select_staging_strategy(images_to_save)
+            except SSHException as e:
+                logging.critical('SSH Failed: {}'.format(e))
+                return False, current_backup_dir
+        current_backup_dir = self._new_backup_dir()
+        if not self._make_backup_dir(current_backup_dir, direct):
+            return False, None
+        local_backup_path = path.join(self.local_path, current_backup_dir)
+        if vm.isActive() == 1 and backup_mode == 'full':
+            downtime_started = time()
+            with trace.span('shutdown'):
                 deactivation = self._deactivate_vm(vm)
-                if not deactivation:
-                    logging.critical('Could not shutdown machine.')
-                    return False, current_backup_dir
-            # return True
+            if not deactivation:
+                logging.critical('Could not shutdown machine.')
+                self._remove_backup_dir(current_backup_dir, direct)
+                return False, None
 
-        images_to_save = self._print_all_vm_disks(vm)
-        ssh.load_host_keys(filename=path.join(path.expanduser('~'), '.ssh', 'known_hosts'))
-        try:
-            ssh.connect(
-                hostname=self.connection['host'],
-                username=self.connection['user'],
-                port=ssh_port,
-                key_filename=self.connection['keyfile']
-            )
-        except SSHException as e:
-            logging.critical('SSH Failed: {}'.format(e))
-            ssh.close()
-            return False, current_backup_dir
         try:
-            current_backup_dir = datetime.today().strftime("backup-%Y%m%d%H%M")
-            stdin, stdout, ssh_stderr = ssh.exec_command('mkdir {}/{}'.format(self.remote_path, current_backup_dir))
-            stdin.flush()
-            for image_to_save in images_to_save:
-                stdin, stdout, ssh_stderr = ssh.exec_command(
-                    'cp -v {} {}/{}'.format(image_to_save, self.remote_path, current_backup_dir)
+            ssh = self.connection_manager.get_ssh()
+            if backup_mode == 'incremental':
+                checkpoint_backup = CheckpointBackup(
+                    vm,
+                    ssh,
+                    self.remote_path,
+                    self._get_vm_disk_targets(vm),
+                    max_chain_length=self.connection.get('max_chain_length')
                 )
-                out.append(stdout.readlines())
-                stdin.flush()
+                with trace.span('checkpoint backup'):
+                    result = checkpoint_backup.run(current_backup_dir)
+                if result is False:
+                    return False, current_backup_dir
+                out.extend(result)
+            else:
+                live_snapshot = None
+                sources = dict()
+                to_copy = images_to_save
+                if backup_mode == 'live':
+                    live_snapshot = LiveSnapshot(
+                        vm,
+                        self._get_vm_disk_targets(vm),
+                        quiesce=self.connection.get('quiesce', False)
+                    )
+                    with trace.span('live snapshot'):
+                        if not live_snapshot.create('sanitex-' + current_backup_dir):
+                            return False, current_backup_dir
+                elif strategy is not None and strategy.releases_early:
+                    # A plain copy would be all the staging there is, so a clone can be the staged file itself
+                    in_place = not direct and not self.connection.get('compression_level') and \
+                        not self._staging_rate() and not self._checksum_block_size()
+                    with trace.span('freeze ' + strategy.name):
+                        frozen = strategy.freeze(images_to_save, current_backup_dir, in_place)
+                    if frozen is None:
+                        logging.warning('{} staging failed, copying with the VM stopped'.format(strategy.name))
+                        strategy = CopyStrategy(self.connection_manager, self.remote_path)
+                    else:
+                        sources = frozen
+                        if strategy.in_place:
+                            to_copy = []
+                        activated, downtime = self._restart_vm(vm, trace, downtime_started)
+                        downtime_started = None
+                try:
+                    # Base images are read only while the guest writes into the overlays
+                    if direct:
+                        lines, failed, streamed_digests = self._stream_images(
+                            to_copy,
+                            local_backup_path,
+                            trace,
+                            progress_reporters,
+                            sources
+                        )
+                        out.extend(lines)
+                        failed_copies.extend(failed)
+                        staged_digests.update(streamed_digests)
+                    else:
+                        for image_to_save, exit_status, lines, digests in self._stage_images(
+                                ssh,
+                                to_copy,
+                                current_backup_dir,
+                                trace,
+                                progress_reporters,
+                                sources):
+                            out.append(lines)
+                            if exit_status != 0:
+                                failed_copies.append(image_to_save)
+                            elif digests is not None:
+                                staged_digests[digests['file']] = {
+                                    'size': digests['size'],
+                                    'blocks': digests['blocks']
+                                }
+                finally:
+                    if live_snapshot is not None:
+                        with trace.span('blockcommit'):
+                            if not live_snapshot.commit(ssh):
+                                out.append("Failed to commit live snapshot overlays\n")
+                    if strategy is not None:
+                        strategy.release()
             # Dump XML too
-            ftp = ssh.open_sftp()
-            ftp.chdir(self.remote_path + '/' + current_backup_dir)
-            with ftp.open('VMdump.xml') as xml_dump_fp:
-                xml_dump_fp.write(vm.XMLDesc())
-            ftp.close()
+            vm_xml = vm.XMLDesc()
+            with trace.span('dump xml'):
+                if direct:
+                    with open(path.join(local_backup_path, 'VMdump.xml'), 'w') as xml_dump_fp:
+                        xml_dump_fp.write(vm_xml)
+                else:
+                    with self.connection_manager.sftp() as ftp:
+                        with ftp.open(self.remote_path + '/' + current_backup_dir + '/VMdump.xml', 'w') as xml_dump_fp:
+                            xml_dump_fp.write(vm_xml)
+            if strategy is not None:
+                if downtime_started is not None:
+                    # The guest stayed down for the whole copy, the record tells so
+                    downtime = time() - downtime_started
+                self._write_staging_record(current_backup_dir, {
+                    'mode': backup_mode,
+                    'transfer_mode': 'direct' if direct else 'staged',
+                    'strategy': strategy.name,
+                    'downtime': downtime,
+                }, direct)
+                out.append('Staging strategy: {}{}\n'.format(
+                    strategy.name,
+                    ', downtime {:.1f}s'.format(downtime) if downtime is not None else ''
+                ))
+            if self._checksum_block_size():
+                with trace.span('checksums'):
+                    try:
+                        if direct:
+                            self._write_local_checksums(local_backup_path, staged_digests, vm_xml)
+                        else:
+                            self._write_checksums(current_backup_dir, staged_digests, vm_xml)
+                    except (OSError, ValueError) as e:
+                        logging.critical('Could not write checksums: {}'.format(e))
+                        out.append("Failed to write checksums\n")
         except SSHException as e:
             logging.critical('SSH error: {}'.format(e))
             return False, current_backup_dir
-        if not self._activate_vm(vm):
+        finally:
+            if activated is None and downtime_started is not None:
+                # Whatever went wrong while the guest was down, the guest this backup stopped runs again
+                activated, downtime = self._restart_vm(vm, trace, downtime_started)
+        if activated is None:
+            activated, downtime = self._restart_vm(vm, trace, downtime_started)
+        if not activated:
             out.append("Failed to reactivate VM\n")
+        if failed_copies:
+            out.append("Failed to copy: {}\n".format(', '.join(failed_copies)))
+            return False, current_backup_dir
+        if direct:
+            # The guest is back, whatever is left only touches the local store
+            out.extend([line + '\n' for line in self._store_local_backup(current_backup_dir, trace)])
+            if retention.is_configured(self._retention_policy('local')):
+                # Same as after a staged backup is retrieved, there is nothing staged to prune
+                with trace.span('prune'):
+                    out.extend([line + '\n' for line in self._prune_local_backups(dry_run=False)])
         return out, current_backup_dir
 
-    @staticmethod
-    def _print_scp_progress(filename, size, sent):
-        logging.warning("%s\'s progress: %.2f%% \r" % (filename, float(sent) / float(size) * 100))
-
-    def retrieve_backup(self, backup_name=None):
+    def retrieve_backup(self, backup_name=None, progress_reporters=None):
         if not backup_name:
             logging.warning('Tried to obtain a backup but no name was given')
             return False
+        trace = self._start_trace('retrieve backup')
+        result = False
+        try:
+            result = self._retrieve_backup(backup_name, trace, progress_reporters)
+            return result
+        finally:
+            trace.finish('ok' if result else 'failed')
+
+    def _retrieve_backup(self, backup_name, trace, progress_reporters=None):
         out = []
-        if 'port' in self.connection:
-            ssh_port = self.connection['port']
-        else:
-            ssh_port = 22
-        ssh = SSHClient()
-        ssh.set_missing_host_key_policy(AutoAddPolicy())
-        ssh.load_host_keys(filename=path.join(path.expanduser('~'), '.ssh', 'known_hosts'))
+        engine = DownloadEngine(
+            self.connection_manager,
+            channels=self.connection.get('download_channels'),
+            progress_reporters=progress_reporters,
+            delta_block_size=self.connection.get('delta_block_size'),
+            connection=self.connection
+        )
         try:
-            ssh.connect(
-                hostname=self.connection['host'],
-                username=self.connection['user'],
-                port=ssh_port,
-                key_filename=self.connection['keyfile']
+            with self.connection_manager.sftp() as ftp:
+                ftp.stat(self.remote_path + '/' + backup_name)
+            local_backup_path = path.join(self.local_path, backup_name)
+            if not path.isdir(local_backup_path):
+                mkdir(local_backup_path)
+            logging.warning('Retrieving backup {} into {}'.format(backup_name, local_backup_path))
+            retrieved = engine.download_directory(
+                self.remote_path + '/' + backup_name,
+                local_backup_path,
+                skip=lambda file_name: path.isfile(
+                    ChunkStore.manifest_for(path.join(local_backup_path, file_name))
+                ),
+                manifest=self._remote_checksums(backup_name),
+                seed=self._delta_seed(backup_name)
             )
-        except SSHException as e:
-            logging.critical('SSH Failed: {}'.format(e))
-            ssh.close()
-            return False
-        try:
-            ftp = ssh.open_sftp()
-            ftp.chdir(self.remote_path + '/' + backup_name)
-            data = ftp.listdir()
-            if not path.isdir('/app/backups/' + backup_name):
-                mkdir('/app/backups/' + backup_name)
-            for to_retrieve in data:
-                logging.warning('Retrieving {} from backup {}'.format(to_retrieve, '/app/backups/' + backup_name))
-                ftp.get(
-                    to_retrieve,
-                    '/app/backups/' + backup_name + '/' + to_retrieve)
+            for to_retrieve, transferred, elapsed in retrieved:
+                trace.add_span('retrieve', time() - elapsed, elapsed, transferred, to_retrieve)
+                out.append('{}: {}'.format(to_retrieve, engine.format_rate(transferred, elapsed)))
+            out.extend(self._store_local_backup(backup_name, trace))
+            if self._retention_configured():
+                # The new copy is safe, older ones the policies gave up can go
+                with trace.span('prune'):
+                    out.extend(self._prune_backups(dry_run=False))
         except SSHException as e:
             logging.critical('SSH error: {}'.format(e))
             return False
         except FileNotFoundError:
-            out = 'Backup not found in remote server'
+            out = ['Backup not found in remote server']
+        except OSError as e:
+            logging.critical('Transfer error: {}'.format(e))
+            return False
+        finally:
+            engine.close()
         return out
 
-    def list_local_backups(self):
-        return self._create_tree_from_path('/app/backups')
+    def restore_backup(self, backup_name=None, new_name=None, progress_reporters=None):
+        """
+        Uploads a retrieved backup to the hypervisor and defines its domain again, under new_name when given.
+        Image paths are rewritten through restore_path_map.
+        """
+        if not backup_name:
+            logging.warning('Tried to restore a backup but no name was given')
+            return False
+        trace = self._start_trace('restore backup')
+        result = False
+        try:
+            try:
+                if not self.__connect_libvirt():
+                    return False
+            except SSHException as e:
+                logging.critical("SSH Error: {}".format(e))
+                return False
+            restore = RestoreBackup(
+                self.connection_manager,
+                self.libvirt_connection,
+                self.local_path,
+                self.remote_path,
+                self._chunk_store_path(),
+                channels=self.connection.get('upload_channels', self.connection.get('download_channels')),
+                path_map=self.connection.get('restore_path_map'),
+                progress_reporters=progress_reporters,
+                connection=self.connection
+            )
+            try:
+                result = restore.run(backup_name, trace, new_name)
+            except RestoreError as e:
+                logging.critical('Restore of {} failed: {}'.format(backup_name, e))
+            return result
+        finally:
+            trace.finish('ok' if result else 'failed')
+
+    def _previous_local_backup(self, backup_name):
+        catalog = self._catalog()
+        self._import_local_backups()
+        for backup in catalog.list_backups(
+                self.connection['vm_name'],
+                until=BackupCatalog.created_from_name(backup_name),
+                per_page=5):
+            if backup['name'] != backup_name and path.isdir(backup['path']):
+                return backup['path']
+        return None
+
+    def _delta_seed(self, backup_name):
+        # Files of the newest older local backup of the VM are the starting point of delta retrieval
+        if not self.connection.get('delta_retrieval', False):
+            return None
+        previous_path = self._previous_local_backup(backup_name)
+        if previous_path is None:
+            logging.warning('No previous local backup of {}, retrieving everything'.format(self.connection['vm_name']))
+            return None
+        logging.warning('Retrieving {} as a delta of {}'.format(backup_name, path.basename(previous_path)))
+
+        def seed(file_name):
+            previous_file = path.join(previous_path, file_name)
+            if path.isfile(previous_file):
+                return lambda destination: copy_sparse(previous_file, destination)
+            if path.isfile(ChunkStore.manifest_for(previous_file)):
+                return lambda destination: self._restore_chunks(ChunkStore.manifest_for(previous_file), destination)
+            return None
+
+        return seed
+
+    def _restore_chunks(self, manifest_path, destination):
+        chunk_store = ChunkStore(self._chunk_store_path())
+        try:
+            return chunk_store.restore(manifest_path, destination)
+        finally:
+            chunk_store.close()
+
+    def _remote_checksums(self, backup_name):
+        try:
+            manifest_path = self.remote_path + '/' + backup_name + '/' + checksums.manifest_name
+            with self.connection_manager.sftp() as ftp:
+                with ftp.open(manifest_path, 'r') as manifest_fp:
+                    return json.loads(manifest_fp.read().decode())
+        except FileNotFoundError:
+            return None
+
+    def _chunk_store_path(self):
+        return path.join(self.local_path, '.chunks')
+
+    def _deduplicate_backup(self, local_path):
+        deduplicated = dict()
+        chunk_store = ChunkStore(self._chunk_store_path())
+        try:
+            for file_name in sorted(listdir(local_path)):
+                file_path = path.join(local_path, file_name)
+                # Only images are worth chunking, dumps, manifests and state files stay as they are
+                if not path.isfile(file_path) or path.getsize(file_path) <= ChunkStore.max_size or \
+                        file_name.endswith((DownloadEngine.state_suffix, DownloadEngine.delta_suffix)) or \
+                        file_name == checksums.manifest_name:
+                    continue
+                logical_size, stored_size = chunk_store.ingest(file_path)
+                state_file = DownloadEngine.state_file_for(file_path)
+                if path.isfile(state_file):
+                    remove(state_file)
+                deduplicated[file_name] = (logical_size, stored_size)
+        finally:
+            chunk_store.close()
+        return deduplicated
+
+    def _catalog(self):
+        return BackupCatalog.shared(self.connection.get('catalog_path', path.join(self.local_path, 'catalog.sqlite')))
+
+    def _backup_vm_name(self, backup_path):
+        # The VM a backup belongs to is the one its VMdump.xml describes, whichever VM retrieved it
+        xml_path = path.join(backup_path, 'VMdump.xml')
+        if path.isfile(xml_path):
+            try:
+                names = minidom.parse(xml_path).getElementsByTagName('name')
+                if names and names[0].firstChild is not None:
+                    return names[0].firstChild.nodeValue
+            except (OSError, ExpatError) as e:
+                logging.warning('Could not read the VM of {}: {}'.format(backup_path, e))
+        return self.connection['vm_name']
+
+    def _catalog_backup(self, backup_name, deduplicated=None):
+        deduplicated = deduplicated or dict()
+        catalog = self._catalog()
+        backup_path = path.join(self.local_path, backup_name)
+        vm_name = self._backup_vm_name(backup_path)
+        previous = dict([(item['name'], item) for item in catalog.list_files(vm_name, backup_name)])
+        manifest_path = path.join(backup_path, checksums.manifest_name)
+        digests = dict()
+        if path.isfile(manifest_path):
+            digests = dict([
+                (name, entry['digest']) for name, entry in checksums.load_manifest(manifest_path)['files'].items()
+            ])
+        files = []
+        for file_name in sorted(listdir(backup_path)):
+            file_path = path.join(backup_path, file_name)
+            if not path.isfile(file_path) or \
+                    file_name.endswith((DownloadEngine.state_suffix, DownloadEngine.delta_suffix)) or \
+                    file_name.endswith('.tmp'):
+                continue
+            file_stat = stat(file_path)
+            if ChunkStore.is_manifest(file_name):
+                name = file_name[:-len(ChunkStore.manifest_suffix)]
+                size = ChunkStore.load_manifest(file_path)['size']
+                # Only the ingest knows how many bytes were new, keep what was recorded back then
+                if name in deduplicated:
+                    stored_size = deduplicated[name][1]
+                elif name in previous:
+                    stored_size = previous[name]['stored_size']
+                else:
+                    stored_size = 0
+            else:
+                name = file_name
+                size = file_stat.st_size
+                stored_size = file_stat.st_blocks * 512
+            files.append({
+                'name': name,
+                'size': size,
+                'stored_size': stored_size,
+                'mtime': file_stat.st_mtime,
+                'checksum': digests.get(name, previous[name]['checksum'] if name in previous else None),
+            })
+        catalog.record_backup(vm_name, backup_name, self.connection.get('host'), backup_path, files)
+
+    def _local_block_digests(self, backup_path, file_name, block_size):
+        file_path = path.join(backup_path, file_name)
+        if path.isfile(file_path):
+            return path.getsize(file_path), checksums.local_block_digests(file_path, block_size)
+        manifest_path = ChunkStore.manifest_for(file_path)
+        if path.isfile(manifest_path):
+            chunk_store = ChunkStore(self._chunk_store_path())
+            try:
+                return ChunkStore.load_manifest(manifest_path)['size'], checksums.stream_block_digests(
+                    chunk_store.read_chunks(manifest_path),
+                    block_size
+                )
+            finally:
+                chunk_store.close()
+        return None
+
+    def verify_backup(self, backup_name, remote=False):
+        """
+        Checks every file of a backup against its checksums.json, either the retrieved copy or the staging copy
+        on the hypervisor. Files are hashed in parallel, verify_concurrency at a time.
+        """
+        try:
+            if remote:
+                manifest = self._remote_checksums(backup_name)
+            else:
+                manifest_path = path.join(self.local_path, backup_name, checksums.manifest_name)
+                manifest = checksums.load_manifest(manifest_path) if path.isfile(manifest_path) else None
+        except (SSHException, OSError, ValueError) as e:
+            logging.critical('Could not read checksums of {}: {}'.format(backup_name, e))
+            return False
+        if manifest is None:
+            return ['No checksums stored for {}'.format(backup_name)]
+        block_size = manifest['block_size']
+        if remote:
+            remote_dir = self.remote_path + '/' + backup_name
+
+            def compute(file_name):
+                try:
+                    return self._remote_block_digests(remote_dir + '/' + file_name, block_size)
+                except SSHException as e:
+                    raise OSError(str(e))
+        else:
+            backup_path = path.join(self.local_path, backup_name)
+
+            def compute(file_name):
+                return self._local_block_digests(backup_path, file_name, block_size)
+
+        results = checksums.verify_files(manifest['files'], compute, self.connection.get('verify_concurrency', 4))
+        out = []
+        for file_name, (ok, message) in sorted(results.items()):
+            out.append('{}: {}'.format(file_name, message))
+            if ok and not remote:
+                self._catalog().set_checksum(
+                    self._backup_vm_name(backup_path),
+                    backup_name,
+                    file_name,
+                    manifest['files'][file_name]['digest']
+                )
+        failed = len([ok for ok, message in results.values() if not ok])
+        out.append('{} ({} copy): {}'.format(
+            backup_name,
+            'remote' if remote else 'local',
+            'all {} files verified'.format(len(results)) if not failed else '{} files FAILED'.format(failed)
+        ))
+        return out
 
     @staticmethod
-    def _create_tree_from_path(local_path):
-        structure = str()
-        for root, dirs, files in walk(local_path):
-            level = root.replace(local_path, '').count(sep)
-            indent = ' ' * 4 * (level)
-            structure += ('{}{}/\n'.format(indent, path.basename(root)))
-            subindent = ' ' * 4 * (level + 1)
-            for f in files:
-                structure += ('{}{}\n'.format(subindent, f))
+    def _format_size(size):
+        for unit in ['B', 'KB', 'MB', 'GB']:
+            if size < 1024:
+                return '{:.1f} {}'.format(size, unit)
+            size /= 1024
+        return '{:.1f} TB'.format(size)
+
+    def _import_local_backups(self):
+        # One time import of backups retrieved before the catalog existed. Remembered per backup directory, a
+        # retrieval may well have added the first backups to the catalog before anything else ran.
+        catalog = self._catalog()
+        key = 'imported ' + path.abspath(self.local_path)
+        if catalog.get_meta(key):
+            return
+        for backup_name in sorted(listdir(self.local_path)):
+            if backup_name.startswith('backup-') and path.isdir(path.join(self.local_path, backup_name)):
+                self._catalog_backup(backup_name)
+        catalog.set_meta(key, str(time()))
+
+    def list_local_backups(self, vm_name=None, since=None, until=None, page=1):
+        catalog = self._catalog()
+        self._import_local_backups()
+        totals = catalog.totals(vm_name, since, until)
+        if not totals['count']:
+            return 'No backups found.\n'
+        pages = (totals['count'] + catalog.per_page - 1) // catalog.per_page
+        structure = 'Page {}/{}: {} backups, {} logical, {} stored\n'.format(
+            page,
+            pages,
+            totals['count'],
+            self._format_size(totals['logical_size']),
+            self._format_size(totals['stored_size'])
+        )
+        for backup in catalog.list_backups(vm_name, since, until, page):
+            structure += '{} [{}] {} files, {} ({} stored)\n'.format(
+                backup['name'],
+                backup['vm'],
+                backup['file_count'],
+                self._format_size(backup['logical_size']),
+                self._format_size(backup['stored_size'])
+            )
         return structure
 
-    def list_remote_backups(self):
-        out = []
-        if 'port' in self.connection:
-            ssh_port = self.connection['port']
-        else:
-            ssh_port = 22
-        ssh = SSHClient()
-        ssh.set_missing_host_key_policy(AutoAddPolicy())
-        ssh.load_host_keys(filename=path.join(path.expanduser('~'), '.ssh', 'known_hosts'))
-        try:
-            ssh.connect(
-                hostname=self.connection['host'],
-                username=self.connection['user'],
-                port=ssh_port,
-                key_filename=self.connection['keyfile']
+    def _staging_paths(self):
+        # Backups may also have been staged in older locations which are still worth listing
+        return [self.remote_path] + [
+            staging_path for staging_path in self.connection.get('additional_remote_backup_paths', [])
+            if staging_path != self.remote_path
+        ]
+
+    def get_remote_backups(self, refresh=False):
+        cache_key = ('remote backups', tuple(self._staging_paths()))
+        if not refresh:
+            backups = self.connection_manager.cache_get(
+                cache_key,
+                self.connection.get('remote_listing_ttl', self.remote_listing_ttl)
             )
-        except SSHException as e:
-            logging.critical('SSH Failed: {}'.format(e))
-            ssh.close()
-            return False
+            if backups is not None:
+                return backups
         try:
-            stdin, stdout, ssh_stderr = ssh.exec_command(
-                'cd {} && find . -type d -mindepth 1 -iname {}'.format('/var/backups', "backup-\*")
+            stdin, stdout, ssh_stderr = self.connection_manager.exec_command(
+                remote_helpers.build_command(remote_helpers.backup_listing, *self._staging_paths())
             )
             stdin.flush()
+            output = stdout.read()
+            if stdout.channel.recv_exit_status() != 0:
+                logging.critical(
+                    'Failed to list remote backups: {}'.format(ssh_stderr.read().decode(errors='replace'))
+                )
+                return False
         except SSHException as e:
             logging.critical('SSH error: {}'.format(e))
-            del ssh
             return False
-        del ssh
-        retrieved_data = stdout.readlines()
-        return self._convert_backup_list_to_string(retrieved_data)
+        backups = json.loads(output.decode())
+        self.connection_manager.cache_put(cache_key, backups)
+        return backups
 
-    @staticmethod
-    def _convert_backup_list_to_string(retrieved_data):
+    def invalidate_remote_backups(self):
+        self.connection_manager.invalidate('remote backups')
+
+    def list_remote_backups(self, refresh=False):
+        # The listing covers every VM staged on the host, only the backups of this VM are shown
+        backups = self.get_remote_backups(refresh)
+        if backups is False:
+            return False
+        return self._convert_backup_list_to_string([
+            backup for backup in backups if backup.get('vm') == self.connection['vm_name']
+        ])
+
+    def _convert_backup_list_to_string(self, backups):
+        if not backups:
+            return 'No backups found.\n'
         parsed_retrieved_data = str()
-        for backup_unit_line in retrieved_data:
-            if str(backup_unit_line).startswith('./'):
-                parsed_retrieved_data += backup_unit_line[2:] + '\n'
-            else:
-                parsed_retrieved_data += backup_unit_line + '\n'
+        for backup in backups:
+            parsed_retrieved_data += '{} {} files, {} ({} on disk), {}'.format(
+                backup['name'],
+                backup['files'],
+                self._format_size(backup['size']),
+                self._format_size(backup['allocated']),
+                datetime.fromtimestamp(backup['mtime']).strftime('%Y-%m-%d %H:%M')
+            )
+            if backup['path'] != self.remote_path:
+                parsed_retrieved_data += ' [{}]'.format(backup['path'])
+            parsed_retrieved_data += '\n'
         return parsed_retrieved_data
 
-    def list_snapshots(self):
-        out = list()
+    def _retention_policy(self, where):
+        return self.connection.get(where + '_retention') or dict()
+
+    def _retention_configured(self):
+        return any([retention.is_configured(self._retention_policy(where)) for where in ('remote', 'local')])
+
+    def _apply_retention(self, where, backups, parents, pinned, delete, dry_run):
+        """
+        backups: dicts with name, label, created and size. delete(backups) removes them and returns an error message
+        or None. Returns the lines reporting what was (or would be) kept and deleted.
+        """
+        keep, doomed = retention.select(backups, self._retention_policy(where), parents, pinned)
+        labels = dict([(backup['name'], backup['label']) for backup in backups])
+        size = self._format_size(sum([backup['size'] or 0 for backup in doomed]))
+        if dry_run:
+            out = ['{}: would keep {} and delete {} ({} stored)'.format(where, len(keep), len(doomed), size)]
+            out.extend(['  keep {} ({})'.format(labels[name], ', '.join(reasons)) for name, reasons in sorted(
+                keep.items(), key=lambda item: labels[item[0]]
+            )])
+            out.extend(['  delete {}'.format(backup['label']) for backup in doomed])
+            return out
+        if not doomed:
+            return ['{}: nothing to delete, {} kept'.format(where, len(keep))]
+        error = delete(doomed)
+        if error:
+            return ['{}: could not delete {}: {}'.format(where, ', '.join([item['label'] for item in doomed]), error)]
+        logging.warning('Retention deleted {} {} backups of {}: {}'.format(
+            len(doomed),
+            where,
+            self.connection['vm_name'],
+            ', '.join([backup['label'] for backup in doomed])
+        ))
+        return ['{}: deleted {} ({} stored), {} kept'.format(
+            where,
+            ', '.join([backup['label'] for backup in doomed]),
+            size,
+            len(keep)
+        )]
+
+    def _delete_remote_backups(self, backups):
+        # Every directory in one command, the listing is stale afterwards whatever happened
+        try:
+            stdin, stdout, ssh_stderr = self.connection_manager.exec_command('rm -rf -- {}'.format(
+                ' '.join([quote(backup['name']) for backup in backups])
+            ))
+            exit_status = stdout.channel.recv_exit_status()
+            error = ssh_stderr.read().decode(errors='replace').strip()
+        except SSHException as e:
+            return 'SSH error: {}'.format(e)
+        finally:
+            self.invalidate_remote_backups()
+        if exit_status != 0:
+            return error or 'rm exited with {}'.format(exit_status)
+        return None
+
+    def _prune_remote_backups(self, dry_run):
+        policy = self._retention_policy('remote')
+        listed = self.get_remote_backups(refresh=True)
+        if listed is False:
+            return ['remote: could not list the staged backups']
+        # Staged backups are told apart by the VMdump.xml they carry, backups of other VMs are never touched
+        backups = [
+            {
+                'name': '{}/{}'.format(backup['path'], backup['name']),
+                'label': backup['name'] if backup['path'] == self.remote_path else '{} [{}]'.format(
+                    backup['name'],
+                    backup['path']
+                ),
+                'created': BackupCatalog.created_from_name(backup['name']),
+                'size': backup['allocated'],
+            }
+            for backup in listed if backup.get('vm') == self.connection['vm_name']
+        ]
+        parents = dict([
+            ('{}/{}'.format(backup['path'], backup['name']), '{}/{}'.format(backup['path'], backup['parent']))
+            for backup in listed if backup.get('parent')
+        ])
+        pinned = dict()
+        if policy.get('only_retrieved', True):
+            catalog = self._catalog()
+            self._import_local_backups()
+            retrieved = set([backup['name'] for backup in catalog.list_all_backups(self.connection['vm_name'])])
+            pinned = dict([
+                (backup['name'], 'not retrieved yet') for backup in backups
+                if backup['name'].rsplit('/', 1)[1] not in retrieved
+            ])
+        return self._apply_retention('remote', backups, parents, pinned, self._delete_remote_backups, dry_run)
+
+    def _local_parent(self, backup_path):
+        try:
+            with open(path.join(backup_path, CheckpointBackup.manifest_name), 'r') as manifest_fp:
+                return json.load(manifest_fp).get('parent_backup')
+        except (OSError, ValueError):
+            return None
+
+    def _delete_local_backups(self, backups):
+        catalog = self._catalog()
+        for backup in backups:
+            try:
+                if path.isdir(backup['path']):
+                    rmtree(backup['path'])
+            except OSError as e:
+                return '{}: {}'.format(backup['label'], e)
+            catalog.remove_backup(self.connection['vm_name'], backup['name'])
+        return None
+
+    def _prune_local_backups(self, dry_run):
+        catalog = self._catalog()
+        self._import_local_backups()
+        backups = [
+            dict(backup, label=backup['name'], size=backup['stored_size'])
+            for backup in catalog.list_all_backups(self.connection['vm_name'])
+        ]
+        parents = dict([(backup['name'], self._local_parent(backup['path'])) for backup in backups])
+        out = self._apply_retention('local', backups, parents, None, self._delete_local_backups, dry_run)
+        if not dry_run and path.isdir(self._chunk_store_path()):
+            chunk_store = ChunkStore(self._chunk_store_path())
+            try:
+                removed, freed = chunk_store.collect_garbage(self.local_path)
+                out.append('chunks: {} unreferenced removed, {} freed'.format(removed, self._format_size(freed)))
+            except (OSError, ValueError) as e:
+                logging.critical('Chunk collection failed: {}'.format(e))
+                out.append('chunks: collection skipped, {}'.format(e))
+            finally:
+                chunk_store.close()
+        return out
+
+    def _prune_backups(self, dry_run):
+        out = []
+        for where, prune in (('remote', self._prune_remote_backups), ('local', self._prune_local_backups)):
+            if not retention.is_configured(self._retention_policy(where)):
+                out.append('{}: no {}_retention configured'.format(where, where))
+                continue
+            out.extend(prune(dry_run))
+        return out
+
+    def prune_backups(self, dry_run=True):
+        """
+        Applies remote_retention to the backups staged for this VM and local_retention to the retrieved ones, or
+        only shows what would go when dry_run is set. Chunks no local backup refers to any more are removed too.
+        """
+        if dry_run:
+            return self._prune_backups(dry_run)
+        trace = self._start_trace('prune backups')
+        result = False
+        try:
+            with trace.span('prune'):
+                result = self._prune_backups(dry_run)
+            return result
+        finally:
+            trace.finish('ok' if result else 'failed')
+
+    def _snapshot_manager(self, vm):
+        return SnapshotManager(
+            vm,
+            self.connection_manager,
+            self.connection.get('snapshot_listing_ttl'),
+            self.connection.get('virsh_uri')
+        )
+
+    def list_snapshots(self, refresh=False):
         vm = self.find_virtual_machine()
         if vm is None:
             logging.critical('Failed to obtain VM')
             return False
-        for snapshot in vm.listAllSnapshots():
-            out.append(snapshot.getName())
+        out = list()
+        for depth, snapshot in SnapshotManager.walk(self._snapshot_manager(vm).tree(refresh)):
+            out.append('{}{} ({}, {}{}){}'.format(
+                '  ' * depth,
+                snapshot['name'],
+                datetime.fromtimestamp(snapshot['created']).strftime('%Y-%m-%d %H:%M'),
+                'external' if snapshot['external'] else 'internal',
+                ', ' + self._format_size(snapshot['size']) if snapshot['size'] else '',
+                ' *current' if snapshot['current'] else ''
+            ))
         return out
 
+    def _snapshot_retention(self, vm):
+        retention = self.connection.get('snapshot_retention') or dict()
+        return {
+            'keep_last': retention.get('keep_last'),
+            'max_age_days': retention.get('max_age_days'),
+            # Only snapshots named like the ones "create snapshot" takes by default
+            'match': retention.get('match', '{vm} *').format(vm=vm.name()),
+        }
+
+    def prune_snapshots(self, dry_run=True, vm=None):
+        """
+        Deletes the snapshots snapshot_retention gives up, or only lists them when dry_run is set.
+        """
+        vm = vm or self.find_virtual_machine()
+        if vm is None:
+            logging.critical('Failed to obtain VM')
+            return False
+        retention = self._snapshot_retention(vm)
+        if not retention['keep_last'] and not retention['max_age_days']:
+            return ['No snapshot_retention configured']
+        manager = self._snapshot_manager(vm)
+        expired = SnapshotManager.expired(manager.tree(refresh=not dry_run), **retention)
+        if not expired:
+            return ['No snapshots to prune']
+        if dry_run:
+            return ['Would delete {}'.format(snapshot['name']) for snapshot in expired]
+        return self._format_deleted(manager.delete([snapshot['name'] for snapshot in expired]))
+
+    def delete_snapshots(self, names):
+        vm = self.find_virtual_machine()
+        if vm is None:
+            logging.critical('Failed to obtain VM')
+            return False
+        return self._format_deleted(self._snapshot_manager(vm).delete(names))
+
+    @staticmethod
+    def _format_deleted(results):
+        return [
+            '{}: {}'.format(name, 'deleted' if error is None else 'kept, {}'.format(error))
+            for name, error in sorted(results.items())
+        ]
+
+    def consolidate_snapshots(self, mode='commit'):
+        vm = self.find_virtual_machine()
+        if vm is None:
+            logging.critical('Failed to obtain VM')
+            return False
+        trace = self._start_trace('consolidate snapshots')
+        result = False
+        try:
+            with trace.span('block ' + mode):
+                result = self._snapshot_manager(vm).consolidate(mode)
+            return result
+        finally:
+            trace.finish('ok' if result else 'failed')
+
     def create_snapshot(self, snapshot_name=None):
         out = list()
         vm = self.find_virtual_machine()
@@ -304,4 +1314,10 @@ class CreateBackup:
             out = 'Snapshot error: {}'.format(e)
             logging.critical(out)
             return out
+        finally:
+            self._snapshot_manager(vm).invalidate()
+        retention = self._snapshot_retention(vm)
+        if out and (retention['keep_last'] or retention['max_age_days']):
+            # Every new snapshot is a chance to drop the ones retention gave up
+            out = '\n'.join([out, 'Pruned:'] + self.prune_snapshots(dry_run=False, vm=vm))
         return out
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+import logging
+import sqlite3
+from contextlib import contextmanager
+from math import ceil
+from threading import Lock
+from time import time
+
+
+class Trace:
+    def __init__(self, history, vm_name, operation):
+        self.history = history
+        self.vm_name = vm_name
+        self.operation = operation
+        self.started = time()
+        self.spans = []
+        self.lock = Lock()
+
+    def add_span(self, phase, started, duration, transferred=0, file_name=None):
+        # Phases are a fixed set so they aggregate across runs, the file a phase worked on is kept apart
+        with self.lock:
+            self.spans.append((phase, started, duration, transferred, file_name))
+        logging.info('[trace] {} {} {}{}: {:.2f}s {} bytes'.format(
+            self.vm_name,
+            self.operation,
+            phase,
+            ' ' + file_name if file_name else '',
+            duration,
+            transferred
+        ))
+
+    @contextmanager
+    def span(self, phase, file_name=None):
+        # The yielded dict lets the traced block report how many bytes it moved
+        details = {'bytes': 0}
+        started = time()
+        try:
+            yield details
+        finally:
+            self.add_span(phase, started, time() - started, details['bytes'], file_name)
+
+    def finish(self, status):
+        if self.history is None:
+            return
+        duration = time() - self.started
+        with self.lock:
+            spans = list(self.spans)
+        try:
+            self.history.save(self, status, duration, spans)
+        except sqlite3.Error as e:
+            logging.warning('Could not save job history: {}'.format(e))
+
+
+class JobHistory:
+    database = '/app/backups/history.sqlite'
+    instances = dict()
+    instances_lock = Lock()
+
+    @classmethod
+    def shared(cls, database=None):
+        database = database or cls.database
+        with cls.instances_lock:
+            if database not in cls.instances:
+                cls.instances[database] = cls(database)
+            return cls.instances[database]
+
+    def __init__(self, database=None):
+        if database is not None:
+            self.database = database
+        self.lock = Lock()
+        self.db = sqlite3.connect(self.database, check_same_thread=False)
+        with self.db:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS runs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                vm TEXT NOT NULL,
+                operation TEXT NOT NULL,
+                started REAL NOT NULL,
+                duration REAL NOT NULL,
+                status TEXT NOT NULL
+            )""")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS spans (
+                run_id INTEGER NOT NULL REFERENCES runs(id),
+                vm TEXT NOT NULL,
+                operation TEXT NOT NULL,
+                phase TEXT NOT NULL,
+                started REAL NOT NULL,
+                duration REAL NOT NULL,
+                bytes INTEGER NOT NULL DEFAULT 0,
+                file TEXT
+            )""")
+            self.db.execute('CREATE INDEX IF NOT EXISTS spans_vm_phase ON spans (vm, phase, started)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS runs_vm_operation ON runs (vm, operation, started)')
+
+    def save(self, trace, status, duration, spans):
+        with self.lock, self.db:
+            cursor = self.db.execute(
+                'INSERT INTO runs (vm, operation, started, duration, status) VALUES (?, ?, ?, ?, ?)',
+                (trace.vm_name, trace.operation, trace.started, duration, status)
+            )
+            self.db.executemany(
+                'INSERT INTO spans (run_id, vm, operation, phase, started, duration, bytes, file) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [(cursor.lastrowid, trace.vm_name, trace.operation) + tuple(span) for span in spans]
+            )
+
+    @staticmethod
+    def _percentile(values, percentile):
+        ordered = sorted(values)
+        index = min(len(ordered) - 1, max(0, ceil(percentile / 100 * len(ordered)) - 1))
+        return ordered[index]
+
+    def stats(self, vm_name=None, since=None):
+        conditions = ''
+        params = []
+        if vm_name:
+            conditions += ' AND vm = ?'
+            params.append(vm_name)
+        if since:
+            conditions += ' AND started >= ?'
+            params.append(since)
+        query = 'SELECT vm, operation, phase, duration, bytes FROM spans WHERE 1=1' + conditions
+        run_query = "SELECT vm, operation, 'total', duration, 0 FROM runs WHERE status = 'ok'" + conditions
+        groups = dict()
+        with self.lock:
+            rows = self.db.execute(query, params).fetchall() + self.db.execute(run_query, params).fetchall()
+        for vm, operation, phase, duration, transferred in rows:
+            groups.setdefault((vm, operation, phase), []).append((duration, transferred))
+        result = []
+        for (vm, operation, phase), samples in sorted(groups.items()):
+            durations = [duration for duration, transferred in samples]
+            total_bytes = sum([transferred for duration, transferred in samples])
+            result.append({
+                'vm': vm,
+                'operation': operation,
+                'phase': phase,
+                'count': len(samples),
+                'p50': self._percentile(durations, 50),
+                'p95': self._percentile(durations, 95),
+                'mb_per_second': total_bytes / 1000000 / max(sum(durations), 0.001) if total_bytes else None,
+            })
+        return result
+
+    @staticmethod
+    def format_stats(stats):
+        lines = []
+        for row in stats:
+            lines.append('{} {} {}: n={} p50={:.1f}s p95={:.1f}s{}'.format(
+                row['vm'],
+                row['operation'],
+                row['phase'],
+                row['count'],
+                row['p50'],
+                row['p95'],
+                ' {:.2f} MB/s'.format(row['mb_per_second']) if row['mb_per_second'] is not None else ''
+            ))
+        return '\n'.join(lines)
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+import logging
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from itertools import count
+from threading import Lock
+
+
+class Job:
+    def __init__(self, job_id, vm_name, action, function, args=()):
+        self.job_id = job_id
+        self.vm_name = vm_name
+        self.action = action
+        self.function = function
+        self.args = args
+        self.status = 'queued'
+        self.result = None
+        self.error = None
+        self.created = datetime.now()
+        self.started = None
+        self.finished = None
+        self.subscribers = []
+
+    def is_pending(self):
+        return self.status in ('queued', 'running')
+
+    def describe(self):
+        reference = self.finished or datetime.now()
+        elapsed = reference - (self.started or self.created)
+        return '#{} {}{} [{}] {} for {}'.format(
+            self.job_id,
+            self.action,
+            ' ' + ' '.join([str(arg) for arg in self.args]) if self.args else '',
+            self.vm_name,
+            self.status,
+            str(elapsed).split('.')[0]
+        )
+
+
+class JobQueue:
+    workers = 2
+    history_size = 50
+    # vm_name of jobs touching every VM, they run alone
+    all_vms = '*'
+
+    def __init__(self, workers=None):
+        if workers:
+            self.workers = int(workers)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self.lock = Lock()
+        self.ids = count(1)
+        self.jobs = OrderedDict()
+        # Jobs waiting for another job of the same VM, or for a job of every VM, in submission order
+        self.waiting = deque()
+        self.busy_vms = set()
+
+    def submit(self, vm_name, action, function, args=(), on_finish=None):
+        with self.lock:
+            for job in self.jobs.values():
+                if job.is_pending() and job.vm_name == vm_name and job.action == action and job.args == args:
+                    if on_finish is not None:
+                        job.subscribers.append(on_finish)
+                    return job, False
+            job = Job(next(self.ids), vm_name, action, function, args)
+            if on_finish is not None:
+                job.subscribers.append(on_finish)
+            self.jobs[job.job_id] = job
+            self._forget_old_jobs()
+            self.waiting.append(job)
+            self._dispatch()
+        logging.warning('Job {} queued'.format(job.describe()))
+        return job, True
+
+    def _can_start(self, job):
+        if job.vm_name == self.all_vms:
+            return not self.busy_vms
+        return job.vm_name not in self.busy_vms and self.all_vms not in self.busy_vms
+
+    def _dispatch(self):
+        # Called with the lock held. A job of every VM waits for the running ones and holds back whatever was
+        # submitted after it, so it can not starve.
+        for job in list(self.waiting):
+            if self._can_start(job):
+                self.waiting.remove(job)
+                self.busy_vms.add(job.vm_name)
+                self.executor.submit(self._run, job)
+            elif job.vm_name == self.all_vms:
+                break
+
+    def _forget_old_jobs(self):
+        finished = [job_id for job_id, job in self.jobs.items() if not job.is_pending()]
+        for job_id in finished[:max(0, len(self.jobs) - self.history_size)]:
+            del self.jobs[job_id]
+
+    def _run(self, job):
+        job.status = 'running'
+        job.started = datetime.now()
+        try:
+            job.result = job.function(*job.args)
+            job.status = 'done'
+        except Exception as e:
+            logging.exception('Job {} failed'.format(job.job_id))
+            job.error = e
+            job.status = 'failed'
+        job.finished = datetime.now()
+        logging.warning('Job {}'.format(job.describe()))
+        with self.lock:
+            subscribers = list(job.subscribers)
+            self.busy_vms.discard(job.vm_name)
+            self._dispatch()
+        for subscriber in subscribers:
+            try:
+                subscriber(job)
+            except Exception:
+                logging.exception('Job {} completion notification failed'.format(job.job_id))
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list(self):
+        with self.lock:
+            return list(self.jobs.values())
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+import logging
+from threading import Event, Lock, Thread
+import libvirt
+
+
+class LifecycleWatcher:
+    event_loop_thread = None
+    event_loop_lock = Lock()
+    shutdown_actions = ('acpi', 'agent', 'destroy')
+
+    @classmethod
+    def start_event_loop(cls):
+        # Has to run before any libvirt connection is opened or they won't deliver events
+        with cls.event_loop_lock:
+            if cls.event_loop_thread is not None:
+                return
+            libvirt.virEventRegisterDefaultImpl()
+
+            def run_event_loop():
+                while True:
+                    libvirt.virEventRunDefaultImpl()
+
+            cls.event_loop_thread = Thread(target=run_event_loop, name='libvirt-events', daemon=True)
+            cls.event_loop_thread.start()
+
+    def __init__(self, libvirt_connection):
+        self.libvirt_connection = libvirt_connection
+
+    def wait_for(self, vm, events, is_done, timeout):
+        reached = Event()
+
+        def lifecycle_callback(conn, dom, event, detail, opaque):
+            if event in events:
+                reached.set()
+
+        callback_id = self.libvirt_connection.domainEventRegisterAny(
+            vm,
+            libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+            lifecycle_callback,
+            None
+        )
+        try:
+            # The state may have changed before the callback was in place
+            if is_done():
+                return True
+            reached.wait(timeout)
+            return is_done()
+        finally:
+            self.libvirt_connection.domainEventDeregisterAny(callback_id)
+
+    def wait_until_stopped(self, vm, timeout):
+        return self.wait_for(vm, (libvirt.VIR_DOMAIN_EVENT_STOPPED,), lambda: vm.isActive() != 1, timeout)
+
+    def wait_until_running(self, vm, timeout):
+        return self.wait_for(
+            vm,
+            (libvirt.VIR_DOMAIN_EVENT_STARTED, libvirt.VIR_DOMAIN_EVENT_RESUMED),
+            lambda: vm.isActive() == 1,
+            timeout
+        )
+
+    def _request_shutdown(self, vm, action):
+        if action == 'acpi':
+            vm.shutdownFlags(libvirt.VIR_DOMAIN_SHUTDOWN_ACPI_POWER_BTN)
+        elif action == 'agent':
+            vm.shutdownFlags(libvirt.VIR_DOMAIN_SHUTDOWN_GUEST_AGENT)
+        elif action == 'destroy':
+            vm.destroy()
+
+    def shutdown(self, vm, timeout, escalation=('acpi',)):
+        for action in escalation:
+            if action not in self.shutdown_actions:
+                logging.warning('Unknown shutdown action "{}", ignoring it'.format(action))
+                continue
+            logging.warning('Stopping VM "{}" [{}]'.format(vm.name(), action))
+            try:
+                self._request_shutdown(vm, action)
+            except libvirt.libvirtError as e:
+                logging.warning('Shutdown through {} failed: {}'.format(action, e))
+                continue
+            if self.wait_until_stopped(vm, timeout):
+                return True
+            logging.warning('VM "{}" still running {}s after {} shutdown'.format(vm.name(), timeout, action))
+        return vm.isActive() != 1
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import logging
+from shlex import quote
+from time import sleep
+import libvirt
+
+
+def wait_for_block_job(vm, target, sleep_time=1):
+    # True once the job of target is ready to pivot or about to finish, False if it vanished on the way
+    while True:
+        info = vm.blockJobInfo(target, 0)
+        if not info:
+            return False
+        if info['end'] > 0 and info['cur'] == info['end']:
+            return True
+        sleep(sleep_time)
+
+
+class LiveSnapshot:
+    overlay_suffix = '.sanitex-overlay'
+    snapshot_xml_template = """<domainsnapshot>
+      <name>{}</name>
+      <disks>{}</disks>
+    </domainsnapshot>"""
+    snapshot_disk_xml_template = """<disk name='{}' snapshot='external'>
+        <driver type='qcow2'/>
+        <source file='{}'/>
+      </disk>"""
+
+    def __init__(self, vm, disks, quiesce=False, sleep_time=1):
+        self.vm = vm
+        # List of (target device, source image) tuples
+        self.disks = disks
+        self.quiesce = quiesce
+        self.sleep_time = sleep_time
+        self.active = False
+
+    def _overlay_for(self, source):
+        return source + self.overlay_suffix
+
+    def create(self, snapshot_name):
+        snapshot_xml = self.snapshot_xml_template.format(
+            snapshot_name,
+            ''.join([
+                self.snapshot_disk_xml_template.format(target, self._overlay_for(source))
+                for target, source in self.disks
+            ])
+        )
+        flags = libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_DISK_ONLY | \
+            libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_ATOMIC | \
+            libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_NO_METADATA
+        if self.quiesce:
+            try:
+                self.vm.snapshotCreateXML(snapshot_xml, flags | libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_QUIESCE)
+                self.active = True
+                return True
+            except libvirt.libvirtError as e:
+                logging.warning('Quiesced snapshot failed, is the guest agent running? {}'.format(e))
+        try:
+            self.vm.snapshotCreateXML(snapshot_xml, flags)
+        except libvirt.libvirtError as e:
+            logging.critical('Could not create live snapshot: {}'.format(e))
+            return False
+        self.active = True
+        return True
+
+    def _wait_for_block_job(self, target):
+        return wait_for_block_job(self.vm, target, self.sleep_time)
+
+    def commit(self, ssh=None):
+        if not self.active:
+            return True
+        result = True
+        for target, source in self.disks:
+            try:
+                self.vm.blockCommit(target, None, None, 0, libvirt.VIR_DOMAIN_BLOCK_COMMIT_ACTIVE)
+                if not self._wait_for_block_job(target):
+                    logging.critical('Block commit of {} vanished before pivot'.format(target))
+                    result = False
+                    continue
+                self.vm.blockJobAbort(target, libvirt.VIR_DOMAIN_BLOCK_JOB_ABORT_PIVOT)
+            except libvirt.libvirtError as e:
+                logging.critical('Could not commit overlay of {}: {}'.format(target, e))
+                result = False
+                continue
+            if ssh is not None:
+                stdin, stdout, ssh_stderr = ssh.exec_command('rm -f {}'.format(quote(self._overlay_for(source))))
+                stdout.channel.recv_exit_status()
+        if result:
+            self.active = False
+        else:
+            logging.critical('VM "{}" may still be running on overlays, check it manually'.format(self.vm.name()))
+        return result
@@ -1,5 +1,9 @@
 # -*- coding: utf-8 -*-
 from . import create_backup
+from .jobs import JobQueue
+from .history import JobHistory
+from .progress import ProgressReporter
+from .orchestrator import BackupOrchestrator, expand_connections
 import os
 import sys
 import time
@@ -20,14 +24,28 @@ class Notifier:
     updater = None
     dispatcher = None
     users = {}
+    backup_makers = None
+    job_queue = None
+    connections = []
     command_list = """
     Available commands:
-      list local backups (lists backups already retrieved)
-      list remote backups (lists backups on the remote server)
+      list local backups [page N] [vm NAME] [since YYYY-MM-DD] [until YYYY-MM-DD] (lists backups already retrieved)
+      list remote backups [refresh] (lists the staged backups of the VM on the remote server, cached for a few minutes)
       create backup (Creates a REMOTE backup, must be retrieved later. MIND IT WILL STOP THE VM while copying)
+      backup all (Creates a REMOTE backup of every configured VM, host by host)
+      verify backup <name> [remote] (checks the retrieved copy, or the staging copy, against its checksums)
+      restore backup <name> [as <new name>] (uploads a retrieved backup and defines the VM again, not started)
+      prune backups [confirm] (shows, or deletes, the staged and local backups the retention policies give up)
       create snapshot (Creates a REMOTE snapshot. This WON'T stop the VM)
-      list snapshots
+      list snapshots [refresh] (snapshot tree, cached for a few minutes)
+      prune snapshots [confirm] (shows, or deletes, the snapshots snapshot_retention gives up)
+      delete snapshots <name>[, <name>...]
+      consolidate snapshots [pull] (merges the overlays of external snapshots, commit by default)
+      jobs (lists queued, running and recent jobs)
+      status <job> (shows the status of a job)
+      stats [days] [vm NAME] (p50/p95 duration and throughput per phase)
       whoami
+    Backup, restore and snapshot commands act on the first configured VM, end them with "vm NAME" for another one.
     """
 
     def __init__(self, connection=None, ):
@@ -57,6 +75,13 @@ class Notifier:
             self.connection = connection
         else:
             self._define_connection()
+        self.connections = expand_connections(self.connection)
+        if 'vm_name' not in self.connection and self.connections:
+            # Single VM commands work on the first configured VM unless they name another one
+            self.connection = self.connections[0]
+        self.backup_makers = dict()
+
+        self.job_queue = JobQueue(self.connection.get('job_workers'))
 
         start_handler = CommandHandler('start', self.start)
         self.dispatcher.add_handler(start_handler)
@@ -103,6 +128,67 @@ class Notifier:
             if _raise_error:
                 return False
 
+    def _get_backup_maker(self, connection=None):
+        # One instance per VM for the whole bot life, its SSH and libvirt connections stay open between commands
+        connection = connection or self.connection
+        if connection['vm_name'] not in self.backup_makers:
+            self.backup_makers[connection['vm_name']] = create_backup.CreateBackup(connection)
+        return self.backup_makers[connection['vm_name']]
+
+    def _select_vm(self, bot, chat_id, message):
+        """
+        Single VM commands end with an optional "vm NAME". Returns the message without it and the backup maker of
+        that VM, of the default one without a selector, or None after telling the user the VM is unknown.
+        """
+        words = message.split(' ')
+        if len(words) < 3 or words[-2].lower() != 'vm':
+            return message, self._get_backup_maker()
+        for connection in self.connections:
+            if connection['vm_name'] == words[-1]:
+                return ' '.join(words[:-2]), self._get_backup_maker(connection)
+        bot.sendMessage(chat_id=chat_id, text="Unknown VM {}, configured: {}".format(
+            words[-1],
+            ', '.join([connection['vm_name'] for connection in self.connections])
+        ))
+        return ' '.join(words[:-2]), None
+
+    def _submit_job(self, bot, chat_id, action, function, args, on_finish, vm_name=None):
+        job, is_new = self.job_queue.submit(vm_name or self.connection['vm_name'], action, function, args, on_finish)
+        if is_new:
+            bot.sendMessage(chat_id=chat_id, text="Job #{} queued: {}. I'll tell you when it's done.".format(
+                job.job_id,
+                action
+            ))
+        else:
+            bot.sendMessage(chat_id=chat_id, text="Same request already in progress as job #{} ({}).".format(
+                job.job_id,
+                job.status
+            ))
+        return job
+
+    def _progress_reporters(self, bot, chat_id):
+        # Telegram rate limits bots, so progress messages are much sparser than log lines. One reporter per job,
+        # however many files or VMs it transfers.
+        return [ProgressReporter(
+            lambda text: bot.sendMessage(chat_id=chat_id, text=text),
+            int(self.connection.get('progress_interval', 300))
+        )]
+
+    @staticmethod
+    def _parse_listing_filters(params):
+        filters = {'page': 1}
+        for key, value in zip(params[::2], params[1::2]):
+            try:
+                if key == 'page' and value.isdigit():
+                    filters['page'] = max(1, int(value))
+                elif key == 'vm':
+                    filters['vm_name'] = value
+                elif key in ('since', 'until'):
+                    filters[key] = datetime.datetime.strptime(value, '%Y-%m-%d').timestamp()
+            except ValueError:
+                logging.warning('Ignoring listing filter {} {}'.format(key, value))
+        return filters
+
     def echo(self, bot, update):
         chat_id = update.message.chat_id
         message = update.message.text
@@ -197,31 +283,66 @@ class Notifier:
                 if self.connection is None:
                     bot.sendMessage(chat_id=chat_id, text="Connection not defined")
                     return False
-                bot.sendMessage(chat_id=chat_id, text="Hold on, this may take a while...")
-                new_backup = create_backup.CreateBackup(self.connection)
-                (data, backup_name) = new_backup.create_backup()
-                if backup_name:
-                    logging.warning('New remote backup created: {}'.format(backup_name))
-                    bot.sendMessage(chat_id=chat_id, text="Backup Name: {}".format(backup_name))
-                else:
-                    logging.warning('Failed to create new backup:\n{}'.format(data))
-                del new_backup
-                bot.sendMessage(chat_id=chat_id, text="Data: {}".format(data))
+                message, backup_maker = self._select_vm(bot, chat_id, message)
+                if backup_maker is None:
+                    return False
+
+                def backup_created(job):
+                    if job.status != 'done':
+                        bot.sendMessage(chat_id=chat_id, text="Job #{} failed: {}".format(job.job_id, job.error))
+                        return
+                    (data, backup_name) = job.result
+                    if data and backup_name:
+                        logging.warning('New remote backup created: {}'.format(backup_name))
+                        bot.sendMessage(chat_id=chat_id, text="Job #{} done. Backup Name: {}".format(
+                            job.job_id,
+                            backup_name
+                        ))
+                    else:
+                        logging.warning('Failed to create new backup:\n{}'.format(data))
+                    bot.sendMessage(chat_id=chat_id, text="Data: {}".format(data))
+
+                reporters = self._progress_reporters(bot, chat_id)
+                self._submit_job(bot, chat_id, 'create backup', lambda: backup_maker.create_backup(reporters), (),
+                                 backup_created, vm_name=backup_maker.connection['vm_name'])
             else:
                 logging.warning('Unknown user {} with ID {} tried to create a backup!'.format(user_name, chat_id))
 
+        elif message.lower().startswith("backup all"):
+            if chat_id in self.users:
+                if not self.connections:
+                    bot.sendMessage(chat_id=chat_id, text="No VMs configured")
+                    return False
+
+                def all_backups_done(job):
+                    if job.status != 'done':
+                        bot.sendMessage(chat_id=chat_id, text="Job #{} failed: {}".format(job.job_id, job.error))
+                        return
+                    bot.sendMessage(chat_id=chat_id, text="Job #{} done:\n{}".format(
+                        job.job_id,
+                        BackupOrchestrator.format_results(job.result)
+                    ))
+
+                reporters = self._progress_reporters(bot, chat_id)
+                self._submit_job(bot, chat_id, 'backup all',
+                                 lambda: BackupOrchestrator(self.connections).run(reporters), (), all_backups_done,
+                                 vm_name=JobQueue.all_vms)
+            else:
+                logging.warning('Unknown user {} with ID {} tried to back up every VM!'.format(user_name, chat_id))
+
         elif message.lower().startswith("list remote backups"):
             if chat_id in self.users:
                 if self.connection is None:
                     bot.sendMessage(chat_id=chat_id, text="Connection not defined")
                     return False
-                new_backup = create_backup.CreateBackup(self.connection)
-                data = new_backup.list_remote_backups()
-                del new_backup
+                message, new_backup = self._select_vm(bot, chat_id, message)
+                if new_backup is None:
+                    return False
+                data = new_backup.list_remote_backups(refresh='refresh' in message.lower().split(' ')[3:])
                 if data:
                     bot.sendMessage(
                         chat_id=chat_id,
-                        text="backups of {}:\n{}".format(self.connection['vm_name'], data)
+                        text="backups of {}:\n{}".format(new_backup.connection['vm_name'], data)
                     )
                 else:
                     bot.sendMessage(
@@ -236,13 +357,12 @@ class Notifier:
                 if self.connection is None:
                     bot.sendMessage(chat_id=chat_id, text="Connection not defined")
                     return False
-                new_backup = create_backup.CreateBackup(self.connection)
-                data = new_backup.list_local_backups()
-                del new_backup
+                new_backup = self._get_backup_maker()
+                data = new_backup.list_local_backups(**self._parse_listing_filters(message.split(' ')[3:]))
                 if data:
                     bot.sendMessage(
                         chat_id=chat_id,
-                        text="backups of {}:\n{}".format(self.connection['vm_name'], data)
+                        text="Local backups:\n{}".format(data)
                     )
                 else:
                     bot.sendMessage(
@@ -257,6 +377,9 @@ class Notifier:
                 if self.connection is None:
                     bot.sendMessage(chat_id=chat_id, text="Connection not defined")
                     return False
+                message, backup_maker = self._select_vm(bot, chat_id, message)
+                if backup_maker is None:
+                    return False
                 params = message.split(' '),
                 params = params[0]
                 if len(params) > 2:
@@ -264,36 +387,146 @@ class Notifier:
                         bot.sendMessage(chat_id=chat_id, text="Please, provide a backup name.")
                         return False
                 backup_name = str(params[2])
-                bot.sendMessage(chat_id=chat_id, text="Hold on, this may take a while... really...")
-                new_backup = create_backup.CreateBackup(self.connection)
-                data = new_backup.retrieve_backup(backup_name)
-                del new_backup
-                if data:
-                    _composed_message = "\n".join(data)
-                    bot.sendMessage(
-                        chat_id=chat_id,
-                        text="Result of backup {} retrieval:\n{}".format(backup_name, _composed_message)
-                    )
-                else:
-                    bot.sendMessage(
-                        chat_id=chat_id,
-                        text="Failed to retrieve remote backup {}.".format(backup_name)
-                    )
+
+                def backup_retrieved(job):
+                    if job.status == 'done' and job.result:
+                        _composed_message = "\n".join(job.result)
+                        bot.sendMessage(
+                            chat_id=chat_id,
+                            text="Job #{}: result of backup {} retrieval:\n{}".format(
+                                job.job_id,
+                                backup_name,
+                                _composed_message
+                            )
+                        )
+                    else:
+                        bot.sendMessage(
+                            chat_id=chat_id,
+                            text="Job #{}: failed to retrieve remote backup {}.".format(job.job_id, backup_name)
+                        )
+
+                reporters = self._progress_reporters(bot, chat_id)
+                self._submit_job(bot, chat_id, 'retrieve backup',
+                                 lambda name: backup_maker.retrieve_backup(name, reporters),
+                                 (backup_name,), backup_retrieved, vm_name=backup_maker.connection['vm_name'])
             else:
                 logging.warning('Unknown user {} with ID {} tried to list backups!'.format(user_name, chat_id))
 
+        elif message.lower().startswith("verify backup"):
+            if chat_id in self.users:
+                if self.connection is None:
+                    bot.sendMessage(chat_id=chat_id, text="Connection not defined")
+                    return False
+                message, backup_maker = self._select_vm(bot, chat_id, message)
+                if backup_maker is None:
+                    return False
+                params = message.split(' ')
+                if len(params) < 3:
+                    bot.sendMessage(chat_id=chat_id, text="Please, provide a backup name.")
+                    return False
+                backup_name = params[2]
+                remote = len(params) > 3 and params[3].lower() == 'remote'
+
+                def backup_verified(job):
+                    if job.status == 'done' and job.result:
+                        bot.sendMessage(
+                            chat_id=chat_id,
+                            text="Job #{}:\n{}".format(job.job_id, "\n".join(job.result))
+                        )
+                    else:
+                        bot.sendMessage(
+                            chat_id=chat_id,
+                            text="Job #{}: failed to verify backup {}.".format(job.job_id, backup_name)
+                        )
+
+                self._submit_job(bot, chat_id, 'verify backup',
+                                 lambda name, on_remote: backup_maker.verify_backup(name, on_remote),
+                                 (backup_name, remote), backup_verified, vm_name=backup_maker.connection['vm_name'])
+            else:
+                logging.warning('Unknown user {} with ID {} tried to verify a backup!'.format(user_name, chat_id))
+
+        elif message.lower().startswith("restore backup"):
+            if chat_id in self.users:
+                if self.connection is None:
+                    bot.sendMessage(chat_id=chat_id, text="Connection not defined")
+                    return False
+                message, backup_maker = self._select_vm(bot, chat_id, message)
+                if backup_maker is None:
+                    return False
+                params = message.split(' ')
+                if len(params) < 3:
+                    bot.sendMessage(chat_id=chat_id, text="Please, provide a backup name.")
+                    return False
+                backup_name = params[2]
+                new_name = None
+                if len(params) > 3:
+                    if len(params) != 5 or params[3].lower() != 'as':
+                        bot.sendMessage(chat_id=chat_id, text="Usage: restore backup <name> [as <new name>]")
+                        return False
+                    new_name = params[4]
+
+                def backup_restored(job):
+                    if job.status == 'done' and job.result:
+                        bot.sendMessage(
+                            chat_id=chat_id,
+                            text="Job #{}: result of backup {} restore:\n{}".format(
+                                job.job_id,
+                                backup_name,
+                                "\n".join(job.result)
+                            )
+                        )
+                    else:
+                        bot.sendMessage(
+                            chat_id=chat_id,
+                            text="Job #{}: failed to restore backup {}.".format(job.job_id, backup_name)
+                        )
+
+                reporters = self._progress_reporters(bot, chat_id)
+                self._submit_job(bot, chat_id, 'restore backup',
+                                 lambda name, rename: backup_maker.restore_backup(name, rename, reporters),
+                                 (backup_name, new_name), backup_restored, vm_name=backup_maker.connection['vm_name'])
+            else:
+                logging.warning('Unknown user {} with ID {} tried to restore a backup!'.format(user_name, chat_id))
+
+        elif message.lower().startswith("prune backups"):
+            if chat_id in self.users:
+                if self.connection is None:
+                    bot.sendMessage(chat_id=chat_id, text="Connection not defined")
+                    return False
+                message, backup_maker = self._select_vm(bot, chat_id, message)
+                if backup_maker is None:
+                    return False
+                params = message.split(' ')
+                # A preview unless confirmed
+                confirmed = len(params) > 2 and params[2].lower() == 'confirm'
+
+                def backups_pruned(job):
+                    if job.status == 'done' and job.result:
+                        bot.sendMessage(chat_id=chat_id, text="Job #{}:\n{}".format(job.job_id, "\n".join(job.result)))
+                    else:
+                        bot.sendMessage(chat_id=chat_id, text="Job #{}: prune backups failed.".format(job.job_id))
+
+                self._submit_job(bot, chat_id, 'prune backups', lambda dry_run: backup_maker.prune_backups(dry_run),
+                                 (not confirmed,), backups_pruned, vm_name=backup_maker.connection['vm_name'])
+            else:
+                logging.warning('Unknown user {} with ID {} tried to prune backups!'.format(user_name, chat_id))
+
         elif message.lower().startswith("list snapshots"):
             if chat_id in self.users:
                 if self.connection is None:
                     bot.sendMessage(chat_id=chat_id, text="Connection not defined")
                     return False
-                new_backup = create_backup.CreateBackup(self.connection)
-                data = list(new_backup.list_snapshots())
-                del new_backup
-                _composed_message = "\n".join(data)
+                message, new_backup = self._select_vm(bot, chat_id, message)
+                if new_backup is None:
+                    return False
+                data = new_backup.list_snapshots(refresh=message.lower().split(' ')[-1] == 'refresh')
+                if data is False:
+                    bot.sendMessage(chat_id=chat_id, text="Failed to list snapshots.")
+                    return False
+                _composed_message = "\n".join(data) if data else "No snapshots."
                 bot.sendMessage(
                     chat_id=chat_id,
-                    text="Snapshots of {}:\n{}".format(self.connection['vm_name'], _composed_message)
+                    text="Snapshots of {}:\n{}".format(new_backup.connection['vm_name'], _composed_message)
                 )
             else:
                 logging.warning('Unknown user {} with ID {} tried to list snapshots!'.format(user_name, chat_id))
@@ -303,13 +536,97 @@ class Notifier:
                 if self.connection is None:
                     bot.sendMessage(chat_id=chat_id, text="Connection not defined")
                     return False
-                new_backup = create_backup.CreateBackup(self.connection)
-                data = new_backup.create_snapshot()
-                del new_backup
-                _composed_message = "\n".join(data)
-                bot.sendMessage(chat_id=chat_id, text="Data:\n{}".format(_composed_message))
+                message, backup_maker = self._select_vm(bot, chat_id, message)
+                if backup_maker is None:
+                    return False
+
+                def snapshot_created(job):
+                    bot.sendMessage(chat_id=chat_id, text="Job #{} {}:\n{}".format(
+                        job.job_id,
+                        job.status,
+                        job.result if job.status == 'done' else job.error
+                    ))
+
+                self._submit_job(bot, chat_id, 'create snapshot', backup_maker.create_snapshot, (),
+                                 snapshot_created, vm_name=backup_maker.connection['vm_name'])
             else:
                 logging.warning('Unknown user {} with ID {} tried to create a snapshot!'.format(user_name, chat_id))
 
+        elif message.lower().startswith("prune snapshots") or message.lower().startswith("delete snapshots") or \
+                message.lower().startswith("consolidate snapshots"):
+            if chat_id in self.users:
+                if self.connection is None:
+                    bot.sendMessage(chat_id=chat_id, text="Connection not defined")
+                    return False
+                message, backup_maker = self._select_vm(bot, chat_id, message)
+                if backup_maker is None:
+                    return False
+                params = message.split(' ')
+                action = '{} snapshots'.format(params[0].lower())
+                if action == 'prune snapshots':
+                    # A preview unless confirmed
+                    confirmed = len(params) > 2 and params[2].lower() == 'confirm'
+                    function, args = lambda dry_run: backup_maker.prune_snapshots(dry_run), (not confirmed,)
+                elif action == 'delete snapshots':
+                    # Snapshot names have spaces, several of them are separated by commas
+                    names = [name.strip() for name in message[len(action):].split(',') if name.strip()]
+                    if not names:
+                        bot.sendMessage(chat_id=chat_id, text="Please, provide the snapshot names.")
+                        return False
+                    function, args = lambda to_delete: backup_maker.delete_snapshots(to_delete), (names,)
+                else:
+                    mode = 'pull' if len(params) > 2 and params[2].lower() == 'pull' else 'commit'
+                    function, args = lambda how: backup_maker.consolidate_snapshots(how), (mode,)
+
+                def snapshots_changed(job):
+                    if job.status == 'done' and job.result:
+                        bot.sendMessage(chat_id=chat_id, text="Job #{}:\n{}".format(job.job_id, "\n".join(job.result)))
+                    else:
+                        bot.sendMessage(chat_id=chat_id, text="Job #{}: {} failed.".format(job.job_id, action))
+
+                self._submit_job(bot, chat_id, action, function, args, snapshots_changed,
+                                 vm_name=backup_maker.connection['vm_name'])
+            else:
+                logging.warning('Unknown user {} with ID {} tried to change snapshots!'.format(user_name, chat_id))
+
+        elif message.lower().startswith("jobs"):
+            if chat_id in self.users:
+                jobs = self.job_queue.list()
+                if jobs:
+                    bot.sendMessage(chat_id=chat_id, text="\n".join([job.describe() for job in jobs]))
+                else:
+                    bot.sendMessage(chat_id=chat_id, text="No jobs.")
+            else:
+                logging.warning('Unknown user {} with ID {} tried to list jobs!'.format(user_name, chat_id))
+
+        elif message.lower().startswith("stats"):
+            if chat_id in self.users:
+                message, backup_maker = self._select_vm(bot, chat_id, message)
+                if backup_maker is None:
+                    return False
+                params = message.split(' ')
+                since = None
+                if len(params) > 1 and params[1].isdigit():
+                    since = time.time() - int(params[1]) * 86400
+                data = JobHistory.format_stats(JobHistory.shared(
+                    os.path.join(backup_maker.local_path, 'history.sqlite')
+                ).stats(backup_maker.connection['vm_name'], since))
+                bot.sendMessage(chat_id=chat_id, text=data if data else "No runs recorded yet.")
+            else:
+                logging.warning('Unknown user {} with ID {} tried to read stats!'.format(user_name, chat_id))
+
+        elif message.lower().startswith("status"):
+            if chat_id in self.users:
+                params = message.split(' ')
+                job = None
+                if len(params) > 1 and params[1].lstrip('#').isdigit():
+                    job = self.job_queue.get(int(params[1].lstrip('#')))
+                if job is None:
+                    bot.sendMessage(chat_id=chat_id, text="Unknown job. Try: status <job>")
+                else:
+                    bot.sendMessage(chat_id=chat_id, text=job.describe())
+            else:
+                logging.warning('Unknown user {} with ID {} tried to query a job!'.format(user_name, chat_id))
+
         else:
             bot.sendMessage(chat_id=chat_id, text="Orden desconocida.")
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+import logging
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+from time import time
+from .create_backup import CreateBackup
+from .history import JobHistory
+
+# Keys describing the bot or the host list itself, never copied into a VM connection
+global_only_keys = ('hosts', 'users', 'telegram_token')
+
+
+def expand_connections(config):
+    """
+    Turns the configuration into one connection dict per VM. Global keys are defaults for every host, host keys are
+    defaults for every VM of the host:
+
+        hosts:
+          - host: kvm1
+            max_concurrent_backups: 1
+            vms:
+              - web
+              - name: db
+                backup_mode: live
+
+    A configuration without "hosts" is the classic single VM connection.
+    """
+    if 'hosts' not in config:
+        return [config] if 'vm_name' in config else []
+    defaults = {key: value for key, value in config.items() if key not in global_only_keys}
+    connections = []
+    for host in config['hosts'] or []:
+        host_defaults = dict(defaults)
+        host_defaults.update({key: value for key, value in host.items() if key != 'vms'})
+        for vm in host.get('vms') or []:
+            connection = dict(host_defaults)
+            if isinstance(vm, dict):
+                connection.update({key: value for key, value in vm.items() if key != 'name'})
+                connection['vm_name'] = vm['name']
+            else:
+                connection['vm_name'] = vm
+            connections.append(connection)
+    return connections
+
+
+class BackupOrchestrator:
+    max_concurrent_backups = 1
+
+    def __init__(self, connections):
+        self.connections = connections
+
+    @staticmethod
+    def _host_key(connection):
+        return connection.get('host'), connection.get('port', 22)
+
+    def _group_by_host(self):
+        hosts = dict()
+        for connection in self.connections:
+            hosts.setdefault(self._host_key(connection), []).append(connection)
+        return hosts
+
+    @staticmethod
+    def _expected_downtime(backup_maker):
+        # p50 of previous runs, VMs never backed up go last. Runs that never stopped the guest record a 0 downtime.
+        try:
+            history = JobHistory.shared(path.join(backup_maker.local_path, 'history.sqlite'))
+            stats = history.stats(backup_maker.connection['vm_name'])
+        except sqlite3.Error as e:
+            logging.warning('Job history not available: {}'.format(e))
+            return float('inf')
+        durations = dict([
+            (row['phase'], row['p50']) for row in stats if row['operation'] == 'create backup'
+        ])
+        return durations.get('downtime', durations.get('total', float('inf')))
+
+    def plan(self):
+        # Shortest downtime first inside every host
+        plan = dict()
+        for host_key, connections in self._group_by_host().items():
+            backup_makers = [CreateBackup(connection) for connection in connections]
+            plan[host_key] = sorted(backup_makers, key=self._expected_downtime)
+        return plan
+
+    @staticmethod
+    def _backup_vm(backup_maker, progress_reporters=None):
+        started = time()
+        vm_name = backup_maker.connection['vm_name']
+        try:
+            data, backup_name = backup_maker.create_backup(progress_reporters)
+        except Exception as e:
+            logging.critical('Backup of {} failed: {}'.format(vm_name, e))
+            data, backup_name = False, None
+        return {
+            'vm': vm_name,
+            'host': backup_maker.connection.get('host'),
+            'ok': data is not False,
+            'backup': backup_name,
+            'output': data,
+            'seconds': time() - started,
+        }
+
+    def _backup_host(self, backup_makers, progress_reporters=None):
+        limit = max(1, int(backup_makers[0].connection.get('max_concurrent_backups', self.max_concurrent_backups)))
+        with ThreadPoolExecutor(max_workers=limit) as executor:
+            return list(executor.map(lambda backup_maker: self._backup_vm(backup_maker, progress_reporters),
+                                     backup_makers))
+
+    def run(self, progress_reporters=None):
+        plan = self.plan()
+        if not plan:
+            logging.warning('No VMs configured for backup')
+            return []
+        for (host, port), backup_makers in plan.items():
+            logging.warning('Backup order for {}: {}'.format(
+                host,
+                ', '.join([backup_maker.connection['vm_name'] for backup_maker in backup_makers])
+            ))
+        # Hosts are independent, each one runs its own queue
+        with ThreadPoolExecutor(max_workers=len(plan)) as executor:
+            futures = [
+                executor.submit(self._backup_host, backup_makers, progress_reporters)
+                for backup_makers in plan.values()
+            ]
+            results = []
+            for future in futures:
+                results.extend(future.result())
+        return results
+
+    @staticmethod
+    def format_results(results):
+        lines = []
+        for result in results:
+            lines.append('{} [{}] {} {} in {:.0f}s'.format(
+                result['vm'],
+                result['host'],
+                'OK' if result['ok'] else 'FAILED',
+                result['backup'] or '',
+                result['seconds']
+            ))
+        return '\n'.join(lines)
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+import logging
+from threading import Lock
+from time import time
+
+
+class ProgressReporter:
+    """
+    Progress of one job sent to a chat. Every transfer of the job reports here and at most one message goes out per
+    interval, a line per running transfer. Transfers that finished in between are folded into that message.
+    """
+    # Transfers hand their progress over at most this often
+    poll_interval = 1
+
+    def __init__(self, send, interval):
+        self.send = send
+        self.interval = interval
+        self.lock = Lock()
+        self.last_sent = time()
+        self.running = dict()
+        self.finished = []
+
+    def report(self, transfer, text, finished=False):
+        with self.lock:
+            if finished:
+                self.running.pop(transfer, None)
+                self.finished.append(text)
+            else:
+                self.running[transfer] = text
+            now = time()
+            if now - self.last_sent < self.interval:
+                return
+            self.last_sent = now
+            message = '\n'.join(['done ' + line for line in self.finished] + list(self.running.values()))
+            self.finished = []
+        # Outside the lock, a slow chat message must not stall the other transfers
+        try:
+            self.send(message)
+        except Exception:
+            logging.exception('Progress message failed')
+
+
+class TransferProgress:
+    log_interval = 10
+
+    def __init__(self, name, total=None, reporters=None):
+        self.name = name
+        self.total = total
+        self.done = 0
+        self.lock = Lock()
+        self.started = time()
+        self.last_sample = (self.started, 0)
+        self.instant_rate = 0.0
+        # ProgressReporter instances shared with the other transfers of the job
+        self.shared = reporters or []
+        # [callback, minimum seconds between calls, last call]
+        self.reporters = [[self._log, self.log_interval, self.started]]
+        for reporter in self.shared:
+            self.reporters.append([
+                lambda text, reporter=reporter: reporter.report(self, text),
+                reporter.poll_interval,
+                self.started
+            ])
+
+    @staticmethod
+    def _log(text):
+        logging.warning(text)
+
+    def update(self, transferred):
+        with self.lock:
+            self.done += transferred
+            due = self._sample()
+        self._report(due)
+
+    def set(self, done):
+        with self.lock:
+            self.done = done
+            due = self._sample()
+        self._report(due)
+
+    def _sample(self):
+        now = time()
+        sample_time, sample_done = self.last_sample
+        if now - sample_time >= 1:
+            self.instant_rate = (self.done - sample_done) / (now - sample_time)
+            self.last_sample = (now, self.done)
+        due = []
+        for reporter in self.reporters:
+            if now - reporter[2] >= reporter[1]:
+                reporter[2] = now
+                due.append(reporter[0])
+        return due
+
+    def _report(self, due):
+        # Outside the lock, a slow chat message must not stall the transfer threads
+        if not due:
+            return
+        text = self.describe()
+        for callback in due:
+            try:
+                callback(text)
+            except Exception:
+                logging.exception('Progress report for {} failed'.format(self.name))
+
+    def average_rate(self):
+        return self.done / max(time() - self.started, 0.001)
+
+    def eta(self):
+        rate = self.average_rate()
+        if not self.total or rate <= 0:
+            return None
+        return max(0, (self.total - self.done) / rate)
+
+    def describe(self):
+        eta = self.eta()
+        return '{}: {:.1f}{} MB{} at {:.2f} MB/s (avg {:.2f} MB/s){}'.format(
+            self.name,
+            self.done / 1000000,
+            ' of {:.1f}'.format(self.total / 1000000) if self.total else '',
+            ' ({:.1f}%)'.format(self.done * 100 / self.total) if self.total else '',
+            self.instant_rate / 1000000,
+            self.average_rate() / 1000000,
+            ', ETA {}s'.format(int(eta)) if eta is not None else ''
+        )
+
+    def finish(self):
+        # The log always gets the final line, the chat gets it with the next message of the job
+        with self.lock:
+            self.reporters[0][2] = 0
+            self._sample()
+        text = self.describe()
+        self._log(text)
+        for reporter in self.shared:
+            reporter.report(self, text, finished=True)
@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+# Small python3 programs run on the hypervisor through "python3 -c", nothing has to be installed there
+import json
+from shlex import quote
+
+extent_map = """
+import errno, json, os, sys
+fd = os.open(sys.argv[1], os.O_RDONLY)
+size = os.lseek(fd, 0, os.SEEK_END)
+extents = []
+offset = 0
+try:
+    while offset < size:
+        data = os.lseek(fd, offset, os.SEEK_DATA)
+        hole = os.lseek(fd, data, os.SEEK_HOLE)
+        extents.append([data, hole - data])
+        offset = hole
+except OSError as e:
+    # ENXIO means there is no data after offset
+    if e.errno != errno.ENXIO:
+        raise
+print(json.dumps({'size': size, 'extents': extents}))
+"""
+
+backup_listing = """
+import json, os, sys
+from xml.etree import ElementTree
+backups = []
+
+
+def owner(backup_path):
+    # VM the backup belongs to (VMdump.xml) and the backup an incremental one builds on (manifest.json)
+    vm = None
+    parent = None
+    try:
+        vm = ElementTree.parse(os.path.join(backup_path, 'VMdump.xml')).getroot().findtext('name')
+    except (OSError, ElementTree.ParseError):
+        pass
+    try:
+        with open(os.path.join(backup_path, 'manifest.json')) as manifest_fp:
+            parent = json.load(manifest_fp).get('parent_backup')
+    except (OSError, ValueError):
+        pass
+    return vm, parent
+
+
+for root in sys.argv[1:]:
+    try:
+        entries = sorted(os.scandir(root), key=lambda entry: entry.name)
+    except OSError:
+        continue
+    for entry in entries:
+        if not entry.name.startswith('backup-') or not entry.is_dir(follow_symlinks=False):
+            continue
+        size = 0
+        allocated = 0
+        files = 0
+        mtime = entry.stat().st_mtime
+        for directory, dirs, names in os.walk(entry.path):
+            for name in names:
+                file_stat = os.lstat(os.path.join(directory, name))
+                size += file_stat.st_size
+                allocated += file_stat.st_blocks * 512
+                files += 1
+                mtime = max(mtime, file_stat.st_mtime)
+        vm, parent = owner(entry.path)
+        backups.append({'name': entry.name, 'path': root, 'size': size, 'allocated': allocated, 'files': files,
+                        'mtime': mtime, 'vm': vm, 'parent': parent})
+print(json.dumps(backups))
+"""
+
+# Every snapshot of domain argv[2] through virsh -c argv[1]: parent, creation time, state, overlay files and size.
+# Internal snapshots are sized by the VM state qemu stored with them, external ones by their overlay files.
+snapshot_tree = """
+import json, os, subprocess, sys
+from xml.etree import ElementTree
+uri, domain = sys.argv[1], sys.argv[2]
+
+
+def run(*arguments):
+    return subprocess.check_output(list(arguments), universal_newlines=True)
+
+
+def virsh(*arguments):
+    return run('virsh', '-q', '-c', uri, *arguments)
+
+
+names = [line.strip() for line in virsh('snapshot-list', domain, '--name').splitlines() if line.strip()]
+try:
+    current = virsh('snapshot-current', domain, '--name').strip()
+except subprocess.CalledProcessError:
+    current = None
+state_sizes = dict()
+for line in virsh('domblklist', domain, '--details').splitlines():
+    fields = line.split()
+    if len(fields) == 4 and fields[0] == 'file' and fields[1] == 'disk':
+        try:
+            info = json.loads(run('qemu-img', 'info', '-U', '--output=json', fields[3]))
+        except (subprocess.CalledProcessError, ValueError):
+            continue
+        for snapshot in info.get('snapshots', []):
+            state_sizes[snapshot['name']] = state_sizes.get(snapshot['name'], 0) + snapshot.get('vm-state-size', 0)
+snapshots = []
+for name in names:
+    xml = ElementTree.fromstring(virsh('snapshot-dumpxml', domain, name))
+    files = [
+        disk.find('source').get('file') for disk in xml.findall('disks/disk')
+        if disk.get('snapshot') == 'external' and disk.find('source') is not None
+    ]
+    memory = xml.find('memory')
+    if memory is not None and memory.get('snapshot') == 'external' and memory.get('file'):
+        files.append(memory.get('file'))
+    size = 0
+    for file_name in files:
+        try:
+            size += os.stat(file_name).st_blocks * 512
+        except OSError:
+            pass
+    snapshots.append({
+        'name': name,
+        'parent': xml.findtext('parent/name'),
+        'created': int(xml.findtext('creationTime') or 0),
+        'state': xml.findtext('state'),
+        'external': bool(files),
+        'files': files,
+        'size': size if files else state_sizes.get(name, 0),
+        'current': name == current,
+    })
+print(json.dumps(snapshots))
+"""
+
+# Shared by the staging copy and the block hasher, same algorithm as checksums.BlockHasher
+block_hasher = """
+import errno, hashlib, json, os, sys
+
+
+class BlockHasher:
+    def __init__(self, block_size):
+        self.block_size = block_size
+        self.blocks = []
+        self.current = hashlib.sha256()
+        self.filled = 0
+        self.zero_block = None
+
+    def update(self, data):
+        view = memoryview(data)
+        while self.block_size and len(view):
+            take = min(len(view), self.block_size - self.filled)
+            self.current.update(view[:take])
+            self.filled += take
+            view = view[take:]
+            if self.filled == self.block_size:
+                self.blocks.append(self.current.hexdigest())
+                self.current = hashlib.sha256()
+                self.filled = 0
+
+    def zeros(self, length):
+        while self.block_size and length:
+            take = min(length, self.block_size - self.filled)
+            if self.filled == 0 and take == self.block_size:
+                if self.zero_block is None:
+                    zero_hash = hashlib.sha256()
+                    for offset in range(0, self.block_size, 1048576):
+                        zero_hash.update(bytes(min(1048576, self.block_size - offset)))
+                    self.zero_block = zero_hash.hexdigest()
+                self.blocks.append(self.zero_block)
+            else:
+                take = min(take, 1048576)
+                self.update(bytes(take))
+            length -= take
+
+    def finish(self):
+        if self.filled:
+            self.blocks.append(self.current.hexdigest())
+            self.filled = 0
+        return self.blocks
+
+
+def data_extents(fd, size):
+    extents = []
+    offset = 0
+    try:
+        while offset < size:
+            data = os.lseek(fd, offset, os.SEEK_DATA)
+            hole = os.lseek(fd, data, os.SEEK_HOLE)
+            extents.append((data, hole))
+            offset = hole
+    except OSError as e:
+        if e.errno == errno.EINVAL:
+            return [(0, size)]
+        if e.errno != errno.ENXIO:
+            raise
+    return extents
+"""
+
+# Copies only the data extents of argv[1] to argv[2] at no more than argv[3] bytes per second (0 is unlimited),
+# hashing every argv[4] bytes of the output (0 disables it). Without a filter command zero runs stay holes, like
+# cp --sparse=always. Otherwise the whole stream, holes as zeros, goes through the filter (e.g. zstd writing to
+# stdout) before reaching argv[2]. Prints "source -> destination" and then the block digests as JSON.
+stage_copy = block_hasher + """
+import subprocess, threading, time
+source, destination, command = sys.argv[1], sys.argv[2], sys.argv[5:]
+rate, block_size = int(sys.argv[3]), int(sys.argv[4])
+block = 1048576
+src = os.open(source, os.O_RDONLY)
+# Block devices have no st_size
+size = os.lseek(src, 0, os.SEEK_END)
+extents = data_extents(src, size)
+dst = os.open(destination, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+hasher = BlockHasher(block_size)
+
+
+def read_source(write, hole):
+    position = 0
+    copied = 0
+    started = time.time()
+    for start, end in extents + [(size, size)]:
+        if position < start:
+            hole(start - position)
+        offset = start
+        while offset < end:
+            chunk = os.pread(src, min(block, end - offset), offset)
+            if not chunk:
+                break
+            write(offset, chunk)
+            offset += len(chunk)
+            copied += len(chunk)
+            if rate:
+                delay = copied / rate - (time.time() - started)
+                if delay > 0:
+                    time.sleep(delay)
+        position = end
+
+
+if command:
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    failures = []
+
+    def write_zeros(length):
+        zeros = bytes(block)
+        while length:
+            length -= process.stdin.write(zeros[:min(block, length)])
+
+    def feed():
+        try:
+            read_source(lambda offset, data: process.stdin.write(data), write_zeros)
+        except Exception as e:
+            failures.append(e)
+        finally:
+            process.stdin.close()
+
+    feeder = threading.Thread(target=feed)
+    feeder.start()
+    while True:
+        data = process.stdout.read(block)
+        if not data:
+            break
+        os.write(dst, data)
+        hasher.update(data)
+    feeder.join()
+    if process.wait() != 0 or failures:
+        sys.stderr.write('{}\\n'.format(failures[0] if failures else 'filter failed'))
+        sys.exit(process.returncode or 1)
+else:
+    def write_file(offset, data):
+        hasher.update(data)
+        if data.count(0) != len(data):
+            os.pwrite(dst, data, offset)
+
+    read_source(write_file, hasher.zeros)
+    # Trailing holes, the file only grew up to the last data written so far
+    os.ftruncate(dst, size)
+os.fsync(dst)
+os.close(dst)
+print("{} -> {}".format(source, destination))
+if block_size:
+    print(json.dumps({'file': os.path.basename(destination), 'size': os.stat(destination).st_size,
+                      'blocks': hasher.finish()}))
+"""
+
+# Block digests of argv[1] with blocks of argv[2] bytes, whole hole blocks are never read
+block_hashes = block_hasher + """
+source, block_size = sys.argv[1], int(sys.argv[2])
+fd = os.open(source, os.O_RDONLY)
+size = os.lseek(fd, 0, os.SEEK_END)
+hasher = BlockHasher(block_size)
+position = 0
+for start, end in data_extents(fd, size) + [(size, size)]:
+    hasher.zeros(start - position)
+    for offset in range(start, end, 1048576):
+        hasher.update(os.pread(fd, min(1048576, end - offset), offset))
+    position = end
+print(json.dumps({'file': os.path.basename(source), 'size': size, 'blocks': hasher.finish()}))
+"""
+
+
+def build_command(script, *arguments):
+    return 'python3 -c {} {}'.format(quote(script), ' '.join([quote(str(argument)) for argument in arguments]))
+
+
+def block_digests(connection_manager, remote_file, block_size):
+    # (size, block digests) of a file on the hypervisor, FileNotFoundError when it is not there
+    stdin, stdout, ssh_stderr = connection_manager.exec_command(build_command(block_hashes, remote_file, block_size))
+    output = stdout.read()
+    if stdout.channel.recv_exit_status() != 0:
+        error = ssh_stderr.read().decode(errors='replace')
+        if 'FileNotFoundError' in error:
+            raise FileNotFoundError('{} not found'.format(remote_file))
+        raise OSError('Could not hash {}: {}'.format(remote_file, error))
+    digests = json.loads(output.decode())
+    return digests['size'], digests['blocks']
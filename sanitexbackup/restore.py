@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+# Puts a retrieved backup back on the hypervisor. Images go up over several SFTP channels, are checked against
+# checksums.json on arrival, turned back into plain images when they were compressed or part of an incremental
+# chain, and the domain is defined again from VMdump.xml.
+import json
+import logging
+from os import path
+from shlex import quote
+from time import time
+from xml.dom import minidom
+import libvirt
+from paramiko import SSHException
+from .checkpoint_backup import CheckpointBackup
+from .chunk_store import ChunkStore
+from . import checksums
+from . import compression
+from . import remote_helpers
+from .transfer import UploadEngine
+
+
+class RestoreError(Exception):
+    pass
+
+
+class RestoreBackup:
+    restore_suffix = '.sanitex-restore'
+    work_prefix = '.restore-'
+    # qemu-img coroutines writing the converted image out of order
+    convert_coroutines = 8
+
+    def __init__(self, connection_manager, libvirt_connection, local_path, remote_path, chunk_store_path,
+                 channels=None, path_map=None, progress_reporters=None, connection=None):
+        self.connection_manager = connection_manager
+        # Configuration of the VM being restored, its upload rates apply
+        self.connection = connection
+        self.libvirt_connection = libvirt_connection
+        self.local_path = local_path
+        self.remote_path = remote_path
+        self.chunk_store_path = chunk_store_path
+        self.channels = channels
+        # {old directory: new directory} applied to every image path of the domain
+        self.path_map = path_map or dict()
+        self.progress_reporters = progress_reporters
+        self.manifests = dict()
+
+    def _run(self, command):
+        try:
+            stdin, stdout, ssh_stderr = self.connection_manager.exec_command(command)
+            output = stdout.read().decode(errors='replace')
+            exit_status = stdout.channel.recv_exit_status()
+            error = ssh_stderr.read().decode(errors='replace')
+        except SSHException as e:
+            raise RestoreError('SSH error: {}'.format(e))
+        if exit_status != 0:
+            raise RestoreError('{} failed: {}'.format(command, error.strip()))
+        return output
+
+    def _remote_exists(self, remote_file):
+        with self.connection_manager.sftp() as ftp:
+            try:
+                ftp.stat(remote_file)
+            except FileNotFoundError:
+                return False
+        return True
+
+    @staticmethod
+    def _disks(xml):
+        disks = []
+        for disk in xml.getElementsByTagName('disk'):
+            if disk.getAttribute('device') != 'disk':
+                continue
+            sources = [node for node in disk.childNodes if node.nodeName == 'source']
+            targets = disk.getElementsByTagName('target')
+            drivers = disk.getElementsByTagName('driver')
+            if not sources or not targets:
+                continue
+            attribute = 'file' if sources[0].getAttribute('file') else 'dev'
+            if not sources[0].getAttribute(attribute):
+                continue
+            disks.append({
+                'node': sources[0],
+                'attribute': attribute,
+                'source': sources[0].getAttribute(attribute),
+                'target': targets[0].getAttribute('dev'),
+                'format': drivers[0].getAttribute('type') if drivers and drivers[0].getAttribute('type') else 'raw',
+            })
+        return disks
+
+    def _remap(self, source):
+        # Longest matching directory wins
+        for old in sorted(self.path_map, key=len, reverse=True):
+            prefix = old.rstrip('/') + '/'
+            if source.startswith(prefix):
+                return self.path_map[old].rstrip('/') + '/' + source[len(prefix):]
+        return source
+
+    def _destination(self, disk, new_name):
+        destination = self._remap(disk['source'])
+        if destination == disk['source'] and new_name:
+            if disk['attribute'] == 'dev':
+                raise RestoreError('{} is a device, restoring it under a new name needs restore_path_map'.format(
+                    disk['source']
+                ))
+            # Next to the original, the original itself may still be in use
+            destination = '{}/{}-{}'.format(path.dirname(destination), new_name, path.basename(destination))
+        return destination
+
+    def _local_manifest(self, backup_dir, manifest_name):
+        manifest_path = path.join(self.local_path, backup_dir, manifest_name)
+        if not path.isfile(manifest_path):
+            return None
+        with open(manifest_path, 'r') as manifest_fp:
+            return json.load(manifest_fp)
+
+    def _checksums(self, backup_dir):
+        if backup_dir not in self.manifests:
+            self.manifests[backup_dir] = self._local_manifest(backup_dir, checksums.manifest_name)
+        return self.manifests[backup_dir]
+
+    def _chain(self, backup_name, target):
+        # [(backup dir, file)] from the full backup up to backup_name, None for backups without checkpoints
+        manifest = self._local_manifest(backup_name, CheckpointBackup.manifest_name)
+        if manifest is None:
+            return None
+        chain = []
+        backup_dir = backup_name
+        while manifest is not None:
+            disks = [disk for disk in manifest['disks'] if disk['target'] == target]
+            if not disks:
+                raise RestoreError('{} has no copy of disk {}'.format(backup_dir, target))
+            chain.insert(0, (backup_dir, disks[0]['file']))
+            backup_dir = manifest.get('parent_backup')
+            if not backup_dir:
+                return chain
+            manifest = self._local_manifest(backup_dir, CheckpointBackup.manifest_name)
+            if manifest is None:
+                raise RestoreError('{} depends on {}, retrieve it first'.format(backup_name, backup_dir))
+
+    def _local_file(self, backup_dir, file_name):
+        file_path = path.join(self.local_path, backup_dir, file_name)
+        if path.isfile(file_path):
+            return file_name, file_path, False
+        if path.isfile(ChunkStore.manifest_for(file_path)):
+            return file_name, ChunkStore.manifest_for(file_path), True
+        return None
+
+    def _image_file(self, backup_name, disk):
+        # Staged copies are named after the image, compressed ones carry the zstd suffix
+        for file_name in (path.basename(disk['source']), compression.compressed_name(disk['source'])):
+            local_file = self._local_file(backup_name, file_name)
+            if local_file is not None:
+                return local_file
+        raise RestoreError('{} has no copy of {}'.format(backup_name, disk['source']))
+
+    def _upload(self, engine, backup_dir, local_file, remote_file, trace, sparse=True):
+        file_name, local_path, chunked = local_file
+        started = time()
+        if chunked:
+            chunk_store = ChunkStore(self.chunk_store_path)
+            try:
+                transferred, elapsed = engine.upload_chunks(chunk_store, local_path, remote_file, sparse)
+            finally:
+                chunk_store.close()
+        else:
+            transferred, elapsed = engine.upload(local_path, remote_file, sparse)
+        trace.add_span('upload', started, elapsed, transferred, file_name)
+        line = '{}: {}'.format(file_name, engine.format_rate(transferred, elapsed))
+        return transferred, line + ', ' + self._verify(backup_dir, file_name, remote_file, trace)
+
+    def _verify(self, backup_dir, file_name, remote_file, trace):
+        manifest = self._checksums(backup_dir)
+        if manifest is None or file_name not in manifest['files']:
+            return 'no checksums to verify'
+        with trace.span('verify', file_name):
+            try:
+                size, block_digests = remote_helpers.block_digests(
+                    self.connection_manager,
+                    remote_file,
+                    manifest['block_size']
+                )
+            except (OSError, ValueError) as e:
+                raise RestoreError('Could not verify {}: {}'.format(remote_file, e))
+        bad = checksums.mismatched_blocks(manifest['files'][file_name], size, block_digests)
+        if bad:
+            raise RestoreError('{} does not match its checksums, {} blocks differ'.format(remote_file, len(bad)))
+        return 'verified'
+
+    def _restore_disk(self, engine, backup_name, disk, destination, work_dir, trace):
+        device = disk['attribute'] == 'dev'
+        # Files are replaced in one rename once they are complete, devices are written in place
+        output = destination if device else destination + self.restore_suffix
+        out = []
+        transferred = 0
+        if not device:
+            self._run('mkdir -p {}'.format(quote(path.dirname(destination))))
+        chain = self._chain(backup_name, disk['target'])
+        if chain is not None:
+            for backup_dir, file_name in chain:
+                local_file = self._local_file(backup_dir, file_name)
+                if local_file is None:
+                    raise RestoreError('{} is missing {}'.format(backup_dir, file_name))
+                # Same layout as on the staging path, the relative backing files resolve again
+                self._run('mkdir -p {}'.format(quote(work_dir + '/' + backup_dir)))
+                remote_file = '{}/{}/{}'.format(work_dir, backup_dir, file_name)
+                uploaded, line = self._upload(engine, backup_dir, local_file, remote_file, trace)
+                transferred += uploaded
+                out.append(line)
+            with trace.span('convert', disk['target']):
+                self._run('qemu-img convert -q -W -m {} {}-O {} {} {}'.format(
+                    self.convert_coroutines,
+                    '-n ' if device else '',
+                    disk['format'],
+                    quote('{}/{}/{}'.format(work_dir, chain[-1][0], chain[-1][1])),
+                    quote(output)
+                ))
+            out.append('{}: converted from a chain of {} backups'.format(disk['target'], len(chain)))
+        else:
+            local_file = self._image_file(backup_name, disk)
+            if compression.is_compressed(local_file[0]):
+                # Compressed copies travel compressed and are expanded next to their destination
+                remote_file = work_dir + '/' + local_file[0]
+                uploaded, line = self._upload(engine, backup_name, local_file, remote_file, trace)
+                with trace.span('decompress', local_file[0]):
+                    self._run('zstd -q -d -c {}{} > {}'.format(
+                        '' if device else '--sparse ',
+                        quote(remote_file),
+                        quote(output)
+                    ))
+            else:
+                uploaded, line = self._upload(engine, backup_name, local_file, output, trace, sparse=not device)
+            transferred += uploaded
+            out.append(line)
+        if not device:
+            self._run('mv -f {} {}'.format(quote(output), quote(destination)))
+        return transferred, out
+
+    def _define(self, xml, disks, destinations, new_name):
+        for disk in disks:
+            disk['node'].setAttribute(disk['attribute'], destinations[disk['source']])
+        if new_name:
+            xml.getElementsByTagName('name')[0].firstChild.nodeValue = new_name
+            # A copy next to the original needs its own identity, libvirt generates new ones
+            for node_name in ('uuid', 'mac'):
+                for node in xml.getElementsByTagName(node_name):
+                    node.parentNode.removeChild(node)
+        try:
+            self.libvirt_connection.defineXML(xml.documentElement.toxml())
+        except libvirt.libvirtError as e:
+            raise RestoreError('Could not define the domain: {}'.format(e))
+
+    def run(self, backup_name, trace, new_name=None):
+        started = time()
+        xml_path = path.join(self.local_path, backup_name, 'VMdump.xml')
+        if not path.isfile(xml_path):
+            raise RestoreError('{} has no VMdump.xml, retrieve it first'.format(backup_name))
+        xml = minidom.parse(xml_path)
+        name = new_name or xml.getElementsByTagName('name')[0].firstChild.nodeValue
+        try:
+            existing = self.libvirt_connection.lookupByName(name)
+        except libvirt.libvirtError:
+            existing = None
+        if existing is not None and new_name:
+            raise RestoreError('A domain called {} already exists'.format(name))
+        if existing is not None and existing.isActive() == 1:
+            raise RestoreError('{} is running, shut it down or restore it under a new name'.format(name))
+        disks = self._disks(xml)
+        destinations = dict([(disk['source'], self._destination(disk, new_name)) for disk in disks])
+        for disk in disks:
+            destination = destinations[disk['source']]
+            # Only an in place restore may overwrite images
+            if destination != disk['source'] and disk['attribute'] == 'file' and self._remote_exists(destination):
+                raise RestoreError('{} already exists'.format(destination))
+        work_dir = '{}/{}{}'.format(self.remote_path, self.work_prefix, backup_name)
+        engine = UploadEngine(self.connection_manager, self.channels, self.progress_reporters, self.connection)
+        out = []
+        transferred = 0
+        try:
+            self._run('mkdir -p {}'.format(quote(work_dir)))
+            for disk in disks:
+                logging.warning('Restoring {} to {}'.format(disk['target'], destinations[disk['source']]))
+                uploaded, lines = self._restore_disk(
+                    engine,
+                    backup_name,
+                    disk,
+                    destinations[disk['source']],
+                    work_dir,
+                    trace
+                )
+                transferred += uploaded
+                out.extend(lines)
+        except (OSError, SSHException) as e:
+            raise RestoreError('Upload failed: {}'.format(e))
+        finally:
+            engine.close()
+            # Partial images of a failed restore go too, complete ones were already renamed
+            leftovers = [work_dir] + [
+                destinations[disk['source']] + self.restore_suffix for disk in disks if disk['attribute'] == 'file'
+            ]
+            try:
+                self._run('rm -rf {}'.format(' '.join([quote(leftover) for leftover in leftovers])))
+            except RestoreError as e:
+                logging.warning('Could not clean up after the restore: {}'.format(e))
+        with trace.span('define'):
+            self._define(xml, disks, destinations, new_name)
+        elapsed = time() - started
+        out.append('Restored {} as {} (defined, not started) in {:.1f}s, {}'.format(
+            backup_name,
+            name,
+            elapsed,
+            engine.format_rate(transferred, elapsed)
+        ))
+        return out
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+# Grandfather-father-son retention: the newest backups, plus the newest backup of each of the last days, weeks,
+# months and years. Backups kept by a rule keep the parents their incremental chain needs.
+from datetime import datetime
+
+# (policy key, period of a timestamp), keep_last counts every backup as a period of its own
+rules = [
+    ('keep_last', None),
+    ('daily', lambda created: datetime.fromtimestamp(created).strftime('%Y-%m-%d')),
+    ('weekly', lambda created: datetime.fromtimestamp(created).isocalendar()[:2]),
+    ('monthly', lambda created: datetime.fromtimestamp(created).strftime('%Y-%m')),
+    ('yearly', lambda created: datetime.fromtimestamp(created).year),
+]
+
+
+def is_configured(policy):
+    # Without a single positive count every backup would go, that is never what an empty policy means
+    return bool(policy) and any([int(policy.get(rule) or 0) > 0 for rule, period in rules])
+
+
+def select(backups, policy, parents=None, pinned=None):
+    """
+    backups: dicts with at least name and created, parents: {name: parent name} of incremental backups, pinned:
+    {name: reason} of backups kept whatever the policy says. Returns ({name: [why it is kept]}, [backups to delete,
+    oldest first]) in a single pass over every rule.
+    """
+    parents = parents or dict()
+    newest_first = sorted(backups, key=lambda item: item['created'], reverse=True)
+    names = set([backup['name'] for backup in backups])
+    keep = dict([(name, [reason]) for name, reason in (pinned or dict()).items() if name in names])
+    for rule, period in rules:
+        count = int(policy.get(rule) or 0)
+        kept = 0
+        last_period = None
+        for backup in newest_first:
+            if kept >= count:
+                break
+            current_period = backup['name'] if period is None else period(backup['created'])
+            if current_period == last_period:
+                continue
+            last_period = current_period
+            keep.setdefault(backup['name'], []).append(rule)
+            kept += 1
+    for name in list(keep):
+        parent = parents.get(name)
+        seen = set([name])
+        while parent in names and parent not in seen:
+            keep.setdefault(parent, []).append('parent of ' + name)
+            seen.add(parent)
+            parent = parents.get(parent)
+    return keep, [backup for backup in reversed(newest_first) if backup['name'] not in keep]
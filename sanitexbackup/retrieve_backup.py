@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
 import logging
 from os import path, mkdir
-from scp import SCPClient, SCPException
-from paramiko import SSHClient, SSHException, AutoAddPolicy
+from stat import S_ISDIR
+from paramiko import SSHException
+from .connection_manager import ConnectionManager
+from .transfer import DownloadEngine
 
 
 class RetrieveBackup:
@@ -42,29 +44,19 @@ class RetrieveBackup:
                 return False
         except KeyError as e:
             logging.critical('Error while reading key: {}'.format(e))
-        if 'port' in self.connection:
-            ssh_port = self.connection['port']
-        else:
-            ssh_port = 22
-        ssh = SSHClient()
-        ssh.set_missing_host_key_policy(AutoAddPolicy())
-        ssh.load_host_keys(filename=path.join(path.expanduser('~'), '.ssh', 'known_hosts'))
+        engine = DownloadEngine(
+            ConnectionManager.for_connection(self.connection),
+            channels=self.connection.get('download_channels'),
+            connection=self.connection
+        )
         try:
-            ssh.connect(
-                hostname=self.connection['host'],
-                username=self.connection['user'],
-                port=ssh_port,
-                key_filename=self.connection['keyfile'],
-            )
-        except SSHException as e:
-            logging.critical('SSH Failed: {}'.format(e))
-            ssh.close()
-            return False
-        try:
-            with SCPClient(ssh.get_transport()) as scp:
-                scp.get(self.remote_path, self.local_path)
+            if S_ISDIR(engine.sftp().stat(self.remote_path).st_mode):
+                engine.download_directory(self.remote_path, self.local_path)
+            else:
+                engine.download(self.remote_path, path.join(self.local_path, path.basename(self.remote_path)))
             return True
-        except SCPException as e:
+        except (SSHException, OSError) as e:
             logging.critical("Failed to retrieve backup: {}".format(e))
-            ssh.close()
             return False
+        finally:
+            engine.close()
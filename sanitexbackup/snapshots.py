@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+# Snapshots of a domain as one tree: listed in a single round trip, pruned by retention rules and deleted in bulk.
+# External snapshots leave overlay chains behind that slow down the guest, consolidate() merges them again.
+import json
+import logging
+from fnmatch import fnmatch
+from shlex import quote
+from time import sleep, time
+from xml.dom import minidom
+import libvirt
+from paramiko import SSHException
+from .live_snapshot import wait_for_block_job
+from . import remote_helpers
+
+
+class SnapshotManager:
+    listing_ttl = 300
+    # virsh runs on the hypervisor itself
+    virsh_uri = 'qemu:///system'
+    sleep_time = 1
+
+    def __init__(self, vm, connection_manager, listing_ttl=None, virsh_uri=None):
+        self.vm = vm
+        self.connection_manager = connection_manager
+        if listing_ttl is not None:
+            self.listing_ttl = listing_ttl
+        if virsh_uri:
+            self.virsh_uri = virsh_uri
+
+    def _remote_tree(self):
+        stdin, stdout, ssh_stderr = self.connection_manager.exec_command(
+            remote_helpers.build_command(remote_helpers.snapshot_tree, self.virsh_uri, self.vm.name())
+        )
+        output = stdout.read()
+        if stdout.channel.recv_exit_status() != 0:
+            logging.warning('Could not list snapshots on the hypervisor: {}'.format(
+                ssh_stderr.read().decode(errors='replace').strip()
+            ))
+            return None
+        return json.loads(output.decode())
+
+    def _libvirt_tree(self):
+        # One round trip per snapshot and no sizes, only used when the hypervisor can not run the helper
+        try:
+            current = self.vm.snapshotCurrent().getName()
+        except libvirt.libvirtError:
+            current = None
+        snapshots = []
+        for snapshot in self.vm.listAllSnapshots():
+            xml = minidom.parseString(snapshot.getXMLDesc())
+            parents = xml.getElementsByTagName('parent')
+            creation_time = xml.getElementsByTagName('creationTime')
+            state = xml.getElementsByTagName('state')
+            files = [
+                disk.getElementsByTagName('source')[0].getAttribute('file')
+                for disk in xml.getElementsByTagName('disk')
+                if disk.getAttribute('snapshot') == 'external' and disk.getElementsByTagName('source')
+            ]
+            snapshots.append({
+                'name': snapshot.getName(),
+                'parent': parents[0].getElementsByTagName('name')[0].firstChild.nodeValue if parents else None,
+                'created': int(creation_time[0].firstChild.nodeValue) if creation_time else 0,
+                'state': state[0].firstChild.nodeValue if state else None,
+                'external': bool(files),
+                'files': files,
+                'size': None,
+                'current': snapshot.getName() == current,
+            })
+        return snapshots
+
+    def tree(self, refresh=False):
+        """
+        Every snapshot as a dict with name, parent, created, state, external, files, size and current. Cached per
+        host for listing_ttl seconds, anything changing snapshots through this class invalidates it.
+        """
+        key = ('snapshots', self.vm.name())
+        if not refresh:
+            cached = self.connection_manager.cache_get(key, self.listing_ttl)
+            if cached is not None:
+                return cached
+        try:
+            snapshots = self._remote_tree()
+        except (SSHException, ValueError) as e:
+            logging.warning('Could not list snapshots on the hypervisor: {}'.format(e))
+            snapshots = None
+        if snapshots is None:
+            snapshots = self._libvirt_tree()
+        self.connection_manager.cache_put(key, snapshots)
+        return snapshots
+
+    def invalidate(self):
+        self.connection_manager.invalidate('snapshots')
+
+    @staticmethod
+    def walk(snapshots):
+        # (depth, snapshot) pairs, parents before their children, oldest first
+        children = dict()
+        names = set([snapshot['name'] for snapshot in snapshots])
+        for snapshot in sorted(snapshots, key=lambda item: item['created']):
+            parent = snapshot['parent'] if snapshot['parent'] in names else None
+            children.setdefault(parent, []).append(snapshot)
+        ordered = []
+        stack = [(0, snapshot) for snapshot in reversed(children.get(None, []))]
+        while stack:
+            depth, snapshot = stack.pop()
+            ordered.append((depth, snapshot))
+            stack.extend([(depth + 1, child) for child in reversed(children.get(snapshot['name'], []))])
+        return ordered
+
+    @staticmethod
+    def expired(snapshots, keep_last=None, max_age_days=None, match='*', now=None):
+        """
+        Snapshots the retention rules give up: of those whose name matches, everything past the newest keep_last
+        that is also older than max_age_days. Without either rule nothing expires.
+        """
+        if not keep_last and not max_age_days:
+            return []
+        now = now or time()
+        candidates = sorted(
+            [snapshot for snapshot in snapshots if fnmatch(snapshot['name'], match)],
+            key=lambda item: item['created'],
+            reverse=True
+        )
+        if keep_last:
+            candidates = candidates[int(keep_last):]
+        if max_age_days:
+            candidates = [
+                snapshot for snapshot in candidates if now - snapshot['created'] > float(max_age_days) * 86400
+            ]
+        return candidates
+
+    def delete(self, names):
+        """
+        Deletes the named snapshots, returns {name: None or why it was kept}. A snapshot going together with all of
+        its descendants is deleted with them in one call. External snapshots stay until consolidate() merged them.
+        """
+        snapshots = dict([(snapshot['name'], snapshot) for snapshot in self.tree(refresh=True)])
+        results = dict([(name, 'not found') for name in names if name not in snapshots])
+        doomed = set([name for name in names if name in snapshots])
+        children = dict()
+        for snapshot in snapshots.values():
+            children.setdefault(snapshot['parent'], []).append(snapshot['name'])
+
+        def descendants(name):
+            found = set()
+            stack = list(children.get(name, []))
+            while stack:
+                child = stack.pop()
+                found.add(child)
+                stack.extend(children.get(child, []))
+            return found
+
+        deleted = set()
+        for depth, snapshot in self.walk(list(snapshots.values())):
+            name = snapshot['name']
+            if name not in doomed or name in deleted:
+                continue
+            if snapshot['external']:
+                results[name] = 'external, consolidate the disks first'
+                continue
+            below = descendants(name)
+            whole = below and below <= doomed and not [child for child in below if snapshots[child]['external']]
+            try:
+                self.vm.snapshotLookupByName(name).delete(libvirt.VIR_DOMAIN_SNAPSHOT_DELETE_CHILDREN if whole else 0)
+            except libvirt.libvirtError as e:
+                results[name] = str(e)
+                continue
+            for gone in [name] + (sorted(below) if whole else []):
+                results[gone] = None
+                deleted.add(gone)
+        self.invalidate()
+        return results
+
+    def _disk_chains(self):
+        # {target: [active image, ..., base image]} as the running domain sees them
+        xml = minidom.parseString(self.vm.XMLDesc(0))
+        chains = dict()
+        for disk in xml.getElementsByTagName('disk'):
+            if disk.getAttribute('device') != 'disk' or not disk.getElementsByTagName('target'):
+                continue
+            files = []
+            node = disk
+            while node is not None:
+                sources = [child for child in node.childNodes if child.nodeName == 'source']
+                if not sources or not sources[0].getAttribute('file'):
+                    break
+                files.append(sources[0].getAttribute('file'))
+                stores = [child for child in node.childNodes if child.nodeName == 'backingStore']
+                node = stores[0] if stores else None
+            chains[disk.getElementsByTagName('target')[0].getAttribute('dev')] = files
+        return chains
+
+    def _wait_for_pull(self, target):
+        # Pulls finish on their own, the job is gone once the active image holds the data
+        while self.vm.blockJobInfo(target, 0):
+            sleep(self.sleep_time)
+
+    def consolidate(self, mode='commit'):
+        """
+        Flattens the overlays external snapshots stacked on every disk of the running domain, down to the image the
+        first of them was taken from. Images below it may be shared templates and are never written. commit merges
+        the overlays into that image and removes them, pull copies their data up into the active image and leaves
+        them in place. Snapshots whose overlays left the chain lose their metadata.
+        """
+        if self.vm.isActive() != 1:
+            return ['{} is not running, block jobs need the VM running'.format(self.vm.name())]
+        snapshot_files = set([
+            file_name for snapshot in self.tree(refresh=True) if snapshot['external'] for file_name in snapshot['files']
+        ])
+        out = []
+        released = []
+        for target, files in sorted(self._disk_chains().items()):
+            overlays = [index for index, file_name in enumerate(files) if file_name in snapshot_files]
+            if not overlays or max(overlays) + 1 >= len(files):
+                continue
+            base = files[max(overlays) + 1]
+            started = time()
+            try:
+                if mode == 'pull':
+                    self.vm.blockRebase(target, base, 0, 0)
+                    self._wait_for_pull(target)
+                else:
+                    self.vm.blockCommit(target, base, None, 0, libvirt.VIR_DOMAIN_BLOCK_COMMIT_ACTIVE)
+                    if not wait_for_block_job(self.vm, target, self.sleep_time):
+                        out.append('{}: commit job vanished before pivot'.format(target))
+                        continue
+                    self.vm.blockJobAbort(target, libvirt.VIR_DOMAIN_BLOCK_JOB_ABORT_PIVOT)
+            except libvirt.libvirtError as e:
+                logging.critical('Could not {} {}: {}'.format(mode, target, e))
+                out.append('{}: {} failed: {}'.format(target, mode, e))
+                continue
+            remaining = self._disk_chains().get(target, [])
+            merged = [file_name for file_name in files[:max(overlays) + 1] if file_name not in remaining]
+            released.extend(merged)
+            out.append('{}: {} overlays merged by {} in {:.1f}s'.format(target, len(merged), mode, time() - started))
+        if not out:
+            return ['No disk of {} runs on snapshot overlays'.format(self.vm.name())]
+        if released:
+            for snapshot in self.tree(refresh=True):
+                if snapshot['external'] and set(snapshot['files']) & set(released):
+                    try:
+                        self.vm.snapshotLookupByName(snapshot['name']).delete(
+                            libvirt.VIR_DOMAIN_SNAPSHOT_DELETE_METADATA_ONLY
+                        )
+                        out.append('Snapshot {} merged away'.format(snapshot['name']))
+                    except libvirt.libvirtError as e:
+                        out.append('Snapshot {} kept: {}'.format(snapshot['name'], e))
+            if mode == 'pull':
+                out.append('No longer used by {}: {}'.format(self.vm.name(), ', '.join(released)))
+            else:
+                try:
+                    stdin, stdout, ssh_stderr = self.connection_manager.exec_command('rm -f {}'.format(
+                        ' '.join([quote(file_name) for file_name in released])
+                    ))
+                    stdout.channel.recv_exit_status()
+                except SSHException as e:
+                    out.append('Could not remove merged overlays: {}'.format(e))
+        self.invalidate()
+        return out
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+# Ways of getting a consistent copy of the images of a stopped VM. Copy-on-write strategies only need the guest down
+# for an instant clone, the data is copied out of the clone once the guest runs again.
+import logging
+from abc import ABC, abstractmethod
+from os import path
+from shlex import quote
+from paramiko import SSHException
+
+
+class StagingStrategy(ABC):
+    name = None
+    # The frozen sources stay consistent after the guest starts again
+    releases_early = True
+    # freeze() already left the final staged files in place, nothing has to be copied afterwards
+    in_place = False
+
+    def __init__(self, connection_manager, staging_path):
+        self.connection_manager = connection_manager
+        self.staging_path = staging_path
+        self.frozen = dict()
+
+    def _run(self, command):
+        try:
+            stdin, stdout, ssh_stderr = self.connection_manager.exec_command(command)
+            output = stdout.read().decode(errors='replace')
+            exit_status = stdout.channel.recv_exit_status()
+            error = ssh_stderr.read().decode(errors='replace')
+        except SSHException as e:
+            logging.warning('{} staging: {}'.format(self.name, e))
+            return False, ''
+        if exit_status != 0:
+            logging.info('{} staging: {} failed: {}'.format(self.name, command, error.strip()))
+            return False, output
+        return True, output
+
+    @abstractmethod
+    def probe(self, images):
+        pass
+
+    @abstractmethod
+    def freeze(self, images, backup_dir, in_place=False):
+        # Returns {image: frozen source}, or None when nothing was frozen
+        pass
+
+    def release(self):
+        self.frozen = dict()
+
+
+class CopyStrategy(StagingStrategy):
+    name = 'copy'
+    releases_early = False
+
+    def probe(self, images):
+        return True
+
+    def freeze(self, images, backup_dir, in_place=False):
+        # The images themselves, the guest has to stay down while they are copied
+        self.frozen = dict([(image, image) for image in images])
+        return self.frozen
+
+
+class ReflinkStrategy(StagingStrategy):
+    name = 'reflink'
+    clone_suffix = '.sanitex-clone'
+
+    def probe(self, images):
+        # Clones only work inside one filesystem that supports them (btrfs, XFS with reflink=1)
+        probe_file = '{}/.sanitex-reflink-probe'.format(self.staging_path)
+        ok, output = self._run('touch {0} && cp --reflink=always {0} {0}.clone; status=$?; rm -f {0} {0}.clone; '
+                               'exit $status'.format(quote(probe_file)))
+        if not ok:
+            return False
+        ok, output = self._run('stat -L -c %d {} {}'.format(
+            quote(self.staging_path),
+            ' '.join([quote(image) for image in images])
+        ))
+        return ok and len(set(output.split())) == 1
+
+    def freeze(self, images, backup_dir, in_place=False):
+        # In place clones are the staged files, the others are hidden in the staging root until they are copied
+        if in_place:
+            frozen = dict([
+                (image, '{}/{}/{}'.format(self.staging_path, backup_dir, path.basename(image))) for image in images
+            ])
+        else:
+            frozen = dict([
+                (image, '{}/.{}-{}{}'.format(self.staging_path, backup_dir, path.basename(image), self.clone_suffix))
+                for image in images
+            ])
+        ok, output = self._run(' && '.join([
+            'cp --reflink=always {} {}'.format(quote(image), quote(clone)) for image, clone in frozen.items()
+        ]))
+        if not ok:
+            self._run('rm -f {}'.format(' '.join([quote(clone) for clone in frozen.values()])))
+            return None
+        self.in_place = in_place
+        self.frozen = frozen
+        return frozen
+
+    def release(self):
+        if self.frozen and not self.in_place:
+            self._run('rm -f {}'.format(' '.join([quote(clone) for clone in self.frozen.values()])))
+        self.frozen = dict()
+
+
+class ZfsStrategy(StagingStrategy):
+    name = 'zfs'
+
+    def __init__(self, connection_manager, staging_path):
+        super().__init__(connection_manager, staging_path)
+        # image: (dataset, mountpoint)
+        self.datasets = dict()
+        self.snapshot_name = None
+
+    def probe(self, images):
+        ok, output = self._run('for image in {}; do df --output=fstype,source,target "$image" | tail -n 1; done'.format(
+            ' '.join([quote(image) for image in images])
+        ))
+        if not ok:
+            return False
+        lines = output.split('\n')
+        datasets = dict()
+        for image, line in zip(images, lines):
+            fields = line.split()
+            if len(fields) != 3 or fields[0] != 'zfs':
+                return False
+            datasets[image] = (fields[1], fields[2])
+        self.datasets = datasets
+        return len(datasets) == len(images)
+
+    def freeze(self, images, backup_dir, in_place=False):
+        if not self.datasets and not self.probe(images):
+            return None
+        self.snapshot_name = 'sanitex-' + backup_dir
+        # A single zfs snapshot command is atomic across datasets of the same pool
+        ok, output = self._run('zfs snapshot {}'.format(' '.join(sorted(set([
+            quote('{}@{}'.format(dataset, self.snapshot_name)) for dataset, mountpoint in self.datasets.values()
+        ])))))
+        if not ok:
+            return None
+        self.frozen = dict([
+            (image, '{}/.zfs/snapshot/{}/{}'.format(
+                mountpoint.rstrip('/'),
+                self.snapshot_name,
+                path.relpath(image, mountpoint)
+            ))
+            for image, (dataset, mountpoint) in self.datasets.items()
+        ])
+        return self.frozen
+
+    def release(self):
+        if self.frozen:
+            for dataset in sorted(set([dataset for dataset, mountpoint in self.datasets.values()])):
+                self._run('zfs destroy {}'.format(quote('{}@{}'.format(dataset, self.snapshot_name))))
+        self.frozen = dict()
+
+
+class LvmThinStrategy(StagingStrategy):
+    name = 'lvm-thin'
+
+    def __init__(self, connection_manager, staging_path):
+        super().__init__(connection_manager, staging_path)
+        # image: (volume group, logical volume)
+        self.volumes = dict()
+
+    def probe(self, images):
+        ok, output = self._run('lvs --noheadings --separator "|" -o vg_name,lv_name,lv_attr {}'.format(
+            ' '.join([quote(image) for image in images])
+        ))
+        if not ok:
+            return False
+        volumes = dict()
+        for image, line in zip(images, [line for line in output.split('\n') if line.strip()]):
+            fields = line.strip().split('|')
+            # Thin volumes have a "V" as first attribute
+            if len(fields) != 3 or not fields[2].startswith('V'):
+                return False
+            volumes[image] = (fields[0], fields[1])
+        self.volumes = volumes
+        return len(volumes) == len(images)
+
+    def _snapshot_for(self, lv_name, backup_dir):
+        return '{}-sanitex-{}'.format(lv_name, backup_dir)
+
+    def freeze(self, images, backup_dir, in_place=False):
+        if not self.volumes and not self.probe(images):
+            return None
+        frozen = dict()
+        for image, (vg_name, lv_name) in self.volumes.items():
+            snapshot = self._snapshot_for(lv_name, backup_dir)
+            # Thin snapshots skip activation by default, -kn -ay makes the device readable
+            ok, output = self._run('lvcreate -q -s -kn -ay -n {} {}'.format(
+                quote(snapshot),
+                quote('{}/{}'.format(vg_name, lv_name))
+            ))
+            if not ok:
+                self.frozen = frozen
+                self.release()
+                return None
+            frozen[image] = '/dev/{}/{}'.format(vg_name, snapshot)
+        self.frozen = frozen
+        return frozen
+
+    def release(self):
+        if self.frozen:
+            self._run('lvremove -q -f {}'.format(' '.join([
+                quote(source[len('/dev/'):]) for source in self.frozen.values()
+            ])))
+        self.frozen = dict()
+
+
+# Cheapest first
+strategies = [ReflinkStrategy, ZfsStrategy, LvmThinStrategy, CopyStrategy]
+
+
+def select_strategy(connection_manager, staging_path, images, wanted='auto'):
+    for strategy_class in strategies:
+        if wanted not in ('auto', strategy_class.name) and strategy_class is not CopyStrategy:
+            continue
+        strategy = strategy_class(connection_manager, staging_path)
+        if strategy.probe(images):
+            if wanted not in ('auto', strategy.name):
+                logging.warning('Staging strategy {} not available for these images'.format(wanted))
+            logging.warning('Staging strategy: {}'.format(strategy.name))
+            return strategy
+    return CopyStrategy(connection_manager, staging_path)
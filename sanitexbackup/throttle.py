@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+import logging
+from datetime import datetime
+from threading import Lock
+from time import sleep, time
+
+rate_units = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_rate(value):
+    # Bytes per second, "50M" style suffixes allowed. Empty or 0 means unlimited.
+    if not value:
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    text = str(value).strip().upper().rstrip('/S').rstrip('B')
+    unit = text[-1] if text and text[-1] in rate_units else ''
+    try:
+        rate = int(float(text[:len(text) - len(unit)]) * rate_units[unit])
+    except ValueError:
+        logging.warning('Ignoring invalid rate {}'.format(value))
+        return None
+    return rate or None
+
+
+def _in_window(window, now):
+    current = now.strftime('%H:%M')
+    start = window.get('from', '00:00')
+    end = window.get('to', '24:00')
+    if start <= end:
+        return start <= current < end
+    # Windows like 20:00 - 06:00 wrap around midnight
+    return current >= start or current < end
+
+
+def scheduled_rate(connection, key, now=None):
+    """
+    Rate configured for key right now. Entries of rate_schedule override the plain key while they are active:
+
+        download_rate: 0
+        rate_schedule:
+          - from: "08:00"
+            to: "20:00"
+            download_rate: 10M
+    """
+    now = now or datetime.now()
+    for window in connection.get('rate_schedule') or []:
+        if key in window and _in_window(window, now):
+            return parse_rate(window[key])
+    return parse_rate(connection.get(key))
+
+
+class TokenBucket:
+    # Burst allowed after an idle period, in seconds worth of the current rate
+    burst_seconds = 1.0
+
+    def __init__(self, rate=None):
+        # rate is called on every consume() so schedules take effect in the middle of a transfer
+        self.rate = rate
+        self.lock = Lock()
+        self.tokens = 0.0
+        self.updated = time()
+
+    def consume(self, amount, rate=None):
+        # A caller sharing the bucket can bring its own rate, the one of its configuration
+        rate = rate or self.rate
+        with self.lock:
+            rate = rate() if rate else None
+            now = time()
+            if not rate:
+                self.tokens = 0.0
+                self.updated = now
+                return 0.0
+            self.tokens = min(rate * self.burst_seconds, self.tokens + (now - self.updated) * rate)
+            self.updated = now
+            # Going into debt reserves the bytes, concurrent callers queue up behind it
+            self.tokens -= amount
+            delay = -self.tokens / rate if self.tokens < 0 else 0.0
+        if delay:
+            sleep(delay)
+        return delay
+
+    def is_limited(self):
+        return bool(self.rate and self.rate())
+
+
+class SharedBucket:
+    # One job's view of a bucket shared by several jobs: tokens are common, the rate is the job's own
+    def __init__(self, bucket, rate):
+        self.bucket = bucket
+        self.rate = rate
+
+    def consume(self, amount):
+        return self.bucket.consume(amount, self.rate)
+
+    def is_limited(self):
+        return bool(self.rate())
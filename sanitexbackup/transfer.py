@@ -0,0 +1,640 @@
+# -*- coding: utf-8 -*-
+import errno
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Empty
+from stat import S_ISBLK, S_ISDIR
+from threading import Lock
+from time import time
+from .progress import TransferProgress
+from .throttle import SharedBucket, TokenBucket, scheduled_rate
+from . import remote_helpers
+from . import checksums
+
+
+def local_extents(fd, size):
+    # [offset, length] of every data extent, the whole file where SEEK_DATA is not supported
+    extents = []
+    position = 0
+    while position < size:
+        try:
+            start = os.lseek(fd, position, os.SEEK_DATA)
+            end = os.lseek(fd, start, os.SEEK_HOLE)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                break
+            return [[0, size]]
+        extents.append([start, min(end, size) - start])
+        position = end
+    return extents
+
+
+def copy_sparse(source, destination):
+    # Holes of source stay holes, copy_file_range lets the filesystem share the blocks where it can
+    source_fd = os.open(source, os.O_RDONLY)
+    try:
+        destination_fd = os.open(destination, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            size = os.fstat(source_fd).st_size
+            for offset, length in local_extents(source_fd, size):
+                end = offset + length
+                while offset < end:
+                    if hasattr(os, 'copy_file_range'):
+                        copied = os.copy_file_range(source_fd, destination_fd, end - offset, offset, offset)
+                    else:
+                        copied = os.pwrite(
+                            destination_fd,
+                            os.pread(source_fd, min(checksums.read_size, end - offset), offset),
+                            offset
+                        )
+                    if not copied:
+                        break
+                    offset += copied
+            os.ftruncate(destination_fd, size)
+        finally:
+            os.close(destination_fd)
+    finally:
+        os.close(source_fd)
+
+
+class TransferEngine:
+    # SFTP sessions are borrowed from the connection manager pool, one per parallel channel
+    channels = 4
+    sessions = None
+
+    def __init__(self, connection_manager, channels=None, progress_reporters=None, connection=None):
+        self.connection_manager = connection_manager
+        # Configuration of the VM the transfer is for, the manager only holds the first one seen for the host
+        self.connection = connection if connection is not None else connection_manager.connection
+        # ProgressReporter instances of the job, receiving progress descriptions
+        self.progress_reporters = progress_reporters
+        if channels:
+            self.channels = max(1, int(channels))
+        self.sessions = []
+
+    def _open_sessions(self):
+        while len(self.sessions) < self.channels:
+            self.sessions.append(self.connection_manager.acquire_sftp())
+        return self.sessions
+
+    def sftp(self):
+        return self._open_sessions()[0]
+
+    def close(self):
+        for session in self.sessions:
+            self.connection_manager.release_sftp(session)
+        self.sessions = []
+
+    @staticmethod
+    def format_rate(transferred, elapsed):
+        return '{:.1f} MB in {:.1f}s ({:.2f} MB/s)'.format(
+            transferred / 1000000,
+            elapsed,
+            transferred / 1000000 / max(elapsed, 0.001)
+        )
+
+    def _buckets(self, host_bucket, rate_key):
+        # The host wide limit of the direction plus the limit of every single file
+        return (
+            SharedBucket(host_bucket, lambda: scheduled_rate(self.connection, rate_key)),
+            TokenBucket(lambda: scheduled_rate(self.connection, 'transfer_rate'))
+        )
+
+    def _remote_layout(self, remote_file):
+        # (size, data extents) as seen on the hypervisor, None when the helper can not run there
+        try:
+            stdin, stdout, ssh_stderr = self.connection_manager.exec_command(
+                remote_helpers.build_command(remote_helpers.extent_map, remote_file)
+            )
+            output = stdout.read()
+            if stdout.channel.recv_exit_status() == 0:
+                layout = json.loads(output.decode())
+                return layout['size'], layout['extents']
+            logging.warning('Could not map extents of {}: {}'.format(remote_file, ssh_stderr.read().decode()))
+        except ValueError as e:
+            logging.warning('Could not map extents of {}: {}'.format(remote_file, e))
+        return None
+
+
+class DownloadEngine(TransferEngine):
+    # Ranges handed to each worker, every range is requested as a pipelined batch of SFTP reads
+    block_size = 32 * 1024 * 1024
+    request_size = 32768
+    # Requests pipelined at once while a rate limit is active, 1 MiB
+    throttled_batch = 32
+    # Fetches of a block that keeps failing its checksum before giving up on the file
+    verify_attempts = 2
+    state_suffix = '.sanitex-state'
+    # The state is rewritten whole, every this many blocks or seconds. A dropped connection refetches the rest.
+    state_save_blocks = 16
+    state_save_interval = 5.0
+    delta_suffix = '.sanitex-delta'
+    # Granularity of delta retrieval, only blocks that differ from the previous copy are fetched
+    delta_block_size = 1024 * 1024
+
+    def __init__(self, connection_manager, channels=None, block_size=None, progress_reporters=None,
+                 record_digests=False, delta_block_size=None, connection=None):
+        super().__init__(connection_manager, channels, progress_reporters, connection)
+        if block_size:
+            self.block_size = int(block_size)
+        if delta_block_size:
+            self.delta_block_size = int(delta_block_size)
+        # Block digests of every downloaded file, by local path, for sources nobody hashed before
+        self.record_digests = record_digests
+        self.recorded_digests = dict()
+
+    def _remote_extents(self, remote_file, size):
+        # Small files are not worth the extra round trip
+        if size <= self.block_size:
+            return [[0, size]]
+        layout = self._remote_layout(remote_file)
+        if layout is None:
+            return [[0, size]]
+        return layout[1]
+
+    def _blocks(self, size, extents):
+        # Every block carries the data extents that fall inside it, holes are never requested
+        blocks = []
+        for block_offset in range(0, size, self.block_size):
+            block_end = min(block_offset + self.block_size, size)
+            pieces = []
+            for extent_offset, extent_length in extents:
+                start = max(block_offset, extent_offset)
+                end = min(block_end, extent_offset + extent_length)
+                if start < end:
+                    pieces.append((start, end - start))
+            blocks.append((block_offset, block_end, pieces))
+        return blocks
+
+    @staticmethod
+    def _preallocate(fd, size, extents, fresh):
+        if fresh:
+            # Drop whatever an older copy left where the new one has holes
+            os.ftruncate(fd, 0)
+        os.ftruncate(fd, size)
+        if hasattr(os, 'posix_fallocate'):
+            try:
+                for extent_offset, extent_length in extents:
+                    os.posix_fallocate(fd, extent_offset, extent_length)
+            except OSError as e:
+                logging.debug('Could not preallocate local file: {}'.format(e))
+
+    def _fetch_block(self, remote_fp, fd, block, progress, buckets=(), digest=None):
+        # digest, when given, is fed the whole block in order, zeros where the pieces leave holes
+        block_offset, block_end, pieces = block
+        chunks = []
+        for offset, length in pieces:
+            chunks += [
+                (chunk_offset, min(self.request_size, offset + length - chunk_offset))
+                for chunk_offset in range(offset, offset + length, self.request_size)
+            ]
+        limited = [bucket for bucket in buckets if bucket.is_limited()]
+        batch_size = self.throttled_batch if limited else max(1, len(chunks))
+        transferred = 0
+        position = block_offset
+        for batch_start in range(0, len(chunks), batch_size):
+            batch = chunks[batch_start:batch_start + batch_size]
+            for bucket in limited:
+                bucket.consume(sum([length for offset, length in batch]))
+            # readv sends every request up front and yields the answers in order
+            for (offset, length), data in zip(batch, remote_fp.readv(batch)):
+                os.pwrite(fd, data, offset)
+                if digest is not None:
+                    checksums.update_zeros(digest, offset - position)
+                    digest.update(data)
+                    position = offset + len(data)
+                transferred += len(data)
+                progress.update(len(data))
+        if digest is not None:
+            checksums.update_zeros(digest, block_end - position)
+        return transferred
+
+    @classmethod
+    def state_file_for(cls, local_file):
+        return local_file + cls.state_suffix
+
+    def _load_state(self, local_file, size, mtime):
+        state = {
+            'size': size, 'mtime': mtime, 'block_size': self.block_size, 'done': [], 'complete': False, 'digests': {}
+        }
+        if not os.path.isfile(local_file):
+            return state
+        try:
+            with open(self.state_file_for(local_file), 'r') as state_fp:
+                saved = json.load(state_fp)
+        except (OSError, ValueError):
+            return state
+        if saved.get('size') != size or saved.get('mtime') != mtime or saved.get('block_size') != self.block_size:
+            logging.warning('Remote file changed since last attempt, retrieving {} again'.format(local_file))
+            return state
+        saved.setdefault('digests', {})
+        return saved
+
+    def _save_state(self, local_file, state):
+        state_file = self.state_file_for(local_file)
+        with open(state_file + '.tmp', 'w') as state_fp:
+            json.dump(state, state_fp)
+        os.replace(state_file + '.tmp', state_file)
+
+    def _record_digests(self, local_file, state):
+        if not self.record_digests:
+            return
+        block_count = (state['size'] + self.block_size - 1) // self.block_size
+        blocks = [state['digests'].get(str(index)) for index in range(block_count)]
+        if None in blocks:
+            # Part of the file came from an attempt that was not hashing
+            logging.warning('No complete block digests for {}'.format(local_file))
+            return
+        self.recorded_digests[local_file] = {'size': state['size'], 'blocks': blocks}
+
+    def _worker(self, session, remote_file, fd, pending, block_done, progress, buckets, expected=None):
+        transferred = 0
+        with session.open(remote_file, 'rb') as remote_fp:
+            while True:
+                try:
+                    block = pending.get_nowait()
+                except Empty:
+                    return transferred
+                index = block[0] // self.block_size
+                attempts = self.verify_attempts if expected is not None else 1
+                for attempt in range(1, attempts + 1):
+                    digest = checksums.new_hash() if expected is not None or self.record_digests else None
+                    transferred += self._fetch_block(remote_fp, fd, block, progress, buckets, digest)
+                    if expected is None or digest.hexdigest() == expected['blocks'][index]:
+                        break
+                    if attempt == attempts:
+                        raise checksums.ChecksumError('Block {} of {} is corrupt'.format(index, remote_file))
+                    logging.warning('Block {} of {} does not match its checksum, fetching it again'.format(
+                        index,
+                        remote_file
+                    ))
+                block_done(block[0], digest.hexdigest() if digest is not None else None)
+
+    def _fetch_blocks(self, remote_file, fd, pending, block_done, progress, expected=None):
+        # Every session works through the queue of blocks, the transfer is limited by the host and per file rates
+        sessions = self._open_sessions()
+        buckets = self._buckets(self.connection_manager.download_bucket, 'download_rate')
+        workers = min(len(sessions), max(1, pending.qsize()))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(
+                    self._worker, sessions[i], remote_file, fd, pending, block_done, progress, buckets, expected
+                ) for i in range(workers)
+            ]
+            return sum([future.result() for future in futures])
+
+    def download(self, remote_file, local_file, expected=None):
+        # expected: checksums manifest entry of the file, blocks are verified as they arrive
+        sessions = self._open_sessions()
+        remote_stat = sessions[0].stat(remote_file)
+        size = remote_stat.st_size
+        extents = None
+        if S_ISBLK(remote_stat.st_mode):
+            # Devices (logical volumes, snapshots) report no size over SFTP
+            layout = self._remote_layout(remote_file)
+            if layout is None:
+                raise OSError('Could not find the size of {}'.format(remote_file))
+            size, extents = layout
+        if expected is not None and expected['size'] != size:
+            raise checksums.ChecksumError('{} is {} bytes, {} expected'.format(remote_file, size, expected['size']))
+        state = self._load_state(local_file, size, remote_stat.st_mtime)
+        if state['complete']:
+            logging.warning('{} already retrieved and unchanged, skipping'.format(local_file))
+            self._record_digests(local_file, state)
+            return 0, 0.0
+        state_lock = Lock()
+        fresh = not state['done']
+        if extents is None:
+            extents = self._remote_extents(remote_file, size)
+        blocks = self._blocks(size, extents)
+        for block_offset, block_end, pieces in blocks:
+            if pieces or block_offset in state['done']:
+                continue
+            index = block_offset // self.block_size
+            if expected is not None and expected['blocks'][index] != checksums.zero_digest(block_end - block_offset):
+                raise checksums.ChecksumError('{} has data at {} where the checksums expect a hole'.format(
+                    remote_file,
+                    block_offset
+                ))
+            if self.record_digests:
+                state['digests'][str(index)] = checksums.zero_digest(block_end - block_offset)
+            state['done'].append(block_offset)
+        done = set(state['done'])
+        unsaved = {'blocks': 0, 'since': time()}
+
+        def save_state():
+            # Page cache is enough here, the state protects against dropped connections, not power loss
+            self._save_state(local_file, state)
+            unsaved.update(blocks=0, since=time())
+
+        def block_done(offset, digest=None):
+            with state_lock:
+                state['done'].append(offset)
+                if self.record_digests:
+                    state['digests'][str(offset // self.block_size)] = digest
+                unsaved['blocks'] += 1
+                if unsaved['blocks'] >= self.state_save_blocks or \
+                        time() - unsaved['since'] >= self.state_save_interval:
+                    save_state()
+
+        started = time()
+        pending = Queue()
+        for block in blocks:
+            if block[0] not in done:
+                pending.put(block)
+        if not fresh:
+            logging.warning('Resuming {}: {} of {} ranges missing'.format(local_file, pending.qsize(), len(blocks)))
+        logging.info('{}: {} bytes of data in {} bytes'.format(
+            remote_file,
+            sum([length for offset, length in extents]),
+            size
+        ))
+        progress = TransferProgress(
+            os.path.basename(remote_file),
+            sum([length for offset, end, pieces in list(pending.queue) for piece_offset, length in pieces]),
+            self.progress_reporters
+        )
+        fd = os.open(local_file, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            self._preallocate(fd, size, extents, fresh)
+            self._save_state(local_file, state)
+            try:
+                transferred = self._fetch_blocks(remote_file, fd, pending, block_done, progress, expected)
+            finally:
+                with state_lock:
+                    if unsaved['blocks']:
+                        save_state()
+        finally:
+            os.close(fd)
+        state['complete'] = True
+        state['verified'] = expected is not None
+        self._save_state(local_file, state)
+        self._record_digests(local_file, state)
+        progress.finish()
+        elapsed = time() - started
+        logging.warning('Retrieved {}: {}'.format(remote_file, self.format_rate(transferred, elapsed)))
+        return transferred, elapsed
+
+    @staticmethod
+    def _ranges(indexes, block_size, size):
+        # Sorted block indexes as [offset, length] ranges, neighbours merged
+        ranges = []
+        for index in indexes:
+            offset = index * block_size
+            length = min(block_size, size - offset)
+            if ranges and ranges[-1][0] + ranges[-1][1] == offset:
+                ranges[-1][1] += length
+            else:
+                ranges.append([offset, length])
+        return ranges
+
+    @staticmethod
+    def _zero_range(fd, offset, length):
+        zeros = bytes(min(length, checksums.read_size))
+        for position in range(offset, offset + length, checksums.read_size):
+            os.pwrite(fd, zeros[:min(checksums.read_size, offset + length - position)], position)
+
+    def _repair_blocks(self, remote_file, fd, size, bad, expected, progress):
+        # Blocks a delta got wrong are fetched again whole, with their checksums verified on arrival
+        layout = self._remote_layout(remote_file)
+        pending = Queue()
+        for block in self._blocks(size, layout[1] if layout is not None else [[0, size]]):
+            if block[0] // self.block_size in bad:
+                self._zero_range(fd, block[0], block[1] - block[0])
+                pending.put(block)
+                progress.total = (progress.total or 0) + sum([length for offset, length in block[2]])
+        return self._fetch_blocks(remote_file, fd, pending, lambda offset, digest=None: None, progress, expected)
+
+    def download_delta(self, remote_file, local_file, seed, expected=None):
+        """
+        Rebuilds remote_file from an older version of it, like rsync does. seed(path) writes that version to path,
+        the hypervisor hashes its copy in delta_block_size blocks and only the blocks that differ are fetched.
+        Blocks that became holes are zeroed locally without a transfer.
+        """
+        sessions = self._open_sessions()
+        remote_stat = sessions[0].stat(remote_file)
+        if S_ISBLK(remote_stat.st_mode) or os.path.isfile(local_file):
+            # Earlier attempts are resumed or skipped by download()
+            return self.download(remote_file, local_file, expected)
+        started = time()
+        size, remote_blocks = remote_helpers.block_digests(self.connection_manager, remote_file, self.delta_block_size)
+        if expected is not None and expected['size'] != size:
+            raise checksums.ChecksumError('{} is {} bytes, {} expected'.format(remote_file, size, expected['size']))
+        work_file = local_file + self.delta_suffix
+        seed(work_file)
+        fd = os.open(work_file, os.O_RDWR)
+        try:
+            os.ftruncate(fd, size)
+            local_blocks = checksums.local_block_digests(work_file, self.delta_block_size)
+            changed = [
+                index for index, (remote_digest, local_digest) in enumerate(zip(remote_blocks, local_blocks))
+                if remote_digest != local_digest
+            ]
+            emptied = [
+                index for index in changed
+                if remote_blocks[index] == checksums.zero_digest(min(self.delta_block_size,
+                                                                     size - index * self.delta_block_size))
+            ]
+            for offset, length in self._ranges(emptied, self.delta_block_size, size):
+                self._zero_range(fd, offset, length)
+            emptied = set(emptied)
+            fetch = self._ranges([index for index in changed if index not in emptied], self.delta_block_size, size)
+            logging.warning('Delta of {}: {} of {} blocks changed'.format(
+                remote_file,
+                len(changed),
+                len(remote_blocks)
+            ))
+            pending = Queue()
+            for block in self._blocks(size, fetch):
+                if block[2]:
+                    pending.put(block)
+            progress = TransferProgress(
+                os.path.basename(remote_file),
+                sum([length for offset, length in fetch]),
+                self.progress_reporters
+            )
+            transferred = self._fetch_blocks(remote_file, fd, pending, lambda offset, digest=None: None, progress)
+            block_digests = None
+            if expected is not None or self.record_digests:
+                block_digests = checksums.local_block_digests(work_file, self.block_size)
+            if expected is not None:
+                bad = set(checksums.mismatched_blocks(expected, size, block_digests))
+                if bad:
+                    logging.warning('{} blocks of {} rebuilt by delta do not match their checksums'.format(
+                        len(bad),
+                        remote_file
+                    ))
+                    transferred += self._repair_blocks(remote_file, fd, size, bad, expected, progress)
+                block_digests = expected['blocks']
+        finally:
+            os.close(fd)
+        os.replace(work_file, local_file)
+        state = {
+            'size': size,
+            'mtime': remote_stat.st_mtime,
+            'block_size': self.block_size,
+            'done': list(range(0, size, self.block_size)),
+            'complete': True,
+            'verified': expected is not None,
+            'digests': dict([(str(index), digest) for index, digest in enumerate(block_digests or [])]),
+        }
+        self._save_state(local_file, state)
+        self._record_digests(local_file, state)
+        progress.finish()
+        elapsed = time() - started
+        logging.warning('Retrieved {} by delta: {}'.format(remote_file, self.format_rate(transferred, elapsed)))
+        return transferred, elapsed
+
+    def download_directory(self, remote_dir, local_dir, skip=None, manifest=None, seed=None):
+        # manifest: checksums of the backup, only usable when its blocks are the blocks of this engine.
+        # seed(file name) returns the seed of download_delta() for files with an older local version, or None.
+        files = dict()
+        if manifest is not None:
+            if manifest['block_size'] == self.block_size:
+                files = manifest['files']
+            else:
+                logging.warning('Checksum blocks of {} do not match the download blocks, not verifying'.format(
+                    remote_dir
+                ))
+        results = []
+        for attributes in self.sftp().listdir_attr(remote_dir):
+            if S_ISDIR(attributes.st_mode):
+                continue
+            if skip is not None and skip(attributes.filename):
+                logging.warning('Skipping {}, already stored locally'.format(attributes.filename))
+                continue
+            remote_file = remote_dir + '/' + attributes.filename
+            local_file = os.path.join(local_dir, attributes.filename)
+            expected = files.get(attributes.filename)
+            # Small files are cheaper to fetch than to compare
+            file_seed = seed(attributes.filename) if seed is not None and attributes.st_size > self.block_size else None
+            transferred, elapsed = None, None
+            if file_seed is not None:
+                try:
+                    transferred, elapsed = self.download_delta(remote_file, local_file, file_seed, expected)
+                except checksums.ChecksumError:
+                    raise
+                except (OSError, ValueError) as e:
+                    logging.warning('Delta retrieval of {} failed, fetching it whole: {}'.format(remote_file, e))
+                    if os.path.isfile(local_file + self.delta_suffix):
+                        os.remove(local_file + self.delta_suffix)
+            if transferred is None:
+                transferred, elapsed = self.download(remote_file, local_file, expected)
+            results.append((attributes.filename, transferred, elapsed))
+        return results
+
+
+def _read_file(file_path):
+    with open(file_path, 'rb') as file_fp:
+        return file_fp.read()
+
+
+class UploadEngine(TransferEngine):
+    # Pieces handed to each worker, every piece is written with pipelined SFTP requests
+    piece_size = 32 * 1024 * 1024
+    request_size = 32768
+    # Requests written per reservation while a rate limit is active, 1 MiB
+    throttled_batch = 32
+
+    def file_pieces(self, fd, size, sparse=True):
+        # (offset, length, read) of the data of a local file, read() returns the bytes of the piece
+        pieces = []
+        for extent_offset, extent_length in local_extents(fd, size) if sparse else [[0, size]]:
+            extent_end = extent_offset + extent_length
+            for offset in range(extent_offset, extent_end, self.piece_size):
+                length = min(self.piece_size, extent_end - offset)
+                pieces.append((offset, length, lambda offset=offset, length=length: os.pread(fd, length, offset)))
+        return pieces
+
+    @staticmethod
+    def chunk_pieces(layout):
+        # Chunk store layouts are already cut into pieces of a few MiB
+        return [
+            (offset, size, lambda chunk_file=chunk_file: _read_file(chunk_file)) for offset, size, chunk_file in layout
+        ]
+
+    def _runs(self, data, sparse):
+        # (start, end) of the parts of data worth writing, requests full of zeros stay holes in sparse files
+        if not sparse:
+            return [(0, len(data))]
+        runs = []
+        for position in range(0, len(data), self.request_size):
+            end = min(position + self.request_size, len(data))
+            if data.count(0, position, end) == end - position:
+                continue
+            if runs and runs[-1][1] == position:
+                runs[-1] = (runs[-1][0], end)
+            else:
+                runs.append((position, end))
+        return runs
+
+    def _worker(self, session, remote_file, pending, progress, buckets, sparse):
+        transferred = 0
+        with session.open(remote_file, 'r+b') as remote_fp:
+            # Writes are acknowledged in bulk, close() raises if any of them failed
+            remote_fp.set_pipelined(True)
+            while True:
+                try:
+                    offset, length, read = pending.get_nowait()
+                except Empty:
+                    return transferred
+                data = read()
+                limited = [bucket for bucket in buckets if bucket.is_limited()]
+                batch_size = self.request_size * self.throttled_batch if limited else len(data)
+                for start, end in self._runs(data, sparse):
+                    for batch_start in range(start, end, batch_size):
+                        batch = data[batch_start:min(batch_start + batch_size, end)]
+                        for bucket in limited:
+                            bucket.consume(len(batch))
+                        remote_fp.seek(offset + batch_start)
+                        remote_fp.write(batch)
+                        transferred += len(batch)
+                progress.update(length)
+
+    def _upload(self, pieces, size, remote_file, sparse=True):
+        sessions = self._open_sessions()
+        if sparse:
+            # A fresh file of the final size, whatever is not written stays a hole
+            with sessions[0].open(remote_file, 'wb') as remote_fp:
+                remote_fp.truncate(size)
+        started = time()
+        pending = Queue()
+        for piece in pieces:
+            pending.put(piece)
+        progress = TransferProgress(
+            'Restoring ' + os.path.basename(remote_file),
+            sum([length for offset, length, read in pieces]),
+            self.progress_reporters
+        )
+        buckets = self._buckets(self.connection_manager.upload_bucket, 'upload_rate')
+        workers = min(len(sessions), max(1, pending.qsize()))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(self._worker, sessions[i], remote_file, pending, progress, buckets, sparse)
+                for i in range(workers)
+            ]
+            transferred = sum([future.result() for future in futures])
+        progress.finish()
+        elapsed = time() - started
+        logging.warning('Uploaded {}: {}'.format(remote_file, self.format_rate(transferred, elapsed)))
+        return transferred, elapsed
+
+    def upload(self, local_file, remote_file, sparse=True):
+        """
+        Copies local_file to remote_file, sparse writes skip holes and zeros into a new file. Devices are not sparse,
+        every byte has to be written over whatever they held. Returns (bytes written, seconds).
+        """
+        fd = os.open(local_file, os.O_RDONLY)
+        try:
+            size = os.fstat(fd).st_size
+            return self._upload(self.file_pieces(fd, size, sparse), size, remote_file, sparse)
+        finally:
+            os.close(fd)
+
+    def upload_chunks(self, chunk_store, manifest_path, remote_file, sparse=True):
+        # A deduplicated file goes up straight from its chunks, it is never reassembled locally
+        layout = chunk_store.chunk_layout(manifest_path)
+        size = sum([size for offset, size, chunk_file in layout])
+        return self._upload(self.chunk_pieces(layout), size, remote_file, sparse)
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+import argparse
+import json
+from time import time
+from sanitexbackup.history import JobHistory
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Backup duration and throughput statistics')
+    parser.add_argument('--vm', help='only show this virtual machine')
+    parser.add_argument('--days', type=int, help='only consider the last DAYS days')
+    parser.add_argument('--database', default=JobHistory.database, help='job history database')
+    parser.add_argument('--json', action='store_true', help='machine readable output')
+    arguments = parser.parse_args()
+
+    history = JobHistory(arguments.database)
+    stats = history.stats(arguments.vm, time() - arguments.days * 86400 if arguments.days else None)
+    if arguments.json:
+        print(json.dumps(stats, indent=2))
+    else:
+        print(JobHistory.format_stats(stats))
+else:
+    print("This file shouldn't be loaded as a module...")
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+from sanitexbackup.create_backup import CreateBackup
+from sanitexbackup.history import Trace
+
+vm_xml = '<domain><name>{}</name></domain>'
+
+
+class CatalogImportTest(unittest.TestCase):
+    def setUp(self):
+        self.local_path = tempfile.mkdtemp()
+        # No SSH or libvirt connection is needed to catalog what is already on disk
+        self.backup_maker = CreateBackup.__new__(CreateBackup)
+        self.backup_maker.connection = {
+            'vm_name': 'web',
+            'catalog_path': os.path.join(self.local_path, 'catalog.sqlite'),
+        }
+        self.backup_maker.local_path = self.local_path
+
+    def tearDown(self):
+        shutil.rmtree(self.local_path)
+
+    def _local_backup(self, backup_name, vm_name='web'):
+        backup_path = os.path.join(self.local_path, backup_name)
+        os.mkdir(backup_path)
+        with open(os.path.join(backup_path, 'VMdump.xml'), 'w') as xml_fp:
+            xml_fp.write(vm_xml.format(vm_name))
+        with open(os.path.join(backup_path, 'vda.img'), 'wb') as image_fp:
+            image_fp.write(os.urandom(4096))
+
+    def test_backups_from_before_the_catalog_survive_a_first_retrieval(self):
+        # Retrieved by a version without catalog
+        self._local_backup('backup-202601011200')
+        self._local_backup('backup-202602011200')
+        # The first thing the upgraded version does is retrieving a backup, which catalogs it
+        self._local_backup('backup-web-20260301120000')
+        self.backup_maker._store_local_backup('backup-web-20260301120000', Trace(None, 'web', 'retrieve backup'))
+
+        listing = self.backup_maker.list_local_backups()
+        self.assertIn('3 backups', listing)
+        for backup_name in ('backup-202601011200', 'backup-202602011200', 'backup-web-20260301120000'):
+            self.assertIn(backup_name, listing)
+
+    def test_backups_are_cataloged_under_the_vm_they_belong_to(self):
+        self._local_backup('backup-db-20260301120000', vm_name='db')
+        self.backup_maker._store_local_backup('backup-db-20260301120000', Trace(None, 'web', 'retrieve backup'))
+        catalog = self.backup_maker._catalog()
+        self.assertEqual([backup['name'] for backup in catalog.list_all_backups('db')], ['backup-db-20260301120000'])
+        self.assertEqual(catalog.list_all_backups('web'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
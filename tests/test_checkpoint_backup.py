@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+import io
+import json
+import unittest
+from unittest import mock
+from sanitexbackup.checkpoint_backup import CheckpointBackup
+
+
+class ChainLengthTest(unittest.TestCase):
+    def _backup(self, manifests, max_chain_length=None):
+        ssh = mock.Mock()
+        stdout = mock.Mock()
+        stdout.channel.recv_exit_status.return_value = 0
+        ssh.exec_command.return_value = (mock.Mock(), stdout, mock.Mock())
+
+        def open_manifest(file_name, mode):
+            backup_dir = file_name.split('/')[-2]
+            if backup_dir not in manifests:
+                raise IOError(file_name)
+            return io.BytesIO(json.dumps(manifests[backup_dir]).encode())
+
+        ssh.open_sftp.return_value.open.side_effect = open_manifest
+        return CheckpointBackup(mock.Mock(), ssh, '/staging', [('vda', '/images/vda.img')],
+                                max_chain_length=max_chain_length)
+
+    @staticmethod
+    def _checkpoints(backup_dir):
+        return [{'name': 'sanitex-' + backup_dir, 'backup_dir': backup_dir, 'created': 1}]
+
+    def test_incremental_below_the_limit(self):
+        backup = self._backup({'b2': {'chain_length': 2}}, max_chain_length=3)
+        parent = backup._find_parent(self._checkpoints('b2'))
+        self.assertEqual(parent['chain_length'], 2)
+
+    def test_full_backup_once_the_chain_is_long_enough(self):
+        backup = self._backup({'b3': {'chain_length': 3}}, max_chain_length=3)
+        self.assertIsNone(backup._find_parent(self._checkpoints('b3')))
+
+    def test_unlimited_chain(self):
+        backup = self._backup({'b9': {'chain_length': 9}}, max_chain_length=0)
+        self.assertIsNotNone(backup._find_parent(self._checkpoints('b9')))
+
+    def test_full_backup_without_parent_manifest(self):
+        backup = self._backup(dict())
+        self.assertIsNone(backup._find_parent(self._checkpoints('b1')))
+
+
+class SupportTest(unittest.TestCase):
+    def test_old_bindings_are_not_supported(self):
+        # libvirt 4.x domains have no checkpoint calls at all
+        self.assertFalse(CheckpointBackup.is_supported(mock.Mock(spec=['name', 'XMLDesc', 'jobInfo'])))
+
+    def test_checkpoint_api_is_supported(self):
+        vm = mock.Mock(spec=['name', 'listAllCheckpoints', 'checkpointLookupByName', 'backupBegin'])
+        with mock.patch('libvirt.VIR_DOMAIN_BACKUP_BEGIN_REUSE_EXTERNAL', 2, create=True):
+            self.assertTrue(CheckpointBackup.is_supported(vm))
+
+
+if __name__ == '__main__':
+    unittest.main()
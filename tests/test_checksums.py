@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from sanitexbackup import checksums, remote_helpers
+
+block_size = 256 * 1024
+
+
+def remote_block_hasher():
+    # The class the hypervisor scripts hash with, as they define it
+    namespace = dict()
+    exec(remote_helpers.block_hasher, namespace)
+    return namespace['BlockHasher']
+
+
+def run_helper(script, *arguments):
+    output = subprocess.check_output([sys.executable, '-c', script] + [str(argument) for argument in arguments])
+    return output.decode().strip().split('\n')
+
+
+class BlockHasherParityTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        # Data, a hole of several blocks, data not aligned to a block, a trailing hole
+        self.source = os.path.join(self.work_dir, 'disk.img')
+        with open(self.source, 'wb') as source_fp:
+            source_fp.write(os.urandom(block_size + 1000))
+            source_fp.seek(5 * block_size + 123)
+            source_fp.write(os.urandom(3 * block_size))
+            source_fp.truncate(12 * block_size + 77)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_same_digests_for_the_same_calls(self):
+        data = os.urandom(3 * block_size)
+        calls = [('update', data[:1000]), ('zeros', block_size * 2 + 5), ('update', data[1000:]), ('zeros', 17)]
+        local = checksums.BlockHasher(block_size)
+        remote = remote_block_hasher()(block_size)
+        for method, argument in calls:
+            getattr(local, method)(argument)
+            getattr(remote, method)(argument)
+        self.assertEqual(local.finish(), remote.finish())
+
+    def test_block_hashes_script_matches_local_digests(self):
+        digests = json.loads(run_helper(remote_helpers.block_hashes, self.source, block_size)[0])
+        self.assertEqual(digests['size'], os.path.getsize(self.source))
+        self.assertEqual(digests['blocks'], checksums.local_block_digests(self.source, block_size))
+
+    def test_staging_copy_digests_match_local_digests(self):
+        destination = os.path.join(self.work_dir, 'staged.img')
+        lines = run_helper(remote_helpers.stage_copy, self.source, destination, 0, block_size)
+        digests = json.loads(lines[-1])
+        self.assertEqual(digests['blocks'], checksums.local_block_digests(self.source, block_size))
+        self.assertEqual(digests['blocks'], checksums.local_block_digests(destination, block_size))
+
+
+if __name__ == '__main__':
+    unittest.main()
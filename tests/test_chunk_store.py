@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from sanitexbackup.chunk_store import ChunkStore
+
+
+class ChunkStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.root = os.path.join(self.work_dir, '.chunks')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def _image(self, name, shared):
+        # Half of the data is shared by both images, so both ingests store some of the same chunks
+        file_path = os.path.join(self.work_dir, name)
+        with open(file_path, 'wb') as image_fp:
+            image_fp.write(shared + os.urandom(len(shared)))
+        with open(file_path, 'rb') as image_fp:
+            return file_path, image_fp.read()
+
+    def _ingest(self, file_path):
+        chunk_store = ChunkStore(self.root)
+        try:
+            return chunk_store.ingest(file_path)
+        finally:
+            chunk_store.close()
+
+    def test_concurrent_ingests_keep_every_chunk_indexed(self):
+        shared = os.urandom(8 * ChunkStore.max_size)
+        images = [self._image('vda-{}.img'.format(index), shared) for index in range(2)]
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            list(executor.map(self._ingest, [file_path for file_path, data in images]))
+
+        chunk_store = ChunkStore(self.root)
+        try:
+            for file_path, data in images:
+                manifest_path = ChunkStore.manifest_for(file_path)
+                for digest, size in ChunkStore.load_manifest(manifest_path)['chunks']:
+                    self.assertTrue(chunk_store.has_chunk(digest))
+                self.assertEqual(b''.join(chunk_store.read_chunks(manifest_path)), data)
+            # Nothing is unreferenced, a sweep must not touch either image
+            self.assertEqual(chunk_store.collect_garbage(self.work_dir), (0, 0))
+            os.remove(ChunkStore.manifest_for(images[0][0]))
+            removed, freed = chunk_store.collect_garbage(self.work_dir)
+            self.assertGreater(removed, 0)
+            self.assertEqual(b''.join(chunk_store.read_chunks(ChunkStore.manifest_for(images[1][0]))), images[1][1])
+        finally:
+            chunk_store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
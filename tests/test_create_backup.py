@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import os
+import shlex
+import shutil
+import subprocess
+import tempfile
+import unittest
+from unittest import mock
+from sanitexbackup.create_backup import CreateBackup
+from sanitexbackup.transfer import DownloadEngine
+
+
+class StageCommandTest(unittest.TestCase):
+    def setUp(self):
+        # A space in every path, the commands run through a shell on the hypervisor
+        self.work_dir = tempfile.mkdtemp(suffix=' stage')
+        self.image = os.path.join(self.work_dir, 'web disk.img')
+        self.staging = os.path.join(self.work_dir, 'backup dir')
+        os.mkdir(self.staging)
+        with open(self.image, 'wb') as image_fp:
+            image_fp.write(os.urandom(300 * 1024))
+            image_fp.truncate(4 * 1024 ** 2)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def _command(self, **connection):
+        backup_maker = CreateBackup.__new__(CreateBackup)
+        backup_maker.connection = dict(connection, vm_name='web')
+        return backup_maker._build_stage_command(self.image, self.staging, copies=1)
+
+    def _run(self, command):
+        subprocess.check_call(command, shell=True, stdout=subprocess.DEVNULL)
+        with open(self.image, 'rb') as image_fp, open(os.path.join(self.staging, 'web disk.img'), 'rb') as staged_fp:
+            self.assertEqual(image_fp.read(), staged_fp.read())
+
+    def test_plain_copy_keeps_holes(self):
+        command = self._command()
+        self.assertTrue(command.startswith('cp -v --sparse=always '))
+        self._run(command)
+
+    def test_paced_copy_goes_through_the_reader(self):
+        command = self._command(staging_rate='1G')
+        self.assertTrue(command.startswith('python3 -c '))
+        self.assertEqual(shlex.split(command)[3:7], [self.image, self.staging + '/web disk.img', str(1024 ** 3), '0'])
+        if shutil.which('python3'):
+            self._run(command)
+
+    def test_checksums_go_through_the_reader(self):
+        arguments = shlex.split(self._command(checksums=True))
+        self.assertEqual(arguments[6], str(DownloadEngine.block_size))
+
+    def test_compression(self):
+        command = self._command(compression_level=3, compression_threads=2)
+        self.assertTrue(command.startswith('zstd -q -T2 -3 -c '))
+        self.assertIn(shlex.quote(self.staging + '/web disk.img.zst'), command)
+        paced = shlex.split(self._command(compression_level=22, staging_rate='10M'))
+        self.assertEqual(paced[7:], ['zstd', '-q', '--ultra', '-T0', '-22', '-c'])
+
+    def test_io_class_wraps_the_whole_command(self):
+        command = self._command(staging_io_class='idle')
+        self.assertTrue(command.startswith('ionice -c3 sh -c '))
+        self.assertEqual(shlex.split(command)[4], self._command())
+        self.assertEqual(self._command(staging_io_class='realtime'), self._command())
+
+
+class RemoteListingTest(unittest.TestCase):
+    def test_only_backups_of_the_vm_are_listed(self):
+        backup_maker = CreateBackup.__new__(CreateBackup)
+        backup_maker.connection = {'vm_name': 'web'}
+        backup_maker.remote_path = '/var/lib/libvirt/backup'
+        listed = [
+            {'name': name, 'files': 2, 'size': 1024, 'allocated': 512, 'mtime': 0, 'vm': vm,
+             'path': backup_maker.remote_path, 'parent': None}
+            for name, vm in (('2026-03-04-10-00-00', 'web'), ('2026-03-04-11-00-00', 'db'), ('partial', None))
+        ]
+        with mock.patch.object(backup_maker, 'get_remote_backups', return_value=listed):
+            lines = backup_maker.list_remote_backups().strip().split('\n')
+        self.assertEqual(len(lines), 1)
+        self.assertTrue(lines[0].startswith('2026-03-04-10-00-00 '))
+        with mock.patch.object(backup_maker, 'get_remote_backups', return_value=listed[1:]):
+            self.assertEqual(backup_maker.list_remote_backups(), 'No backups found.\n')
+        with mock.patch.object(backup_maker, 'get_remote_backups', return_value=False):
+            self.assertFalse(backup_maker.list_remote_backups())
+
+
+if __name__ == '__main__':
+    unittest.main()
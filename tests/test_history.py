@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+from sanitexbackup.history import JobHistory, Trace
+
+
+class JobHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.database = os.path.join(self.work_dir, 'history.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_phases_aggregate_across_files(self):
+        history = JobHistory(self.database)
+        for file_name in ('disk0.img', 'disk1.img'):
+            trace = Trace(history, 'web', 'create backup')
+            trace.add_span('copy', trace.started, 2.0, 1000000, file_name)
+            trace.finish('ok')
+        phases = [row for row in history.stats('web') if row['phase'] == 'copy']
+        self.assertEqual(len(phases), 1)
+        self.assertEqual(phases[0]['count'], 2)
+        files = history.db.execute("SELECT file FROM spans WHERE phase = 'copy' ORDER BY file").fetchall()
+        self.assertEqual(files, [('disk0.img',), ('disk1.img',)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+import unittest
+from threading import Event
+from sanitexbackup.jobs import JobQueue
+
+timeout = 10
+
+
+class JobQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.queue = JobQueue(workers=4)
+
+    def tearDown(self):
+        self.queue.executor.shutdown(wait=True)
+
+    def _blocking(self, name):
+        # A job that runs until released, started tells when it began
+        started, release = Event(), Event()
+
+        def function():
+            started.set()
+            release.wait(timeout)
+            return name
+        return function, started, release
+
+    def _wait_done(self, job):
+        # Subscribers are called after the status changes, so only jobs still blocked wait for theirs
+        done = Event()
+        with self.queue.lock:
+            if not job.is_pending():
+                return job
+            job.subscribers.append(lambda finished_job: done.set())
+        self.assertTrue(done.wait(timeout))
+        return job
+
+    def test_same_request_is_coalesced(self):
+        function, started, release = self._blocking('first')
+        notified = []
+        job, is_new = self.queue.submit('web', 'create backup', function, (), notified.append)
+        again, again_new = self.queue.submit('web', 'create backup', function, (), notified.append)
+        self.assertTrue(is_new)
+        self.assertFalse(again_new)
+        self.assertIs(again, job)
+        done = Event()
+        self.queue.submit('web', 'create backup', function, (), lambda finished_job: done.set())
+        release.set()
+        self.assertTrue(done.wait(timeout))
+        self.assertEqual(notified, [job, job])
+        self.assertEqual(job.result, 'first')
+
+    def test_other_arguments_or_vms_are_new_jobs(self):
+        function, started, release = self._blocking('job')
+        first, first_new = self.queue.submit('web', 'retrieve backup', function, ('a',))
+        second, second_new = self.queue.submit('web', 'retrieve backup', function, ('b',))
+        third, third_new = self.queue.submit('db', 'retrieve backup', function, ('a',))
+        self.assertTrue(first_new and second_new and third_new)
+        self.assertEqual(len(set([first.job_id, second.job_id, third.job_id])), 3)
+        release.set()
+        for job in (first, second, third):
+            self._wait_done(job)
+
+    def test_jobs_of_one_vm_run_one_at_a_time(self):
+        web_function, web_started, web_release = self._blocking('web 1')
+        first, is_new = self.queue.submit('web', 'create backup', web_function)
+        self.assertTrue(web_started.wait(timeout))
+        second_function, second_started, second_release = self._blocking('web 2')
+        second, is_new = self.queue.submit('web', 'prune backups', second_function)
+        db_function, db_started, db_release = self._blocking('db')
+        other, is_new = self.queue.submit('db', 'create backup', db_function)
+        # Another VM is not held back by web
+        self.assertTrue(db_started.wait(timeout))
+        self.assertFalse(second_started.wait(0.2))
+        self.assertEqual(second.status, 'queued')
+        web_release.set()
+        self.assertTrue(second_started.wait(timeout))
+        second_release.set()
+        db_release.set()
+        for job in (first, second, other):
+            self._wait_done(job)
+
+    def test_job_of_every_vm_runs_alone_and_keeps_its_place(self):
+        web_function, web_started, web_release = self._blocking('web')
+        web, is_new = self.queue.submit('web', 'create backup', web_function)
+        self.assertTrue(web_started.wait(timeout))
+        all_function, all_started, all_release = self._blocking('all')
+        every, is_new = self.queue.submit(JobQueue.all_vms, 'backup all', all_function)
+        db_function, db_started, db_release = self._blocking('db')
+        db, is_new = self.queue.submit('db', 'create backup', db_function)
+        # db is free, but was submitted after the job of every VM
+        self.assertFalse(all_started.wait(0.2))
+        self.assertFalse(db_started.is_set())
+        web_release.set()
+        self.assertTrue(all_started.wait(timeout))
+        self.assertFalse(db_started.wait(0.2))
+        all_release.set()
+        self.assertTrue(db_started.wait(timeout))
+        db_release.set()
+        for job in (web, every, db):
+            self._wait_done(job)
+
+    def test_failures_reach_the_subscribers(self):
+        notified = []
+        done = Event()
+
+        def failing():
+            raise OSError('disk gone')
+
+        def subscriber(job):
+            notified.append(job)
+            done.set()
+
+        job, is_new = self.queue.submit('web', 'create backup', failing, (), subscriber)
+        self.assertTrue(done.wait(timeout))
+        self.assertEqual(job.status, 'failed')
+        self.assertIsInstance(job.error, OSError)
+        self.assertIsNone(job.result)
+        self.assertEqual(notified, [job])
+        self.assertIsNotNone(job.finished)
+
+    def test_failing_subscriber_does_not_block_the_vm(self):
+        def broken_subscriber(job):
+            raise ValueError('chat unreachable')
+
+        job, is_new = self.queue.submit('web', 'create backup', lambda: 'ok', (), broken_subscriber)
+        self._wait_done(job)
+        following, is_new = self.queue.submit('web', 'prune backups', lambda: 'pruned')
+        self.assertEqual(self._wait_done(following).result, 'pruned')
+
+    def test_finished_jobs_are_forgotten_past_the_history_size(self):
+        self.queue.history_size = 3
+        jobs = [self._wait_done(self.queue.submit('web', 'list', lambda: None, (index,))[0]) for index in range(5)]
+        self.queue.submit('web', 'list', lambda: None, (5,))
+        remaining = [job.job_id for job in self.queue.list()]
+        self.assertNotIn(jobs[0].job_id, remaining)
+        self.assertLessEqual(len(remaining), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+from sanitexbackup.create_backup import CreateBackup
+from sanitexbackup.history import JobHistory, Trace
+from sanitexbackup.orchestrator import BackupOrchestrator, expand_connections
+
+
+class ExpandConnectionsTest(unittest.TestCase):
+    def test_classic_single_vm(self):
+        config = {'host': 'kvm1', 'vm_name': 'web', 'telegram_token': 'token'}
+        self.assertEqual(expand_connections(config), [config])
+        self.assertEqual(expand_connections({'host': 'kvm1'}), [])
+
+    def test_vm_keys_override_host_keys_override_globals(self):
+        config = {
+            'telegram_token': 'token',
+            'users': ['admin'],
+            'backup_mode': 'full',
+            'local_path': '/backups',
+            'hosts': [
+                {'host': 'kvm1', 'backup_mode': 'live', 'vms': ['web', {'name': 'db', 'backup_mode': 'incremental'}]},
+                {'host': 'kvm2', 'port': 2222, 'vms': [{'name': 'mail'}]},
+            ],
+        }
+        connections = expand_connections(config)
+        self.assertEqual([connection['vm_name'] for connection in connections], ['web', 'db', 'mail'])
+        self.assertEqual([connection['backup_mode'] for connection in connections], ['live', 'incremental', 'full'])
+        self.assertEqual([connection['host'] for connection in connections], ['kvm1', 'kvm1', 'kvm2'])
+        self.assertEqual(connections[2]['port'], 2222)
+        for connection in connections:
+            self.assertEqual(connection['local_path'], '/backups')
+            for key in ('hosts', 'users', 'telegram_token', 'vms', 'name'):
+                self.assertNotIn(key, connection)
+
+    def test_empty_hosts(self):
+        self.assertEqual(expand_connections({'hosts': None}), [])
+        self.assertEqual(expand_connections({'hosts': [{'host': 'kvm1', 'vms': None}]}), [])
+
+
+class ExpectedDowntimeTest(unittest.TestCase):
+    def setUp(self):
+        self.local_path = tempfile.mkdtemp()
+        self.history = JobHistory.shared(os.path.join(self.local_path, 'history.sqlite'))
+
+    def tearDown(self):
+        with JobHistory.instances_lock:
+            del JobHistory.instances[self.history.database]
+        self.history.db.close()
+        shutil.rmtree(self.local_path)
+
+    def _backup_maker(self, vm_name):
+        backup_maker = CreateBackup.__new__(CreateBackup)
+        backup_maker.connection = {'vm_name': vm_name}
+        backup_maker.local_path = self.local_path
+        return backup_maker
+
+    def _run(self, vm_name, duration, downtime):
+        trace = Trace(self.history, vm_name, 'create backup')
+        trace.add_span('downtime', trace.started, downtime)
+        trace.started -= duration
+        trace.finish('ok')
+
+    def test_vms_that_stay_up_go_first(self):
+        # A long live copy keeps the guest running, the short full one stops it
+        self._run('live', 600, 0.0)
+        self._run('full', 60, 45.0)
+        order = sorted([self._backup_maker(vm) for vm in ('full', 'new', 'live')],
+                       key=BackupOrchestrator._expected_downtime)
+        self.assertEqual([backup_maker.connection['vm_name'] for backup_maker in order], ['live', 'full', 'new'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+import unittest
+from unittest import mock
+from sanitexbackup.progress import ProgressReporter, TransferProgress
+
+
+class ProgressReporterTest(unittest.TestCase):
+    def setUp(self):
+        self.messages = []
+        self.reporter = ProgressReporter(self.messages.append, 300)
+
+    def test_parallel_transfers_share_one_message(self):
+        transfers = [TransferProgress('disk{}.img'.format(index), 100, [self.reporter]) for index in range(4)]
+        for transfer in transfers:
+            transfer.update(50)
+            transfer.finish()
+        # Every finish used to force a message of its own
+        self.assertEqual(self.messages, [])
+        self.reporter.last_sent -= 300
+        TransferProgress('disk4.img', 100, [self.reporter]).finish()
+        self.assertEqual(len(self.messages), 1)
+        self.assertEqual(len(self.messages[0].split('\n')), 5)
+        self.assertTrue(all([line.startswith('done disk') for line in self.messages[0].split('\n')]))
+
+    def test_running_transfers_are_listed_once(self):
+        transfer = TransferProgress('disk0.img', 100, [self.reporter])
+        with mock.patch('sanitexbackup.progress.time', return_value=transfer.started + 301):
+            transfer.update(10)
+            transfer.update(10)
+        self.assertEqual(len(self.messages), 1)
+        self.assertTrue(self.messages[0].startswith('disk0.img: '))
+
+
+if __name__ == '__main__':
+    unittest.main()
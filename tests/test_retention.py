@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+import unittest
+from datetime import datetime, timedelta
+from sanitexbackup import retention
+
+start = datetime(2026, 1, 1, 3, 0)
+
+
+def backups_every(step, count):
+    # Oldest first, b0 is the oldest
+    return [
+        {'name': 'b{}'.format(index), 'created': (start + step * index).timestamp()}
+        for index in range(count)
+    ]
+
+
+class SelectTest(unittest.TestCase):
+    def test_keep_last(self):
+        keep, doomed = retention.select(backups_every(timedelta(hours=1), 5), {'keep_last': 2})
+        self.assertEqual(sorted(keep), ['b3', 'b4'])
+        self.assertEqual([backup['name'] for backup in doomed], ['b0', 'b1', 'b2'])
+
+    def test_daily_keeps_the_newest_of_each_day(self):
+        # Four backups a day for three days
+        keep, doomed = retention.select(backups_every(timedelta(hours=6), 12), {'daily': 2})
+        self.assertEqual(sorted(keep), ['b11', 'b7'])
+        self.assertEqual(len(doomed), 10)
+
+    def test_weekly(self):
+        # Daily from Thursday January 1st to Wednesday January 21st, weeks start on Monday
+        keep, doomed = retention.select(backups_every(timedelta(days=1), 21), {'weekly': 2})
+        self.assertEqual(sorted(keep), ['b17', 'b20'])
+
+    def test_monthly(self):
+        keep, doomed = retention.select(backups_every(timedelta(days=10), 9), {'monthly': 3})
+        # b8 is in March, b5 (February 20) the last one of February, b3 (January 31) the last one of January
+        self.assertEqual(sorted(keep), ['b3', 'b5', 'b8'])
+
+    def test_rules_add_up_with_reasons(self):
+        keep, doomed = retention.select(backups_every(timedelta(hours=6), 12), {'keep_last': 1, 'daily': 2})
+        self.assertEqual(keep['b11'], ['keep_last', 'daily'])
+        self.assertEqual(keep['b7'], ['daily'])
+
+    def test_pinned_backups_stay(self):
+        keep, doomed = retention.select(backups_every(timedelta(hours=1), 3), {'keep_last': 1}, pinned={
+            'b0': 'not retrieved yet', 'gone': 'not retrieved yet'
+        })
+        self.assertEqual(sorted(keep), ['b0', 'b2'])
+        self.assertEqual([backup['name'] for backup in doomed], ['b1'])
+
+    def test_parents_of_kept_backups_stay(self):
+        parents = dict([('b{}'.format(index), 'b{}'.format(index - 1)) for index in range(1, 10)])
+        keep, doomed = retention.select(backups_every(timedelta(hours=1), 10), {'keep_last': 2}, parents)
+        # A chain that never ends keeps everything, max_chain_length is what makes incrementals prunable
+        self.assertEqual(len(keep), 10)
+        self.assertEqual(keep['b0'], ['parent of b9', 'parent of b8'])
+        self.assertEqual(doomed, [])
+
+    def test_chains_ended_by_full_backups_are_pruned(self):
+        # A full backup every four: b0, b4 and b8 have no parent
+        parents = dict([('b{}'.format(index), 'b{}'.format(index - 1)) for index in range(1, 10) if index % 4])
+        keep, doomed = retention.select(backups_every(timedelta(hours=1), 10), {'keep_last': 2}, parents)
+        self.assertEqual(sorted(keep), ['b8', 'b9'])
+        self.assertEqual([backup['name'] for backup in doomed], ['b0', 'b1', 'b2', 'b3', 'b4', 'b5', 'b6', 'b7'])
+
+    def test_empty_policy_is_not_configured(self):
+        self.assertFalse(retention.is_configured(dict()))
+        self.assertFalse(retention.is_configured({'keep_last': 0, 'only_retrieved': True}))
+        self.assertTrue(retention.is_configured({'monthly': 1}))
+
+
+if __name__ == '__main__':
+    unittest.main()
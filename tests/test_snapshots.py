@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+import unittest
+from unittest import mock
+from sanitexbackup.snapshots import SnapshotManager
+
+day = 86400
+
+
+def snapshot(name, parent, created, external=False):
+    return {
+        'name': name,
+        'parent': parent,
+        'created': created,
+        'state': 'running',
+        'external': external,
+        'files': ['/var/lib/libvirt/images/{}.qcow2'.format(name)] if external else [],
+        'size': None,
+        'current': False,
+    }
+
+
+class WalkTest(unittest.TestCase):
+    def test_parents_before_children_oldest_first(self):
+        snapshots = [
+            snapshot('b1', 'a', 20),
+            snapshot('c', None, 30),
+            snapshot('a', None, 10),
+            snapshot('b2', 'a', 15),
+            snapshot('b1x', 'b1', 25),
+        ]
+        walked = [(depth, item['name']) for depth, item in SnapshotManager.walk(snapshots)]
+        self.assertEqual(walked, [(0, 'a'), (1, 'b2'), (1, 'b1'), (2, 'b1x'), (0, 'c')])
+
+    def test_missing_parent_becomes_a_root(self):
+        walked = SnapshotManager.walk([snapshot('orphan', 'deleted', 10)])
+        self.assertEqual([(depth, item['name']) for depth, item in walked], [(0, 'orphan')])
+
+
+class ExpiredTest(unittest.TestCase):
+    now = 100 * day
+    snapshots = [snapshot('auto-{}'.format(age), None, 100 * day - age * day) for age in (1, 2, 5, 10, 30)] + [
+        snapshot('manual', None, 0),
+    ]
+
+    def _expired(self, **rules):
+        return sorted([item['name'] for item in SnapshotManager.expired(self.snapshots, now=self.now, **rules)])
+
+    def test_no_rules_keep_everything(self):
+        self.assertEqual(self._expired(), [])
+
+    def test_keep_last(self):
+        self.assertEqual(self._expired(keep_last=2, match='auto-*'), ['auto-10', 'auto-30', 'auto-5'])
+
+    def test_max_age(self):
+        self.assertEqual(self._expired(max_age_days=7, match='auto-*'), ['auto-10', 'auto-30'])
+
+    def test_both_rules_must_agree(self):
+        # auto-5 is past the newest two but young enough to stay
+        self.assertEqual(self._expired(keep_last=2, max_age_days=7, match='auto-*'), ['auto-10', 'auto-30'])
+
+    def test_match_protects_other_names(self):
+        self.assertIn('manual', self._expired(keep_last=1))
+        self.assertNotIn('manual', self._expired(keep_last=1, match='auto-*'))
+
+
+class DeleteTest(unittest.TestCase):
+    def setUp(self):
+        self.vm = mock.Mock()
+        self.manager = SnapshotManager(self.vm, mock.Mock())
+        self.snapshots = [
+            snapshot('a', None, 10),
+            snapshot('a1', 'a', 20),
+            snapshot('a2', 'a1', 30),
+            snapshot('ext', None, 40, external=True),
+            snapshot('b', None, 50),
+            snapshot('b1', 'b', 60),
+        ]
+        mock.patch.object(self.manager, 'tree', return_value=self.snapshots).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def _looked_up(self):
+        return [call[0][0] for call in self.vm.snapshotLookupByName.call_args_list]
+
+    def test_whole_subtree_goes_in_one_call(self):
+        results = self.manager.delete(['a', 'a1', 'a2'])
+        self.assertEqual(results, {'a': None, 'a1': None, 'a2': None})
+        self.assertEqual(self._looked_up(), ['a'])
+
+    def test_parent_without_its_children(self):
+        results = self.manager.delete(['b'])
+        self.assertEqual(results, {'b': None})
+        self.assertEqual(self._looked_up(), ['b'])
+
+    def test_external_and_unknown_are_kept(self):
+        results = self.manager.delete(['ext', 'gone'])
+        self.assertEqual(results['gone'], 'not found')
+        self.assertTrue(results['ext'].startswith('external'))
+        self.assertEqual(self._looked_up(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import unittest
+from datetime import datetime
+from sanitexbackup.create_backup import CreateBackup
+from sanitexbackup.throttle import TokenBucket, parse_rate, scheduled_rate
+
+
+class ParseRateTest(unittest.TestCase):
+    def test_suffixes(self):
+        self.assertEqual(parse_rate('50M'), 50 * 1024 ** 2)
+        self.assertEqual(parse_rate('1.5k'), 1536)
+        self.assertEqual(parse_rate('2G'), 2 * 1024 ** 3)
+        self.assertEqual(parse_rate('10MB/s'), 10 * 1024 ** 2)
+        self.assertEqual(parse_rate(' 100 '), 100)
+
+    def test_numbers(self):
+        self.assertEqual(parse_rate(4096), 4096)
+        self.assertEqual(parse_rate(2.5), 2)
+
+    def test_unlimited(self):
+        for value in (None, 0, '', '0', '0M'):
+            self.assertIsNone(parse_rate(value))
+
+    def test_invalid_is_unlimited(self):
+        self.assertIsNone(parse_rate('fast'))
+
+
+class ScheduledRateTest(unittest.TestCase):
+    connection = {
+        'download_rate': '100M',
+        'rate_schedule': [
+            {'from': '08:00', 'to': '20:00', 'download_rate': '10M'},
+            # Wraps around midnight
+            {'from': '22:00', 'to': '06:00', 'download_rate': 0, 'staging_rate': '1M'},
+        ],
+    }
+
+    def _rate(self, hour, minute=0, key='download_rate'):
+        return scheduled_rate(self.connection, key, datetime(2026, 3, 4, hour, minute))
+
+    def test_plain_key_outside_windows(self):
+        self.assertEqual(self._rate(7, 59), 100 * 1024 ** 2)
+        self.assertEqual(self._rate(20, 0), 100 * 1024 ** 2)
+        self.assertEqual(self._rate(21, 59), 100 * 1024 ** 2)
+
+    def test_daytime_window(self):
+        self.assertEqual(self._rate(8, 0), 10 * 1024 ** 2)
+        self.assertEqual(self._rate(19, 59), 10 * 1024 ** 2)
+
+    def test_window_past_midnight(self):
+        self.assertIsNone(self._rate(22, 0))
+        self.assertIsNone(self._rate(0, 30))
+        self.assertIsNone(self._rate(5, 59))
+        self.assertEqual(self._rate(6, 0), 100 * 1024 ** 2)
+
+    def test_windows_only_override_their_keys(self):
+        self.assertEqual(self._rate(23, 0, 'staging_rate'), 1024 ** 2)
+        self.assertIsNone(self._rate(12, 0, 'staging_rate'))
+
+    def test_no_schedule(self):
+        self.assertEqual(scheduled_rate({'upload_rate': '1K'}, 'upload_rate'), 1024)
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_unlimited_never_waits(self):
+        bucket = TokenBucket(lambda: None)
+        self.assertFalse(bucket.is_limited())
+        self.assertEqual(bucket.consume(10 ** 12), 0.0)
+
+    def test_debt_is_paid_in_time(self):
+        bucket = TokenBucket(lambda: 1000)
+        bucket.burst_seconds = 0
+        self.assertTrue(bucket.is_limited())
+        self.assertAlmostEqual(bucket.consume(50), 0.05, delta=0.02)
+
+
+class StagingRateTest(unittest.TestCase):
+    def _backup_maker(self, **connection):
+        backup_maker = CreateBackup.__new__(CreateBackup)
+        backup_maker.connection = dict(connection, vm_name='web')
+        return backup_maker
+
+    def test_single_copy_gets_the_whole_rate(self):
+        backup_maker = self._backup_maker(staging_rate='100M', copy_concurrency=2)
+        self.assertEqual(backup_maker._staging_rate(1), 100 * 1024 ** 2)
+        self.assertEqual(backup_maker._staging_rate(2), 50 * 1024 ** 2)
+
+    def test_unlimited(self):
+        self.assertEqual(self._backup_maker(copy_concurrency=4)._staging_rate(4), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import paramiko
+from benchmarks.sftp_server import BenchmarkSSHServer
+from sanitexbackup.connection_manager import ConnectionManager
+from sanitexbackup.transfer import DownloadEngine
+
+
+class RateLookupTest(unittest.TestCase):
+    def setUp(self):
+        host = {'host': 'kvm1', 'user': 'root', 'keyfile': '/dev/null', 'libvirt_uri': 'test:///default'}
+        self.web = dict(host, vm_name='web', download_rate='10M', transfer_rate='1M')
+        self.db = dict(host, vm_name='db', download_rate=0, transfer_rate=0)
+        # The manager is built from the first VM of the host, db then reuses it
+        self.connection_manager = ConnectionManager(self.web)
+
+    def test_engine_uses_rates_of_its_own_vm(self):
+        engine = DownloadEngine(self.connection_manager, connection=self.db)
+        host_bucket, file_bucket = engine._buckets(self.connection_manager.download_bucket, 'download_rate')
+        self.assertFalse(host_bucket.is_limited())
+        self.assertFalse(file_bucket.is_limited())
+        engine = DownloadEngine(self.connection_manager, connection=self.web)
+        host_bucket, file_bucket = engine._buckets(self.connection_manager.download_bucket, 'download_rate')
+        self.assertTrue(host_bucket.is_limited())
+        self.assertTrue(file_bucket.is_limited())
+
+    def test_rate_schedule_of_the_job_applies(self):
+        self.db['rate_schedule'] = [{'from': '00:00', 'to': '24:00', 'download_rate': '5M'}]
+        engine = DownloadEngine(self.connection_manager, connection=self.db)
+        host_bucket, file_bucket = engine._buckets(self.connection_manager.download_bucket, 'download_rate')
+        self.assertTrue(host_bucket.is_limited())
+
+
+class DownloadTest(unittest.TestCase):
+    block_size = 1024 * 1024
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        client_key = paramiko.RSAKey.generate(2048)
+        key_file = os.path.join(self.work_dir, 'id')
+        client_key.write_private_key_file(key_file)
+        self.server = BenchmarkSSHServer(client_key).start()
+        self.connection_manager = ConnectionManager({
+            'host': self.server.host, 'port': self.server.port, 'user': 'test', 'keyfile': key_file
+        })
+        self.remote_file = os.path.join(self.work_dir, 'remote.img')
+        with open(self.remote_file, 'wb') as remote_fp:
+            remote_fp.write(os.urandom(64 * self.block_size))
+        self.local_file = os.path.join(self.work_dir, 'local.img')
+
+    def tearDown(self):
+        self.connection_manager.close()
+        self.server.stop()
+        shutil.rmtree(self.work_dir)
+
+    def _download(self):
+        engine = DownloadEngine(self.connection_manager, channels=2, block_size=self.block_size)
+        try:
+            with mock.patch.object(engine, '_save_state', wraps=engine._save_state) as save_state:
+                transferred, elapsed = engine.download(self.remote_file, self.local_file)
+        finally:
+            engine.close()
+        with open(self.remote_file, 'rb') as remote_fp, open(self.local_file, 'rb') as local_fp:
+            self.assertEqual(remote_fp.read(), local_fp.read())
+        return transferred, save_state.call_count
+
+    def test_state_is_saved_in_batches(self):
+        transferred, saves = self._download()
+        self.assertEqual(transferred, 64 * self.block_size)
+        # Initial and final saves plus one per batch, not one per block
+        self.assertLessEqual(saves, 64 // DownloadEngine.state_save_blocks + 4)
+
+    def test_resume_fetches_only_missing_blocks(self):
+        self._download()
+        state_file = DownloadEngine.state_file_for(self.local_file)
+        with open(state_file, 'r') as state_fp:
+            state = json.load(state_fp)
+        state['complete'] = False
+        state['done'] = [offset for offset in state['done'] if offset < 16 * self.block_size]
+        with open(state_file, 'w') as state_fp:
+            json.dump(state, state_fp)
+        with open(self.local_file, 'r+b') as local_fp:
+            local_fp.seek(16 * self.block_size)
+            local_fp.write(bytes(48 * self.block_size))
+        transferred, saves = self._download()
+        self.assertEqual(transferred, 48 * self.block_size)
+
+    def _write_blocks(self, file_name, blocks):
+        with open(file_name, 'r+b') as file_fp:
+            for index, data in blocks.items():
+                file_fp.seek(index * self.block_size)
+                file_fp.write(data)
+
+    def _download_delta(self, old_version):
+        engine = DownloadEngine(self.connection_manager, channels=2, block_size=self.block_size,
+                                delta_block_size=self.block_size)
+        try:
+            transferred, elapsed = engine.download_delta(
+                self.remote_file, self.local_file, lambda work_file: shutil.copyfile(old_version, work_file)
+            )
+        finally:
+            engine.close()
+        with open(self.remote_file, 'rb') as remote_fp, open(self.local_file, 'rb') as local_fp:
+            self.assertEqual(remote_fp.read(), local_fp.read())
+        self.assertFalse(os.path.exists(self.local_file + DownloadEngine.delta_suffix))
+        return transferred
+
+    def test_delta_fetches_only_changed_blocks(self):
+        old_version = os.path.join(self.work_dir, 'old.img')
+        shutil.copyfile(self.remote_file, old_version)
+        # Two blocks changed, one became a hole and is zeroed without a transfer
+        self._write_blocks(self.remote_file, {
+            3: os.urandom(self.block_size), 10: os.urandom(100), 20: bytes(self.block_size)
+        })
+        self.assertEqual(self._download_delta(old_version), 2 * self.block_size)
+
+    def test_delta_of_a_grown_file(self):
+        old_version = os.path.join(self.work_dir, 'old.img')
+        shutil.copyfile(self.remote_file, old_version)
+        with open(old_version, 'r+b') as old_fp:
+            old_fp.truncate(60 * self.block_size)
+        self.assertEqual(self._download_delta(old_version), 4 * self.block_size)
+
+
+if __name__ == '__main__':
+    unittest.main()